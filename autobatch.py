@@ -0,0 +1,75 @@
+import os
+import json
+import time
+import threading
+import torch
+
+import sampling
+from memory import MemoryMonitor, available_memory, free_memory, rss
+from utils import atomic_write, clip
+
+
+MODELS_FILE = "batch_models.json"
+
+
+def measure(pipe, width: int, height: int, device: str, batch: int) -> int:
+    free_memory(device)
+    embeds = sampling.encode(pipe, "", "", device)
+    dtype = embeds['cond'].dtype
+    baseline = torch.cuda.memory_allocated() if device == "cuda" else rss()
+    monitor = MemoryMonitor(device, interval=0.01)
+    with monitor:
+        scheduler = sampling.make_scheduler(pipe, 1, device)
+        latents = sampling.initial_latents(
+            pipe, list(range(batch)), width, height, device, dtype
+        ) * scheduler.init_noise_sigma
+        latents = sampling.denoise(pipe, latents, embeds, scheduler, 7.5, width, height)
+        sampling.decode(pipe, latents)
+    del latents
+    peak = monitor.peak_device if device == "cuda" else monitor.peak_rss
+    free_memory(device)
+    return max(peak - baseline, 0)
+
+
+def calibrate(pipe, width: int, height: int, device: str) -> dict:
+    # Memory of a batch is modeled as base + per_image * batch, fitted from one step runs with 1 and 2 images
+    single = measure(pipe, width, height, device, 1)
+    double = measure(pipe, width, height, device, 2)
+    per_image = double - single if double > single else single
+    return {'base': max(single - per_image, 0), 'per_image': max(per_image, 1), 'measured': time.time()}
+
+
+class BatchModels:
+    def __init__(self, cache_dir: str, safety: float = 0.85, max_batch: int = 16):
+        self.filename = os.path.join(cache_dir, MODELS_FILE)
+        self.safety = safety
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename, 'rt', encoding='utf-8') as file:
+                self.models = json.load(file)
+        except (OSError, ValueError):
+            self.models = {}
+
+    @staticmethod
+    def key(model: dict, device_opts: dict, width: int, height: int, memory_mode: list) -> str:
+        return "|".join([
+            model['repo'], model['variant'], model['dtype'], device_opts.get('name', device_opts['type']),
+            f"{width}x{height}", "+".join(memory_mode) or "default"
+        ] + ([model['engine']] if 'engine' in model else []))
+
+    def get(self, key: str):
+        with self.lock:
+            return self.models.get(key)
+
+    def put(self, key: str, entry: dict):
+        with self.lock:
+            self.models[key] = entry
+            atomic_write(self.filename, json.dumps(self.models, indent=1, sort_keys=True))
+
+    def batch_size(self, key: str, device: str):
+        entry = self.get(key)
+        free = available_memory(device)
+        if entry is None or free is None:
+            return None
+        return clip(int((free * self.safety - entry['base']) // entry['per_image']), 1, self.max_batch)
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+
+
+def tiny_pipeline(folder: str) -> str:
+    # Randomly initialized miniature Stable Diffusion, enough to time the code paths without downloads
+    import torch
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel, AutoencoderKL, DDIMScheduler
+    from transformers import CLIPTextModel, CLIPTextConfig, CLIPTokenizer
+
+    path = os.path.join(folder, "tiny-sd")
+    if os.path.isfile(os.path.join(path, "model_index.json")):
+        return path
+    torch.manual_seed(0)
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}
+    for char in "abcdefghijklmnopqrstuvwxyz":
+        vocab[char] = len(vocab)
+        vocab[char + "</w>"] = len(vocab)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "vocab.json"), 'wt') as file:
+        json.dump(vocab, file)
+    with open(os.path.join(folder, "merges.txt"), 'wt') as file:
+        file.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(os.path.join(folder, "vocab.json"), os.path.join(folder, "merges.txt"), model_max_length=16)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(vocab), hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4,
+        max_position_embeddings=16, bos_token_id=0, eos_token_id=1, pad_token_id=1
+    ))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64, 64), layers_per_block=2, sample_size=32, in_channels=4, out_channels=4,
+        down_block_types=("CrossAttnDownBlock2D", "CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32, attention_head_dim=8, norm_num_groups=8
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(16, 32), in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=8,
+        down_block_types=("DownEncoderBlock2D",) * 2, up_block_types=("UpDecoderBlock2D",) * 2, sample_size=64
+    )
+    pipe = StableDiffusionPipeline(
+        unet=unet, vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, scheduler=DDIMScheduler(),
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False
+    )
+    pipe.save_pretrained(path)
+    return path
+
+
+def parse_list(text: str, dtype) -> list:
+    return [dtype(item) for item in text.split(',') if item.strip()]
+
+
+def psnr(reference, image) -> float:
+    error = np.mean((np.asarray(reference, dtype=np.float64) - np.asarray(image, dtype=np.float64)) ** 2)
+    return float('inf') if error == 0 else 10 * np.log10(255 ** 2 / error)
+
+
+def timed_run(handler, repeats: int, **kwargs):
+    times, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = handler.run(**kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def report(name: str, elapsed: float, base_time: float, reference: list, result: list):
+    quality = [psnr(ref_image, image) for (ref_image, _), (image, _) in zip(reference, result)]
+    diff = max(
+        int(np.abs(np.asarray(ref_image, dtype=np.int16) - np.asarray(image, dtype=np.int16)).max())
+        for (ref_image, _), (image, _) in zip(reference, result)
+    )
+    print(f"{name:<24}{elapsed:>10.3f}{base_time / elapsed:>10.2f}x{min(quality):>12.2f}{diff:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Speed/quality benchmarks of the inference options")
+    parser.add_argument('--repo', default=None, help="Model repository or folder, default: tiny offline pipeline")
+    parser.add_argument('--cache-dir', default="cache")
+    parser.add_argument('--cpu', action='store_true', help="Do not use CUDA")
+    parser.add_argument('--float32', action='store_true', help="Do not use float16")
+    parser.add_argument('--sizes', default=None, help="Comma separated image sizes, default model's native size")
+    parser.add_argument('--steps', type=int, default=25)
+    parser.add_argument('--seeds', default="0,1", help="Comma separated seeds, every seed is one image")
+    parser.add_argument('--prompt', default="a photo of a cat sitting on a windowsill")
+    parser.add_argument('--repeats', type=int, default=2, help="Timed runs per setting, the best one is reported")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cache_cmd = commands.add_parser('step-cache', help="DeepCache-style reuse of deep UNet features")
+    cache_cmd.add_argument('--intervals', default="2,3,4,5")
+    cache_cmd.add_argument('--depths', default="1")
+
+    merge_cmd = commands.add_parser('token-merge', help="Merging of redundant tokens before self-attention (ToMe)")
+    merge_cmd.add_argument('--ratios', default="0.3,0.5,0.7")
+
+    truncation_cmd = commands.add_parser('guidance-truncation', help="No classifier-free guidance for the last steps")
+    truncation_cmd.add_argument('--fractions', default="0.2,0.4,0.6")
+
+    engine_cmd = commands.add_parser('engine', help="Other inference engines against the diffusers one")
+    engine_cmd.add_argument('--engines', default="onnx")
+    engine_cmd.add_argument('--threads', type=int, default=0, help="CPU threads of the ONNX engine, 0 for all")
+
+    args = parser.parse_args(argv)
+    import engines
+    from diffusershandler import DiffusersHandler
+
+    if args.repo is None:
+        repo = tiny_pipeline(os.path.join(tempfile.gettempdir(), "diffusers_gui_benchmark"))
+        use_float16 = False
+    else:
+        repo = args.repo
+        use_float16 = not args.float32
+    handler = DiffusersHandler(
+        cache_dir=args.cache_dir, use_cuda=not args.cpu, use_float16=use_float16, result_cache_mb=0, auto_batch=False
+    )
+    if args.command == 'step-cache':
+        settings = [
+            (f"interval {interval}, depth {depth}", handler, {'step_cache': interval, 'step_cache_depth': depth})
+            for depth in parse_list(args.depths, int) for interval in parse_list(args.intervals, int)
+        ]
+    elif args.command == 'token-merge':
+        settings = [(f"ratio {ratio}", handler, {'token_merge': ratio}) for ratio in parse_list(args.ratios, float)]
+    elif args.command == 'guidance-truncation':
+        settings = [
+            (f"last {fraction}", handler, {'guidance_truncation': fraction})
+            for fraction in parse_list(args.fractions, float)
+        ]
+    else:
+        settings = []
+        for engine in parse_list(args.engines, str):
+            options = {'threads': args.threads} if engine == "onnx" else {}
+            engine_handler = engines.handler_class(engine)(
+                cache_dir=args.cache_dir, use_cuda=not args.cpu, use_float16=use_float16, result_cache_mb=0,
+                auto_batch=False, **options
+            )
+            engine_handler.load_pipeline(repo, connect=args.repo is not None)
+            settings.append((f"engine {engine}", engine_handler, {}))
+
+    with handler.lock:
+        handler.load_pipeline(repo, connect=args.repo is not None)
+        sizes = parse_list(args.sizes, int) if args.sizes else [handler.curr['model']['default_image_size']]
+        print(f"{repo}, {args.steps} steps, {handler.device}", file=sys.stderr)
+        for size in sizes:
+            common = dict(
+                prompt=args.prompt, num_inference_steps=args.steps, width=size, height=size, block_nsfw=False,
+                seed=parse_list(args.seeds, int)
+            )
+            for warm_handler in [handler] + [item[1] for item in settings if item[1] is not handler]:
+                warm_handler.run(**dict(common, num_inference_steps=2))
+            base_time, reference = timed_run(handler, args.repeats, **common)
+            print(f"{f'{size}x{size}':<24}{'Time, s':>10}{'Speedup':>11}{'PSNR, dB':>12}{'Max diff':>10}")
+            report("baseline", base_time, base_time, reference, reference)
+            for name, setting_handler, options in settings:
+                elapsed, result = timed_run(setting_handler, args.repeats, **common, **options)
+                report(name, elapsed, base_time, reference, result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from typing import Optional
+
+from utils import load_yaml, params_hash
+from filehandlers import read_png_params
+
+
+CATALOG_FILE = "catalog.sqlite"
+PARAMS_EXT = ".prm"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    params_hash TEXT,
+    repo TEXT,
+    variant TEXT,
+    dtype TEXT,
+    prompt TEXT,
+    negative_prompt TEXT,
+    adprompt TEXT,
+    negative_adprompt TEXT,
+    seed INTEGER,
+    width INTEGER,
+    height INTEGER,
+    steps INTEGER,
+    guidance_scale REAL,
+    strength REAL,
+    init_image TEXT,
+    inference_time REAL,
+    created REAL,
+    params TEXT
+);
+CREATE INDEX IF NOT EXISTS images_repo_seed ON images(repo, seed);
+CREATE INDEX IF NOT EXISTS images_seed ON images(seed);
+CREATE INDEX IF NOT EXISTS images_hash ON images(params_hash);
+CREATE INDEX IF NOT EXISTS images_adprompt ON images(adprompt);
+CREATE INDEX IF NOT EXISTS images_negative_adprompt ON images(negative_adprompt);
+CREATE INDEX IF NOT EXISTS images_size ON images(width, height);
+CREATE INDEX IF NOT EXISTS images_created ON images(created);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(
+    prompt, negative_prompt, content='images', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS images_ai AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts(rowid, prompt, negative_prompt)
+    VALUES (new.id, new.prompt, new.negative_prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS images_ad AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts(images_fts, rowid, prompt, negative_prompt)
+    VALUES ('delete', old.id, old.prompt, old.negative_prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS images_au AFTER UPDATE ON images BEGIN
+    INSERT INTO images_fts(images_fts, rowid, prompt, negative_prompt)
+    VALUES ('delete', old.id, old.prompt, old.negative_prompt);
+    INSERT INTO images_fts(rowid, prompt, negative_prompt)
+    VALUES (new.id, new.prompt, new.negative_prompt);
+END;
+"""
+
+COLUMNS = [
+    'path', 'params_hash', 'repo', 'variant', 'dtype', 'prompt', 'negative_prompt', 'adprompt', 'negative_adprompt',
+    'seed', 'width', 'height', 'steps', 'guidance_scale', 'strength', 'init_image', 'inference_time', 'created',
+    'params'
+]
+
+
+def _row(path: str, params: dict, created: float) -> tuple:
+    model = params.get('model') or {}
+    timings = params.get('timings') or {}
+    return (
+        path,
+        params_hash(params),
+        model.get('repo'),
+        model.get('variant'),
+        model.get('dtype'),
+        params.get('prompt'),
+        params.get('negative_prompt'),
+        params.get('adprompt'),
+        params.get('negative_adprompt'),
+        params.get('seed'),
+        params.get('width'),
+        params.get('height'),
+        params.get('num_inference_steps'),
+        params.get('guidance_scale'),
+        params.get('strength'),
+        params.get('init_image'),
+        timings.get('inference'),
+        created,
+        json.dumps(params, ensure_ascii=False, default=str)
+    )
+
+
+class OutputCatalog:
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, CATALOG_FILE), check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def relpath(self, filepath: str) -> str:
+        path = os.path.realpath(filepath)
+        try:
+            rel = os.path.relpath(path, self.root)
+        except ValueError:
+            return path
+        return path if rel.startswith('..') else rel.replace(os.sep, '/')
+
+    def abspath(self, path: str) -> str:
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def add(self, filepath: str, params: dict, created: float = None):
+        if created is None:
+            try:
+                created = os.path.getmtime(filepath)
+            except OSError:
+                created = time.time()
+        self.add_many([(filepath, params, created)])
+
+    def add_many(self, items):
+        rows = [_row(self.relpath(filepath), params, created) for filepath, params, created in items]
+        with self.lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO images({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows
+            )
+
+    def remove(self, filepath: str):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM images WHERE path = ?", (self.relpath(filepath),))
+
+    def search(self, text: str = None, limit: int = 100, offset: int = 0, **filters) -> list[dict]:
+        where, args = [], []
+        for column, value in filters.items():
+            if column not in COLUMNS:
+                raise KeyError(f"Unknown catalog column: {column}")
+            if value is None:
+                continue
+            where.append(f"images.{column} = ?")
+            args.append(value)
+        if text:
+            where.append("images.id IN (SELECT rowid FROM images_fts WHERE images_fts MATCH ?)")
+            args.append(text)
+        query = "SELECT * FROM images"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY created DESC LIMIT ? OFFSET ?"
+        args += [limit, offset]
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [self._result(row) for row in rows]
+
+    def find_same(self, params: dict) -> list[str]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT path FROM images WHERE params_hash = ?", (params_hash(params),)
+            ).fetchall()
+        return [self.abspath(row['path']) for row in rows]
+
+    def duplicates(self) -> list[list[str]]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT params_hash, path FROM images WHERE params_hash IN ("
+                "SELECT params_hash FROM images GROUP BY params_hash HAVING COUNT(*) > 1"
+                ") ORDER BY params_hash, created"
+            ).fetchall()
+        groups = {}
+        for row in rows:
+            groups.setdefault(row['params_hash'], []).append(self.abspath(row['path']))
+        return list(groups.values())
+
+    def import_folder(self, folder: str = None, recursive: bool = True) -> int:
+        folder = folder or self.root
+        items = []
+        count = 0
+        for filepath, params in _scan_params(folder, recursive):
+            items.append((filepath, params, os.path.getmtime(filepath)))
+            if len(items) >= 500:
+                self.add_many(items)
+                count += len(items)
+                items.clear()
+        self.add_many(items)
+        return count + len(items)
+
+    def _result(self, row: sqlite3.Row) -> dict:
+        result = dict(row)
+        result['path'] = self.abspath(result['path'])
+        result['params'] = json.loads(result['params']) if result['params'] else None
+        return result
+
+
+def _scan_params(folder: str, recursive: bool):
+    for entry in os.scandir(folder):
+        if entry.is_dir():
+            if recursive:
+                yield from _scan_params(entry.path, recursive)
+            continue
+        name = entry.name
+        if name.endswith(PARAMS_EXT):
+            image_path = entry.path.removesuffix(PARAMS_EXT)
+            if not os.path.isfile(image_path):
+                continue
+            try:
+                params = load_yaml(entry.path)
+            except Exception:
+                continue
+            if isinstance(params, dict):
+                yield image_path, params
+        elif name.lower().endswith(".png") and not os.path.exists(entry.path + PARAMS_EXT):
+            try:
+                params = read_png_params(entry.path)
+            except Exception:
+                continue
+            if isinstance(params, dict):
+                yield entry.path, params
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def catalog_for(root: str) -> OutputCatalog:
+    root = os.path.realpath(root)
+    with _catalogs_lock:
+        if root not in _catalogs:
+            _catalogs[root] = OutputCatalog(root)
+        return _catalogs[root]
+
+
+def find_catalog(filepath: str) -> Optional[OutputCatalog]:
+    folder = os.path.dirname(os.path.realpath(filepath))
+    while True:
+        if os.path.isfile(os.path.join(folder, CATALOG_FILE)):
+            return catalog_for(folder)
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def catalog_at(filepath: str) -> OutputCatalog:
+    # The nearest catalog above a file is its output root, so subfolders of one root share a single database
+    return find_catalog(filepath) or catalog_for(os.path.dirname(os.path.realpath(filepath)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Catalog of generated images")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_cmd = commands.add_parser('import', help="Import existing .prm files and PNG parameters")
+    import_cmd.add_argument('root', help="Output root folder")
+
+    search_cmd = commands.add_parser('search', help="Search catalog")
+    search_cmd.add_argument('root', help="Output root folder")
+    search_cmd.add_argument('text', nargs='?', default=None, help="Full-text query on prompts")
+    search_cmd.add_argument('--repo')
+    search_cmd.add_argument('--seed', type=int)
+    search_cmd.add_argument('--adprompt')
+    search_cmd.add_argument('--negative-adprompt')
+    search_cmd.add_argument('--width', type=int)
+    search_cmd.add_argument('--height', type=int)
+    search_cmd.add_argument('--steps', type=int)
+    search_cmd.add_argument('--limit', type=int, default=100)
+
+    dupes_cmd = commands.add_parser('duplicates', help="List images generated with identical parameters")
+    dupes_cmd.add_argument('root', help="Output root folder")
+
+    args = parser.parse_args(argv)
+    catalog = catalog_for(args.root)
+    if args.command == 'import':
+        start = time.perf_counter()
+        count = catalog.import_folder()
+        print(f"Imported {count} images in {time.perf_counter() - start:.2f}s")
+    elif args.command == 'search':
+        start = time.perf_counter()
+        rows = catalog.search(
+            args.text, limit=args.limit, repo=args.repo, seed=args.seed,
+            adprompt=args.adprompt, negative_adprompt=args.negative_adprompt,
+            width=args.width, height=args.height, steps=args.steps
+        )
+        elapsed = time.perf_counter() - start
+        for row in rows:
+            print(f"{row['path']}\t{row['repo']}\t{row['seed']}\t{row['prompt']}")
+        print(f"{len(rows)} results in {elapsed * 1000:.1f}ms", file=sys.stderr)
+    elif args.command == 'duplicates':
+        for group in catalog.duplicates():
+            print("\t".join(group))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,13 @@
 import os
+import copy
+import json
+import atexit
+import threading
 from PIL import Image
 
 from typing import Optional
 
-from utils import load_yaml, save_yaml
+from utils import load_yaml, save_yaml, atomic_write
 
 
 def _try_load_image(filename, default_size=None):
@@ -18,26 +22,45 @@ def _try_load_image(filename, default_size=None):
 ICON_PATH = os.path.abspath("Icons")
 CONFIG_FILE = os.path.abspath("config.yml")
 DEFAULT_CONFIG_FILE = os.path.abspath("default.yml")
+HISTORY_FILE = os.path.abspath("history.jsonl")
+JOBS_FILE = os.path.abspath("jobs.sqlite")
+SAVE_DELAY = 2.0           # Seconds to collect changes before writing
+HISTORY_COMPACT_LINES = 1000
 ICON_SIZE = 32
 ADPROMPT_MAXLEN = 2048
 
-PLACEHOLDER_IMAGE = _try_load_image(os.path.join(ICON_PATH, "placeholder.png"), ICON_SIZE)
-ICONS = dict(
-    (name, _try_load_image(os.path.join(ICON_PATH, name+".png"), ICON_SIZE))
-    for name in [
-        "favicon",
-        "folder",
-        "open_file",
-        "plus",
-        "arrow_up",
-        "arrow_down",
-        "arrow_right",
-        "arrow_left",
-        "arrow_trash",
-        'forward',
-        'backward'
-    ]
-)
+ICON_NAMES = [
+    "favicon",
+    "folder",
+    "open_file",
+    "plus",
+    "arrow_up",
+    "arrow_down",
+    "arrow_right",
+    "arrow_left",
+    "arrow_trash",
+    'forward',
+    'backward'
+]
+
+
+class LazyIcons(dict):
+    def __missing__(self, name):
+        if name not in ICON_NAMES:
+            raise KeyError(name)
+        self[name] = _try_load_image(os.path.join(ICON_PATH, name+".png"), ICON_SIZE)
+        return self[name]
+
+
+ICONS = LazyIcons()
+
+
+def __getattr__(name):
+    if name == 'PLACEHOLDER_IMAGE':
+        global PLACEHOLDER_IMAGE
+        PLACEHOLDER_IMAGE = _try_load_image(os.path.join(ICON_PATH, "placeholder.png"), ICON_SIZE)
+        return PLACEHOLDER_IMAGE
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 default_config = dict(
@@ -46,6 +69,18 @@ default_config = dict(
     use_cuda=True,             # 'true' to use GPU if available, default 'true'
     use_float16=True,          # 'true' to use 'float16' for inference, default 'true'
     adprompt_path="adprompt",  # Path to store adPrompts
+    preload_last_repo=False,   # 'true' to load the last used model in background at startup
+    result_cache_mb=1024,      # Size limit of generated images cache in MB, '0' to disable
+    hires_strength=0.55,       # Denoising strength of the second pass of hires generation
+    auto_batch=True,           # 'true' to pick batch sizes from measured memory use
+    step_cache=0,              # Reuse deep UNet features for this many steps (DeepCache), '0' to disable
+    token_merge=0.0,           # Share of self-attention tokens merged at full resolution (ToMe), '0' to disable
+    guidance_truncation=0.0,   # Share of the last steps run without classifier-free guidance, '0' to disable
+    engine="diffusers",        # Inference engine: 'diffusers' (PyTorch), 'onnx' (ONNX Runtime on CPU) or 'fake'
+    onnx_threads=0,            # CPU threads of the ONNX engine, '0' for all available cores
+    fake_engine={},            # Options of the 'fake' engine: step_time, load_time, memory_mb, failure_rate, max_batch
+    residency="resident",      # CPU component memory: 'resident', 'lazy' (release under pressure) or 'minimal'
+    thread_tuning=True,        # 'true' to measure the fastest CPU thread count and allocator once per model
 
     nsfw_image="Icons/nsfw.png",
 
@@ -53,21 +88,172 @@ default_config = dict(
     adprompt_history=[],
     neg_adprompt_history=[],
     init_image_history=[],
+    init_folder_history=[],
+    lora_history=[],
     outdir_history=[],
+    queue_template_history=["ai_painting_????.png"],
     filename_prefix_history=[],
     filename_ext_history=[".png", ".jpg"]
 )
 config: Optional[dict] = default_config.copy()
 
 
+def is_history(key) -> bool:
+    return key.endswith("_history")
+
+
+class ConfigStore:
+    def __init__(self, config_file, history_file, delay=SAVE_DELAY):
+        self.config_file = config_file
+        self.history_file = history_file
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.timer = None
+        self.saved_settings = None
+        self.saved_histories = {}
+        self.history_lines = 0
+
+    def load(self, mapping: dict):
+        try:
+            settings = load_yaml(self.config_file)
+            missing = False
+        except FileNotFoundError:
+            settings = {}
+            missing = True
+        histories = self.load_histories()
+        legacy = {key: value for key, value in settings.items() if is_history(key)}
+        for key, value in legacy.items():
+            histories.setdefault(key, value)
+            del settings[key]
+        mapping.update(settings)
+        mapping.update(histories)
+        with self.lock:
+            self.saved_settings = None if legacy or missing else self.serialize(self.settings(mapping))
+            self.saved_histories = {key: list(value) for key, value in histories.items()}
+            if legacy:
+                self.history_lines = HISTORY_COMPACT_LINES
+
+    def load_histories(self) -> dict:
+        histories = {}
+        lines = 0
+        try:
+            with open(self.history_file, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                        apply_history_record(histories, record)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+                    lines += 1
+        except FileNotFoundError:
+            pass
+        self.history_lines = lines
+        return histories
+
+    @staticmethod
+    def settings(mapping: dict) -> dict:
+        return {key: value for key, value in mapping.items() if not is_history(key)}
+
+    @staticmethod
+    def serialize(settings: dict) -> str:
+        return json.dumps(settings, sort_keys=True, default=str)
+
+    def schedule(self, mapping: dict):
+        # The timer writes a deep copy taken here, on the thread that edits the mapping, never the live config
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.delay, self.timed_write, args=(copy.deepcopy(mapping),))
+            self.timer.daemon = True
+            self.timer.start()
+
+    def timed_write(self, mapping: dict):
+        with self.lock:
+            # A timer replaced by a later edit must not write its older snapshot
+            if threading.current_thread() is not self.timer:
+                return
+            self.timer = None
+            self.write(mapping)
+
+    def flush(self, mapping: dict):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.write(copy.deepcopy(mapping))
+
+    def write(self, mapping: dict):
+        # Histories first: after a legacy migration config.yml no longer holds them, so it is rewritten only once
+        # they are safely in the history file
+        with self.lock:
+            histories = {key: list(value) for key, value in mapping.items() if is_history(key)}
+            if self.history_lines >= HISTORY_COMPACT_LINES:
+                lines = [{'key': key, 'set': value} for key, value in histories.items()]
+                atomic_write(self.history_file, "".join(json.dumps(line) + "\n" for line in lines))
+                self.history_lines = len(lines)
+            else:
+                records = []
+                for key, value in histories.items():
+                    record = history_record(key, self.saved_histories.get(key), value)
+                    if record is not None:
+                        records.append(record)
+                if records:
+                    with open(self.history_file, 'at', encoding='utf-8') as file:
+                        file.write("".join(json.dumps(record) + "\n" for record in records))
+                    self.history_lines += len(records)
+            self.saved_histories = histories
+
+            settings = self.settings(mapping)
+            serialized = self.serialize(settings)
+            if serialized != self.saved_settings:
+                save_yaml(self.config_file, settings)
+                self.saved_settings = serialized
+
+
+def history_record(key, old: Optional[list], new: list) -> Optional[dict]:
+    if old == new:
+        return None
+    if old is not None and new:
+        value = new[0]
+        moved = [value] + [item for item in old if item != value]
+        if moved[:len(new)] == new:
+            record = {'key': key, 'front': value}
+            if len(new) < len(moved):
+                record['limit'] = len(new)
+            return record
+    return {'key': key, 'set': new}
+
+
+def apply_history_record(histories: dict, record: dict):
+    key = record['key']
+    if 'set' in record:
+        histories[key] = list(record['set'])
+        return
+    history = histories.setdefault(key, [])
+    value = record['front']
+    if value in history:
+        history.remove(value)
+    history.insert(0, value)
+    if 'limit' in record:
+        del history[record['limit']:]
+
+
+store = ConfigStore(CONFIG_FILE, HISTORY_FILE)
+
+
 def load():
     global config
-    try:
-        config.update(load_yaml(CONFIG_FILE))
-    except FileNotFoundError:
-        pass
+    store.load(config)
 
 
 def save():
     if config:
-        save_yaml(CONFIG_FILE, config)
+        store.schedule(config)
+
+
+def flush():
+    if config:
+        store.flush(config)
+
+
+atexit.register(flush)
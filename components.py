@@ -0,0 +1,105 @@
+import os
+import json
+import weakref
+import threading
+import torch
+
+from modelcatalog import component_fingerprint
+
+
+NOT_SHARED = {'scheduler'}
+
+
+def module_bytes(module) -> int:
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    # By storage, so released placeholders of lazily loaded components count as nothing
+    storages = {
+        tensor.untyped_storage().data_ptr(): tensor.untyped_storage().nbytes()
+        for tensor in list(module.parameters()) + list(module.buffers()) if not tensor.is_meta
+    }
+    return sum(storages.values())
+
+
+def pipeline_components(path: str) -> list:
+    try:
+        with open(os.path.join(path, "model_index.json"), 'rt') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return []
+    return [
+        name for name, value in index.items()
+        if not name.startswith('_') and isinstance(value, list) and value[0] is not None and name not in NOT_SHARED
+    ]
+
+
+def memory_usage(pipes: list) -> dict:
+    sizes = {}
+    total = 0
+    for pipe in pipes:
+        for module in pipe.components.values():
+            size = module_bytes(module)
+            total += size
+            sizes[id(module)] = size
+    resident = sum(sizes.values())
+    return {'total': total, 'resident': resident, 'shared': total - resident}
+
+
+class ComponentPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def fingerprints(self, path: str, variant: str = None) -> dict:
+        fingerprints = {}
+        for name in pipeline_components(path):
+            folder = os.path.join(path, name)
+            if os.path.isdir(folder):
+                quick = component_fingerprint(folder, variant)
+                if quick is not None:
+                    fingerprints[name] = quick
+        return fingerprints
+
+    def live(self, key: tuple) -> list:
+        with self.lock:
+            entries = [entry for entry in self.entries.get(key, []) if entry['module']() is not None]
+            if entries:
+                self.entries[key] = entries
+            else:
+                self.entries.pop(key, None)
+            return entries
+
+    def full(self, entry: dict):
+        if entry['full'] is None:
+            entry['full'] = component_fingerprint(entry['folder'], entry['variant'], full=True)
+        return entry['full']
+
+    def find(self, path: str, variant: str = None, dtype: str = "auto") -> dict:
+        found = {}
+        for name, quick in self.fingerprints(path, variant).items():
+            folder = os.path.join(path, name)
+            full = None
+            for entry in self.live((quick, dtype)):
+                if entry['folder'] != folder:
+                    full = full or component_fingerprint(folder, variant, full=True)
+                    if full != self.full(entry):
+                        continue
+                module = entry['module']()
+                if module is not None:
+                    found[name] = module
+                    break
+        return found
+
+    def register(self, path: str, variant: str, dtype: str, pipe):
+        for name, quick in self.fingerprints(path, variant).items():
+            module = getattr(pipe, name, None)
+            if module is None or any(entry['module']() is module for entry in self.live((quick, dtype))):
+                continue
+            try:
+                ref = weakref.ref(module)
+            except TypeError:
+                continue
+            with self.lock:
+                self.entries.setdefault((quick, dtype), []).append({
+                    'folder': os.path.join(path, name), 'variant': variant, 'full': None, 'module': ref
+                })
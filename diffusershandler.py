@@ -1,17 +1,43 @@
 import os
+import time
+from contextlib import nullcontext
+from typing import Union
 import torch
 os.putenv('HF_HUB_DISABLE_SYMLINKS_WARNING', 'true')
 from diffusers import AutoPipelineForText2Image, AutoPipelineForImage2Image
+from diffusers.utils import USE_PEFT_BACKEND
 
-from utils import image_fit, repo_key
+from utils import image_fit, repo_key, contact_sheet, file_hash, array_image
 from filehandlers import image_files
+from resultcache import ResultCache
+from modelcatalog import catalog_for
+from downloader import DownloadManager
+from components import ComponentPool, memory_usage
+from lora import LoraCache
+from memory import MemoryMonitor, is_oom, free_memory
+from autobatch import BatchModels, calibrate
+from progress import TimingHistory, RunProgress
+from priority import PriorityLock, Preempted
+from stepcache import FeatureCache
+from tokenmerge import TokenMerge
+from residency import Residency
+import sampling
+import threadtune
+
+
+MEMORY_MODES = ('attention_slicing', 'vae_slicing', 'vae_tiling')
 
 
 class DiffusersHandler:
-    def __init__(self, cache_dir="cache", max_models=1, use_cuda=True, use_float16=True, hf_key=None):
+    def __init__(self, cache_dir="cache", max_models=1, use_cuda=True, use_float16=True, hf_key=None,
+                 result_cache_mb=1024, downloader=None, max_loras=8, auto_batch=True, residency="resident",
+                 thread_tuning=True):
         self.err_info = None
+        self.lock = PriorityLock()
         os.makedirs(cache_dir, exist_ok=True)
         self.cache_dir = cache_dir
+        self.model_catalog = catalog_for(cache_dir)
+        self.downloader = downloader or DownloadManager(cache_dir, token=hf_key)
         self.max_models = max_models
         if use_cuda and torch.cuda.is_available():
             self.device = "cuda"
@@ -31,46 +57,139 @@ class DiffusersHandler:
 
         self.use_float16 = use_float16
         self.hf_key = hf_key
+        self.result_cache = ResultCache(os.path.join(cache_dir, "results"), result_cache_mb << 20) \
+            if result_cache_mb else None
         self.pipelines = {}
+        self.components = ComponentPool()
+        self.loras = LoraCache(max_loras)
+        self.batch_models = BatchModels(cache_dir) if auto_batch else None
+        self.thread_profiles = threadtune.ThreadProfiles(cache_dir) if thread_tuning and self.device == "cpu" else None
+        self.timing_history = TimingHistory(cache_dir)
+        # Memory-mapped weights and released components only pay off where weights live in host memory
+        self.residency = Residency(residency, self.device) if residency != "resident" and self.device == "cpu" \
+            else None
         self.curr = None
         self.rng = torch.Generator(self.device)
 
-    def load_pipeline(self, repo_name: str, connect: bool = True):
+    def load_pipeline(self, repo_name: str, connect: bool = True, progress=None):
         self.err_info = None
         key = repo_key(repo_name)
         if key in self.pipelines:
             self.curr = self.pipelines.pop(key)
             self.pipelines[key] = self.curr
+            self.tune_threads()
             return
 
-        if len(self.pipelines) == self.max_models:
-            del self.pipelines[list(self.pipelines)[0]]
         torch_dtype, variant = (torch.float16, "fp16") if self.use_float16 else ("auto", None)
         token = self.hf_key if connect else None
-        try:
-            txt2img = AutoPipelineForText2Image.from_pretrained(
-                repo_name, cache_dir=self.cache_dir, local_files_only=not connect, token=token,
-                torch_dtype=torch_dtype, variant=variant)
-        except Exception as error:
-            if variant is None:
-                raise error
-            else:
-                variant = None
+        start = time.perf_counter()
+        local_path, local_variant = self.resolve_local(repo_name, variant)
+        if local_path is None and connect and not os.path.isdir(repo_name):
+            try:
+                self.downloader.download(repo_name, variant)
+            except Exception as error:
+                # diffusers fetches the model instead; the reason stays in err_info for the report if that fails too
+                self.err_info = {'download': f"{type(error).__name__}: {error}"}
+                if progress is not None:
+                    progress({
+                        'stage': f"Download failed ({type(error).__name__}), loading through diffusers",
+                        'stage_index': 0, 'stages': 1, 'step': 0, 'steps': 1, 'eta': None
+                    })
+            local_path, local_variant = self.resolve_local(repo_name, variant)
+        shared, mapped = {}, {}
+        if local_path:
+            variant = local_variant
+            shared = self.components.find(local_path, variant, str(torch_dtype))
+            if self.residency is not None:
+                mapped = self.residency.map_components(local_path, variant, torch_dtype, exclude=shared)
+        # Evict after the lookup, so components of the evicted pipeline can still be reused
+        if len(self.pipelines) == self.max_models:
+            evicted = self.pipelines.pop(next(iter(self.pipelines)))
+            if self.residency is not None:
+                self.residency.prompt_cache.forget(evicted['txt2img'])
+        load_key = TimingHistory.load_key(repo_name, str(torch_dtype), local_path is not None)
+        load_start = time.perf_counter()
+        if progress is not None:
+            progress({
+                'stage': "Loading model", 'stage_index': 0, 'stages': 1, 'step': 0, 'steps': 1,
+                'eta': (self.timing_history.get(load_key) or {}).get('load')
+            })
+        if local_path:
             txt2img = AutoPipelineForText2Image.from_pretrained(
-                repo_name, cache_dir=self.cache_dir, local_files_only=not connect, token=token,
-                torch_dtype=torch_dtype)
+                local_path, local_files_only=True, torch_dtype=torch_dtype, variant=variant, **shared, **mapped)
+        else:
+            try:
+                txt2img = AutoPipelineForText2Image.from_pretrained(
+                    repo_name, cache_dir=self.cache_dir, local_files_only=not connect, token=token,
+                    torch_dtype=torch_dtype, variant=variant)
+            except Exception as error:
+                if variant is None:
+                    raise error
+                else:
+                    variant = None
+                txt2img = AutoPipelineForText2Image.from_pretrained(
+                    repo_name, cache_dir=self.cache_dir, local_files_only=not connect, token=token,
+                    torch_dtype=torch_dtype)
+            self.model_catalog.invalidate(repo_name)
+            local_path, _ = self.resolve_local(repo_name, variant)
 
         txt2img.to(self.device)
+        if self.residency is not None:
+            self.residency.attach(txt2img)
+        if local_path:
+            self.components.register(local_path, variant, str(torch_dtype), txt2img)
         default_size = txt2img.unet.config.sample_size * txt2img.vae_scale_factor
 
         model = {
             'repo': repo_name,
             'variant': variant or "default",
             'dtype': str(torch_dtype),
+            'scheduler': txt2img.scheduler.__class__.__name__,
             'default_image_size': default_size
         }
-        self.curr = {'model': model, 'txt2img': txt2img}
+        self.curr = {
+            'model': model, 'txt2img': txt2img, 'load_time': round(time.perf_counter() - start, 3),
+            'shared': sorted(shared)
+        }
         self.pipelines[key] = self.curr
+        self.timing_history.update(load_key, load=time.perf_counter() - load_start)
+        self.timing_history.save()
+        self.tune_threads(progress)
+
+    def tune_threads(self, progress=None):
+        # CPU threads and allocator of the fastest profile, measured once per host and model
+        if self.thread_profiles is None:
+            return
+        key = threadtune.ThreadProfiles.key(self.curr['model'])
+        profile = self.thread_profiles.get(key)
+        if profile is None:
+            if progress is not None:
+                progress({
+                    'stage': "Tuning CPU threads", 'stage_index': 0, 'stages': 1, 'step': 0, 'steps': 1, 'eta': None
+                })
+            size = max(self.curr['model']['default_image_size'] // 128 * 64, 64)
+            threads = torch.get_num_threads()
+            try:
+                profile = threadtune.calibrate(self.curr['txt2img'], self.device, size)
+            except Exception as error:
+                profile = threadtune.default_profile(threads, error)
+                free_memory(self.device)
+            self.thread_profiles.put(key, profile)
+        threadtune.apply(profile)
+        self.device_opts = dict(
+            self.device_opts, threads=profile['threads'], interop_threads=profile['interop_threads'],
+            allocator=profile['allocator']
+        )
+
+    def memory_usage(self) -> dict:
+        return memory_usage([pipeline['txt2img'] for pipeline in self.pipelines.values()])
+
+    def resolve_local(self, repo_name: str, variant: str = None):
+        for local_variant in ([variant, None] if variant else [None]):
+            local_path = self.model_catalog.resolve(repo_name, local_variant)
+            if local_path:
+                return local_path, local_variant
+        return None, None
 
     def disable_nsfw_check(self):
         self.err_info = None
@@ -91,11 +210,136 @@ class DiffusersHandler:
             if 'img2img' in self.curr:
                 self.curr['img2img'].safety_checker = self.curr['safety_checker']
 
+    def set_loras(self, loras: list = None, fuse: bool = False) -> list:
+        pipe = self.curr['txt2img']
+        entries, names = [], set()
+        for filename, weight in loras or []:
+            entry = self.loras.get(filename)
+            if entry['name'] not in names:
+                names.add(entry['name'])
+                entries.append((entry, float(weight)))
+        wanted = [(entry['name'], weight) for entry, weight in entries]
+
+        # Fused weights live in modules that may be shared with other pipelines
+        for pipeline in self.pipelines.values():
+            if pipeline.get('fused') and (pipeline is not self.curr or not fuse or pipeline['fused'] != wanted):
+                pipeline['txt2img'].unfuse_lora()
+                pipeline['fused'] = None
+
+        # Adapters are read from the components: pipeline adapter methods require the PEFT backend even when unused
+        loaded = set(
+            name for module in pipe.components.values() for name in (getattr(module, 'peft_config', None) or {})
+        )
+        if not wanted:
+            if loaded:
+                pipe.disable_lora()
+            return []
+        if not USE_PEFT_BACKEND:
+            raise ValueError("LoRA adapters require the 'peft' package")
+        if self.residency is not None:
+            self.residency.pin(getattr(pipe, 'text_encoder', None))
+            self.residency.pin(getattr(pipe, 'text_encoder_2', None))
+        for entry, _ in entries:
+            if entry['name'] not in loaded:
+                pipe.load_lora_weights(dict(entry['state_dict']), adapter_name=entry['name'])
+                loaded.add(entry['name'])
+        stale = loaded - names
+        if len(loaded) > self.loras.max_entries and stale:
+            pipe.delete_adapters(list(stale))
+
+        if not self.curr.get('fused'):
+            pipe.enable_lora()
+            pipe.set_adapters([name for name, _ in wanted], [weight for _, weight in wanted])
+            if fuse:
+                pipe.fuse_lora(adapter_names=[name for name, _ in wanted])
+                self.curr['fused'] = wanted
+        return [
+            {'file': os.path.basename(entry['file']), 'hash': entry['hash'], 'weight': weight}
+            for entry, weight in entries
+        ]
+
+    def img2img(self):
+        if 'img2img' not in self.curr:
+            self.curr['img2img'] = AutoPipelineForImage2Image.from_pipe(self.curr['txt2img'])
+            if self.residency is not None:
+                self.residency.attach(self.curr['img2img'])
+        return self.curr['img2img']
+
+    def hires_base_size(self, width: int, height: int) -> tuple:
+        default_size = self.curr['model']['default_image_size']
+        if width * height <= default_size * default_size:
+            return width, height
+        scale = default_size / (width * height) ** 0.5
+        return max(round(width * scale / 32) * 32, 32), max(round(height * scale / 32) * 32, 32)
+
+    def enable_memory_mode(self, mode: str):
+        pipe = self.curr['txt2img']
+        if mode == 'attention_slicing':
+            pipe.enable_attention_slicing()
+        elif mode == 'vae_slicing':
+            pipe.vae.enable_slicing()
+        elif mode == 'vae_tiling':
+            pipe.vae.enable_tiling()
+        self.curr.setdefault('memory_mode', []).append(mode)
+
+    def auto_batch(self, width: int, height: int):
+        if self.batch_models is None:
+            return None
+        key = BatchModels.key(self.curr['model'], self.device_opts, width, height, self.curr.get('memory_mode', []))
+        if self.batch_models.get(key) is None:
+            self.batch_models.put(key, calibrate(self.curr['txt2img'], width, height, self.device))
+        return self.batch_models.batch_size(key, self.device)
+
+    def generate_with_recovery(self, generate, number: int, seed: int = None, params: dict = None,
+                               limit: int = None) -> tuple:
+        # On out of memory: free caches and retry, then switch on cheaper modes one by one, then split the batch
+        batch, retried, oom = min(number, limit or number, self.curr.get('max_batch') or number), False, False
+        while True:
+            if seed is not None:
+                self.rng.manual_seed(seed)
+            failure = None
+            try:
+                images, flags = [], []
+                for offset in range(0, number, batch):
+                    chunk_images, chunk_flags = generate(offset, min(batch, number - offset))
+                    images += chunk_images
+                    flags += chunk_flags
+                break
+            except Exception as error:
+                if not is_oom(error):
+                    raise
+                failure = error.with_traceback(None)
+            # Outside of except block, so the traceback no longer holds tensors
+            images = flags = None
+            free_memory(self.device)
+            modes = self.curr.get('memory_mode', [])
+            if not retried:
+                retried = True
+            elif len(modes) < len(MEMORY_MODES):
+                self.enable_memory_mode(MEMORY_MODES[len(modes)])
+            elif batch > 1:
+                batch = (batch + 1) // 2
+                self.curr['max_batch'] = batch
+                oom = True
+            else:
+                raise failure
+
+        if params is not None:
+            memory_mode = list(self.curr.get('memory_mode', [])) + ([f"batch={batch}"] if oom and batch < number else [])
+            if memory_mode:
+                params['memory_mode'] = memory_mode
+            params.setdefault('timings', {})['batch_size'] = batch
+        return images, flags
+
     def run(self,
             prompt: str, negative_prompt: str = "", guidance_scale: float = 7.5,
             image_file: str = None, strength: float = 0.8, width: int = None, height: int = None,
-            num_inference_steps: int = 50, number: int = 1, seed: int = None,
-            block_nsfw: bool = True) -> list[tuple]:
+            num_inference_steps: int = 50, number: int = 1, seed: Union[int, list] = None,
+            block_nsfw: bool = True, loras: list = None, fuse_loras: bool = False,
+            hires: bool = False, hires_strength: float = 0.55, hires_steps: int = None,
+            step_cache: int = 0, step_cache_depth: int = 1, token_merge: float = 0.0,
+            guidance_truncation: float = 0.0,
+            progress=None, checkpoint: dict = None, should_yield=None) -> list[tuple]:
         self.err_info = None
         if self.curr is None:
             raise AssertionError("Model not loaded")
@@ -110,6 +354,10 @@ class DiffusersHandler:
             'image_index': 0
         }
 
+        seeds = list(seed) if isinstance(seed, (list, tuple)) else None
+        if seeds:
+            number = params['num_images_per_prompt'] = len(seeds)
+        start = time.perf_counter() - (checkpoint or {}).get('elapsed', 0)
         try:
             width = width or self.curr['model']['default_image_size']
             height = height or self.curr['model']['default_image_size']
@@ -117,53 +365,443 @@ class DiffusersHandler:
             height = max(round(height / 32) * 32, 32)
 
             if seed is not None:
-                self.rng.manual_seed(seed)
                 params['seed'] = seed
-
-            if block_nsfw:
-                self.enable_nsfw_check()
-            else:
-                self.disable_nsfw_check()
-            if not image_file:
-                params['width'], params['height'] = width, height
-                result = self.curr['txt2img'](
-                    prompt=prompt, negative_prompt=negative_prompt, guidance_scale=guidance_scale,
-                    width=width, height=height,
-                    num_images_per_prompt=number,
-                    num_inference_steps=num_inference_steps, generator=self.rng,
-                    return_dict=True)
-            else:
+            active_loras = self.set_loras(loras, fuse_loras)
+            if active_loras:
+                params['loras'] = active_loras
+            if image_file:
                 init_image = image_files.load(image_file)
                 init_image = image_fit(init_image, width, height, 32).convert('RGB')
                 params['init_image'] = image_file
                 params['strength'] = strength
                 params['width'], params['height'] = init_image.size
+            else:
+                params['width'], params['height'] = width, height
+                base_width, base_height = self.hires_base_size(width, height) if hires else (width, height)
+                if (base_width, base_height) != (width, height):
+                    params['hires'] = {
+                        'base_width': base_width,
+                        'base_height': base_height,
+                        'upscale': "bilinear",
+                        'strength': hires_strength,
+                        'num_inference_steps': hires_steps or num_inference_steps
+                    }
+
+            feature_cache = FeatureCache(self.curr['txt2img'].unet, step_cache, step_cache_depth) \
+                if step_cache and step_cache > 1 else None
+            if feature_cache is not None:
+                params['step_cache'] = feature_cache.policy()
+            merger = TokenMerge(self.curr['txt2img'].unet, token_merge) if token_merge and token_merge > 0 else None
+            if merger is not None:
+                params['token_merge'] = merger.policy()
+            # Guidance <= 1 already skips the unconditional branch, truncation also drops it for the last steps
+            truncation = min(max(guidance_truncation, 0.0), 1.0) \
+                if guidance_truncation and guidance_scale > 1 else None
+            if truncation is not None:
+                params['guidance_truncation'] = truncation
+
+            cache_key = None
+            if seed is not None and self.result_cache is not None:
+                cache_key = ResultCache.key(dict(
+                    params, block_nsfw=bool(block_nsfw),
+                    init_image_hash=file_hash(image_file) if image_file else None
+                ))
+                cached = self.result_cache.get(cache_key)
+                if cached is not None:
+                    for _, image_params in cached:
+                        image_params.setdefault('timings', {})['cache_hit'] = True
+                    return cached
+
+            if block_nsfw:
+                self.enable_nsfw_check()
+            else:
+                self.disable_nsfw_check()
+
+            # Runs with a seed list can be paused between batch chunks and hires between its two passes; plain
+            # txt2img also between steps. They are resumed from the checkpoint
+            pausable = should_yield is not None and checkpoint is not None and bool(seeds)
+            resumable = pausable and not image_file and 'hires' not in params
+            stage_timings = {}
+            # Chunks finished by this call; a resumed run does not give way again before it has made progress
+            finished = []
+
+            def generate(offset, count):
+                if merger is not None:
+                    merger.install()
+                chunk_key, state, base = (offset, count), None, None
+                if pausable:
+                    if chunk_key in checkpoint.setdefault('chunks', {}):
+                        return checkpoint['chunks'][chunk_key]
+                    if finished and should_yield():
+                        raise Preempted(f"Preempted before image {offset + 1}")
+                    base = checkpoint.get('hires', {}).pop(chunk_key, None)
+                if resumable:
+                    state = checkpoint.pop('state', None)
+                    if state is not None and state['chunk'] != chunk_key:
+                        state = None
+                model = self.curr['model']
+                # A list of seeds gives every image its own generator, the same as a single run with that seed
+                generator = [torch.Generator(self.device).manual_seed(value) for value in seeds[offset:offset + count]] \
+                    if seeds else self.rng
+                if 'hires' in params:
+                    hires = params['hires']
+                    stages = [
+                        ("Generating", TimingHistory.key(
+                            model, hires['base_width'], hires['base_height'], count, "latent"
+                        ), num_inference_steps),
+                        ("Hires pass", TimingHistory.key(model, width, height, count, "img2img"),
+                         int(hires['num_inference_steps'] * hires['strength']))
+                    ]
+                elif not image_file:
+                    stages = [("Generating", TimingHistory.key(model, width, height, count), num_inference_steps)]
+                else:
+                    stages = [("Generating", TimingHistory.key(model, width, height, count, "img2img"),
+                               int(num_inference_steps * strength))]
+                tags = [speedup.tag() for speedup in (feature_cache, merger) if speedup is not None]
+                if guidance_scale <= 1:
+                    tags.append("nocfg")
+                elif truncation is not None:
+                    tags.append(f"cfg{truncation}")
+                if tags:
+                    # Cached, merged and unguided steps are faster, so they are timed apart
+                    stages = [(name, "|".join([key] + tags), steps) for name, key, steps in stages]
+                run_progress = RunProgress(self.timing_history, stages, progress)
+
+                def step_end(pipe) -> dict:
+                    if truncation is None:
+                        return {'callback_on_step_end': run_progress.step_callback()}
+                    return {
+                        'callback_on_step_end': sampling.truncate_guidance(truncation, run_progress.step_callback()),
+                        'callback_on_step_end_tensor_inputs': sampling.callback_inputs(pipe)
+                    }
 
-                if 'img2img' not in self.curr:
-                    self.curr['img2img'] = AutoPipelineForImage2Image.from_pipe(self.curr['txt2img'])
-                result = self.curr['img2img'](
-                    prompt=prompt, negative_prompt=negative_prompt, guidance_scale=guidance_scale,
-                    image=init_image, strength=strength,
-                    num_images_per_prompt=number,
-                    num_inference_steps=num_inference_steps, generator=self.rng,
-                    return_dict=True)
+                expected = run_progress.expected()
+                if offset == 0 or expected is None or stage_timings.get('expected') is None:
+                    stage_timings['expected'] = expected if offset == 0 else None
+                else:
+                    stage_timings['expected'] = round(stage_timings['expected'] + expected, 3)
+
+                run_progress.start(done=num_inference_steps if base else state['step'] if state else 0)
+                if resumable:
+                    pipe = self.curr['txt2img']
+                    embeds = sampling.encode(pipe, prompt, negative_prompt, self.device, guidance_scale > 1)
+                    dtype = embeds['cond'].dtype
+                    generators = sampling.make_generators(seeds[offset:offset + count], self.device)
+                    if state is not None:
+                        scheduler, latents = state['scheduler'], state['latents'].to(self.device)
+                        for generator, generator_state in zip(generators, state['generators']):
+                            generator.set_state(generator_state)
+                        if feature_cache is not None and state.get('features'):
+                            feature_cache.load_state(state['features'], self.device)
+                    else:
+                        scheduler = sampling.make_scheduler(pipe, num_inference_steps, self.device)
+                        latents = sampling.initial_latents(
+                            pipe, None, width, height, self.device, dtype, generators
+                        ) * scheduler.init_noise_sigma
+
+                    def on_step(i, t, step_latents):
+                        run_progress.on_step(i)
+                        if i + 1 < len(scheduler.timesteps) and should_yield():
+                            checkpoint['state'] = {
+                                'chunk': chunk_key, 'step': i + 1, 'latents': step_latents.cpu(), 'scheduler': scheduler,
+                                'generators': [generator.get_state() for generator in generators],
+                                'features': feature_cache.state() if feature_cache is not None else None
+                            }
+                            raise Preempted(f"Preempted at step {i + 1}")
+
+                    latents = sampling.denoise(
+                        pipe, latents, embeds, scheduler, guidance_scale, width, height,
+                        start=state['step'] if state else 0, callback=on_step, generator=generators,
+                        guidance_end=sampling.guidance_steps(len(scheduler.timesteps), truncation)
+                        if truncation is not None else None
+                    )
+                    images, flags = sampling.to_pil(pipe, sampling.decode(pipe, latents), self.device, dtype, block_nsfw)
+                    run_progress.end()
+                    checkpoint['chunks'][chunk_key] = (images, flags)
+                    finished.append(chunk_key)
+                    return images, flags
+                if 'hires' in params:
+                    stage_start = time.perf_counter()
+                    if base is not None:
+                        latents = base['latents'].to(self.device)
+                        for chunk_generator, generator_state in zip(generator, base['generators']):
+                            chunk_generator.set_state(generator_state)
+                    else:
+                        latents = self.curr['txt2img'](
+                            prompt=prompt, negative_prompt=negative_prompt, guidance_scale=guidance_scale,
+                            width=hires['base_width'], height=hires['base_height'],
+                            num_images_per_prompt=count,
+                            num_inference_steps=num_inference_steps, generator=generator,
+                            **step_end(self.curr['txt2img']),
+                            output_type="latent", return_dict=True).images
+                    run_progress.end()
+                    stage_time = time.perf_counter() - stage_start
+                    if pausable and base is None and should_yield():
+                        # The base latents and generator states are all the refine pass needs
+                        checkpoint.setdefault('hires', {})[chunk_key] = {
+                            'latents': latents.cpu(), 'generators': [item.get_state() for item in generator]
+                        }
+                        raise Preempted("Preempted after the hires base pass")
+                    # Upscaled latents go to img2img as is, without VAE decode/encode round trip
+                    scale_factor = self.curr['txt2img'].vae_scale_factor
+                    latents = torch.nn.functional.interpolate(
+                        latents, size=(height // scale_factor, width // scale_factor), mode=hires['upscale']
+                    )
+                    run_progress.start()
+                    pipe = self.img2img()
+                    latents = pipe(
+                        prompt=prompt, negative_prompt=negative_prompt, guidance_scale=guidance_scale,
+                        image=latents, strength=hires['strength'],
+                        num_images_per_prompt=count,
+                        num_inference_steps=hires['num_inference_steps'], generator=generator,
+                        **step_end(pipe),
+                        output_type="latent", return_dict=True).images
+                elif not image_file:
+                    pipe = self.curr['txt2img']
+                    latents = pipe(
+                        prompt=prompt, negative_prompt=negative_prompt, guidance_scale=guidance_scale,
+                        width=width, height=height,
+                        num_images_per_prompt=count,
+                        num_inference_steps=num_inference_steps, generator=generator,
+                        **step_end(pipe),
+                        output_type="latent", return_dict=True).images
+                else:
+                    pipe = self.img2img()
+                    latents = pipe(
+                        prompt=prompt, negative_prompt=negative_prompt, guidance_scale=guidance_scale,
+                        image=init_image, strength=strength,
+                        num_images_per_prompt=count,
+                        num_inference_steps=num_inference_steps, generator=generator,
+                        **step_end(pipe),
+                        output_type="latent", return_dict=True).images
+                # Decoded here rather than by the pipeline, which would build PIL images through float NumPy arrays
+                images, flags = sampling.to_pil(
+                    pipe, sampling.decode(pipe, latents), self.device, pipe.unet.dtype, block_nsfw
+                )
+                if 'hires' in params:
+                    stage_timings['base'] = round(stage_timings.get('base', 0) + stage_time, 3)
+                    stage_timings['hires'] = round(
+                        stage_timings.get('hires', 0) + time.perf_counter() - stage_start - stage_time, 3
+                    )
+                run_progress.end()
+                if pausable:
+                    checkpoint['chunks'][chunk_key] = (images, flags)
+                    finished.append(chunk_key)
+                return images, flags
+
+            limit = self.auto_batch(width, height) if number > 1 else None
+            if checkpoint is not None:
+                # Keep the chunking of the first attempt, so finished chunks and the saved state still fit
+                limit = checkpoint.setdefault('limit', limit)
+            with MemoryMonitor(self.device) as monitor, feature_cache or nullcontext(), merger or nullcontext():
+                images, flags = self.generate_with_recovery(
+                    generate, number, None if seeds else seed, params, limit=limit
+                )
+        except Preempted:
+            checkpoint['elapsed'] = time.perf_counter() - start
+            checkpoint['preempted'] = checkpoint.get('preempted', 0) + 1
+            raise
         except Exception as error:
             self.err_info = params
             raise error
+        self.timing_history.save()
+        if stage_timings.get('expected') is None:
+            stage_timings.pop('expected', None)
+        params['timings'] = {
+            'inference': round(time.perf_counter() - start, 3), **stage_timings, **monitor.report(),
+            **params.get('timings', {})
+        }
+        if checkpoint and checkpoint.get('preempted'):
+            params['timings']['preempted'] = checkpoint['preempted']
 
         output = []
-        try:
-            flags = result.nsfw_content_detected
-            if flags is None:
-                raise AttributeError()
-        except AttributeError:
-            flags = [False] * len(result.images)
-
-        for image, nsfw in zip(result.images, flags):
+        for index, (image, nsfw) in enumerate(zip(images, flags)):
+            if seeds:
+                params.update(seed=seeds[index], num_images_per_prompt=1, image_index=0)
             if not nsfw:
                 output.append((image, params.copy()))
             else:
                 output.append((None, params.copy()))
             params['image_index'] += 1
 
+        if cache_key is not None:
+            self.result_cache.put(cache_key, output)
         return output
+
+    def run_images(self,
+                   images: list, names: list, seeds: list,
+                   prompt: str, negative_prompt: str = "", guidance_scale: float = 7.5, strength: float = 0.8,
+                   num_inference_steps: int = 50, block_nsfw: bool = True, loras: list = None,
+                   fuse_loras: bool = False, progress=None) -> list[tuple]:
+        # img2img of fitted init images of one size, one seed each: VAE encode, denoise and decode run batched
+        self.err_info = None
+        if self.curr is None:
+            raise AssertionError("Model not loaded")
+        width, height = images[0].size
+        params = {
+            'model': self.curr['model'],
+            'device': self.device_opts,
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'guidance_scale': guidance_scale,
+            'num_inference_steps': num_inference_steps,
+            'num_images_per_prompt': 1,
+            'image_index': 0,
+            'strength': strength,
+            'width': width,
+            'height': height
+        }
+
+        start = time.perf_counter()
+        try:
+            active_loras = self.set_loras(loras, fuse_loras)
+            if active_loras:
+                params['loras'] = active_loras
+            if block_nsfw:
+                self.enable_nsfw_check()
+            else:
+                self.disable_nsfw_check()
+            pipe = self.img2img()
+
+            def generate(offset, count):
+                run_progress = RunProgress(self.timing_history, [(
+                    "Generating", TimingHistory.key(self.curr['model'], width, height, count, "img2img"),
+                    int(num_inference_steps * strength)
+                )], progress)
+                run_progress.start()
+                # Prompts are repeated, so every init image gets its own batch element
+                latents = pipe(
+                    prompt=[prompt] * count, negative_prompt=[negative_prompt] * count, guidance_scale=guidance_scale,
+                    image=images[offset:offset + count], strength=strength,
+                    num_inference_steps=num_inference_steps,
+                    generator=sampling.make_generators(seeds[offset:offset + count], self.device),
+                    callback_on_step_end=run_progress.step_callback(),
+                    output_type="latent", return_dict=True).images
+                result = sampling.to_pil(pipe, sampling.decode(pipe, latents), self.device, pipe.unet.dtype, block_nsfw)
+                run_progress.end()
+                return result
+
+            with MemoryMonitor(self.device) as monitor:
+                output_images, flags = self.generate_with_recovery(generate, len(images), params=params)
+        except Exception as error:
+            self.err_info = params
+            raise error
+        self.timing_history.save()
+        params['timings'] = {
+            'inference': round(time.perf_counter() - start, 3), **monitor.report(), **params.get('timings', {})
+        }
+        return [
+            (None if nsfw else image, dict(params, init_image=name, seed=seed))
+            for name, seed, image, nsfw in zip(names, seeds, output_images, flags)
+        ]
+
+    def sweep(self,
+              prompt: str, negative_prompt: str = "", guidance_scales: list = (7.5,), steps: list = (50,),
+              seeds: list = (0,), width: int = None, height: int = None, block_nsfw: bool = True,
+              max_batch: int = None, loras: list = None, fuse_loras: bool = False, progress=None) -> tuple:
+        self.err_info = None
+        if self.curr is None:
+            raise AssertionError("Model not loaded")
+        pipe = self.curr['txt2img']
+        guidance_scales, steps, seeds = list(guidance_scales), list(steps), list(seeds)
+        sweep = {'guidance_scales': guidance_scales, 'steps': steps, 'seeds': seeds}
+        params = {
+            'model': self.curr['model'],
+            'device': self.device_opts,
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'sweep': sweep
+        }
+
+        start = time.perf_counter()
+        try:
+            width = width or self.curr['model']['default_image_size']
+            height = height or self.curr['model']['default_image_size']
+            width = max(round(width / 32) * 32, 32)
+            height = max(round(height / 32) * 32, 32)
+            params['width'], params['height'] = width, height
+            active_loras = self.set_loras(loras, fuse_loras)
+            if active_loras:
+                params['loras'] = active_loras
+
+            if block_nsfw:
+                self.enable_nsfw_check()
+            else:
+                self.disable_nsfw_check()
+
+            if max_batch is None:
+                max_batch = self.auto_batch(width, height) or 8
+            monitor = MemoryMonitor(self.device)
+            embeds = sampling.encode(pipe, prompt, negative_prompt, self.device)
+            dtype = embeds['cond'].dtype
+            output = [None] * (len(steps) * len(guidance_scales) * len(seeds))
+            tiles = [None] * len(output)
+            jobs = [
+                (index, num_steps, guidance, seed)
+                for index, (num_steps, guidance, seed) in enumerate(
+                    (num_steps, guidance, seed) for num_steps in steps for guidance in guidance_scales for seed in seeds
+                )
+            ]
+            plan = []
+            for num_steps in steps:
+                # Elements with guidance <= 1 need no unconditional pass, so they are batched apart
+                groups = [
+                    [job for job in jobs if job[1] == num_steps and job[2] <= 1],
+                    [job for job in jobs if job[1] == num_steps and job[2] > 1]
+                ]
+                plan += [
+                    (num_steps, group[i:i + max_batch]) for group in groups for i in range(0, len(group), max_batch)
+                ]
+            run_progress = RunProgress(self.timing_history, [
+                (f"Sweep {number + 1}/{len(plan)}",
+                 TimingHistory.key(self.curr['model'], width, height, len(chunk), "sweep"), num_steps)
+                for number, (num_steps, chunk) in enumerate(plan)
+            ], progress)
+            expected = run_progress.expected()
+            if expected is not None:
+                params.setdefault('timings', {})['expected'] = expected
+            for num_steps, chunk in plan:
+                def generate(offset, count):
+                    part = chunk[offset:offset + count]
+                    scheduler = sampling.make_scheduler(pipe, num_steps, self.device)
+                    latents = sampling.initial_latents(
+                        pipe, [job[3] for job in part], width, height, self.device, dtype
+                    ) * scheduler.init_noise_sigma
+                    latents = sampling.denoise(
+                        pipe, latents, embeds, scheduler, [job[2] for job in part], width, height,
+                        callback=lambda i, t, latents: run_progress.on_step(i)
+                    )
+                    batch, flags = sampling.to_uint8(pipe, sampling.decode(pipe, latents), self.device, dtype, block_nsfw)
+                    return list(batch), flags
+
+                run_progress.start()
+                with monitor:
+                    images, flags = self.generate_with_recovery(generate, len(chunk), params=params)
+                run_progress.end()
+                for (index, _, guidance, seed), image, nsfw in zip(chunk, images, flags):
+                    image_params = params.copy()
+                    image_params.update({
+                        'guidance_scale': guidance,
+                        'num_inference_steps': num_steps,
+                        'num_images_per_prompt': 1,
+                        'image_index': index,
+                        'seed': seed
+                    })
+                    tiles[index] = None if nsfw else image
+                    output[index] = (None if nsfw else array_image(image), image_params)
+        except Exception as error:
+            self.err_info = params
+            raise error
+        self.timing_history.save()
+        params['timings'] = {
+            'inference': round(time.perf_counter() - start, 3), **monitor.report(), **params.get('timings', {})
+        }
+        for _, image_params in output:
+            image_params['timings'] = params['timings']
+
+        sheet = contact_sheet(
+            tiles, rows=len(steps) * len(guidance_scales), cols=len(seeds),
+            row_labels=[f"steps {num_steps}, guidance {guidance}" for num_steps in steps for guidance in guidance_scales],
+            col_labels=[f"seed {seed}" for seed in seeds]
+        ) if any(tile is not None for tile in tiles) else None
+        return (sheet, params), output
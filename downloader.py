@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from modelcatalog import repo_folder, weight_variant, DEFAULT_VARIANT, catalog_for
+
+
+DEFAULT_ENDPOINT = os.environ.get('HF_ENDPOINT', "https://huggingface.co")
+CHUNK_SIZE = 1 << 20
+RANGE_SIZE = 64 << 20
+# Configuration, tokenizer and scheduler files of a component; weights of other frameworks (.msgpack, .onnx, .h5,
+# .ckpt) and anything else in the repository are not downloaded
+CONFIG_EXTS = ('.json', '.txt', '.model')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def git_blob_sha1(filename: str) -> str:
+    digest = hashlib.sha1(f"blob {os.path.getsize(filename)}\0".encode())
+    with open(filename, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sha256(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def select_files(tree: dict, model_index: dict, variant: str = None) -> list:
+    variant = variant or DEFAULT_VARIANT
+    components = [
+        name for name, value in model_index.items()
+        if not name.startswith('_') and isinstance(value, list) and value[0] is not None
+    ]
+    selected = ["model_index.json"]
+    for name in components:
+        safetensors, other = {}, {}
+        for path in tree:
+            if not path.startswith(name + "/") or path.count('/') != 1:
+                continue
+            file_variant = weight_variant(path)
+            if file_variant is not None:
+                (safetensors if ".safetensors" in path else other).setdefault(file_variant, []).append(path)
+            elif path.endswith(CONFIG_EXTS):
+                selected.append(path)
+        # One weight format per component: safetensors if there are any, .bin otherwise
+        weights = safetensors or other
+        selected += weights.get(variant) or weights.get(DEFAULT_VARIANT) or []
+    return [path for path in selected if path in tree]
+
+
+class Progress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.files = 0
+        self.files_done = 0
+        self.status = "Waiting"
+
+    def add(self, size):
+        with self.lock:
+            self.done += size
+
+    def fraction(self) -> float:
+        return self.done / self.total if self.total else 0.0
+
+    def __str__(self):
+        return (f"{self.status}: {self.fraction() * 100:.0f}% "
+                f"({self.done / (1 << 30):.2f}/{self.total / (1 << 30):.2f} GB, {self.files_done}/{self.files} files)")
+
+
+class DownloadManager:
+    def __init__(self, cache_dir: str, endpoint: str = None, token: str = None, workers: int = 8,
+                 range_size: int = RANGE_SIZE, timeout: float = 60):
+        self.cache_dir = cache_dir
+        self.endpoint = (endpoint or DEFAULT_ENDPOINT).rstrip('/')
+        self.token = token
+        self.range_size = range_size
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self.progress = {}
+        self.queue_lock = threading.Lock()
+        self.prefetch_thread = None
+        self.prefetch_queue = []
+
+    def request(self, url: str, headers: dict = None):
+        headers = dict(headers or {})
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+
+    def file_url(self, repo_name: str, revision: str, path: str) -> str:
+        return f"{self.endpoint}/{repo_name}/resolve/{urllib.parse.quote(revision, safe='')}/{path}"
+
+    def list_tree(self, repo_name: str, revision: str) -> dict:
+        url = f"{self.endpoint}/api/models/{repo_name}/tree/{urllib.parse.quote(revision, safe='')}?recursive=true"
+        tree = {}
+        while url:
+            with self.request(url) as response:
+                entries = json.load(response)
+                link = response.headers.get('Link') or ""
+            for entry in entries:
+                if entry.get('type', 'file') != 'file':
+                    continue
+                lfs = entry.get('lfs') or {}
+                tree[entry['path']] = {
+                    'size': lfs.get('size', entry.get('size')),
+                    'sha256': lfs.get('oid') or lfs.get('sha256'),
+                    'oid': entry.get('oid')
+                }
+            url = None
+            for part in link.split(','):
+                if 'rel="next"' in part:
+                    url = part[part.find('<') + 1:part.find('>')]
+        return tree
+
+    def download(self, repo_name: str, variant: str = None, revision: str = "main", progress: Progress = None):
+        progress = progress or self.progress.setdefault(repo_name, Progress())
+        progress.status = "Listing files"
+        tree = self.list_tree(repo_name, revision)
+        if "model_index.json" not in tree:
+            raise DownloadError(f"{repo_name} has no model_index.json")
+        with self.request(self.file_url(repo_name, revision, "model_index.json"), {'Range': "bytes=0-"}) as response:
+            model_index = json.loads(response.read())
+            commit = response.headers.get('X-Repo-Commit') or revision
+            ranges_supported = response.status == 206
+
+        files = select_files(tree, model_index, variant)
+        folder = os.path.join(self.cache_dir, repo_folder(repo_name))
+        snapshot = os.path.join(folder, "snapshots", commit)
+        os.makedirs(os.path.join(folder, "blobs"), exist_ok=True)
+        progress.total = sum(tree[path]['size'] or 0 for path in files)
+        progress.files = len(files)
+        progress.done = progress.files_done = 0
+        progress.status = f"Downloading {repo_name}"
+
+        tasks = {}
+        for path in files:
+            info = tree[path]
+            blob = os.path.join(folder, "blobs", blob_name(info, commit, path))
+            if os.path.isfile(blob):
+                progress.add(os.path.getsize(blob))
+                continue
+            url = self.file_url(repo_name, commit, path)
+            ranges = self.split(info['size'], ranges_supported)
+            parts = [blob + ".incomplete"] if len(ranges) == 1 else \
+                [f"{blob}.incomplete.{index}" for index in range(len(ranges))]
+            futures = [
+                self.pool.submit(self.fetch_range, url, part, start, end, ranges_supported, progress)
+                for part, (start, end) in zip(parts, ranges)
+            ]
+            tasks[path] = (blob, parts, futures)
+
+        errors = []
+        for path in files:
+            info = tree[path]
+            blob = os.path.join(folder, "blobs", blob_name(info, commit, path))
+            try:
+                if path in tasks:
+                    _, parts, futures = tasks[path]
+                    for future in futures:
+                        future.result()
+                    assemble(blob, parts)
+                    self.verify(blob, info)
+                link_blob(blob, os.path.join(snapshot, *path.split('/')))
+                with progress.lock:
+                    progress.files_done += 1
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            progress.status = "Failed"
+            raise DownloadError(f"{len(errors)} file(s) failed, first error: {errors[0]}")
+
+        os.makedirs(os.path.join(folder, "refs"), exist_ok=True)
+        with open(os.path.join(folder, "refs", revision), 'wt') as file:
+            file.write(commit)
+        catalog_for(self.cache_dir).invalidate(repo_name)
+        progress.status = "Done"
+        return snapshot
+
+    def split(self, size, ranges_supported: bool) -> list:
+        if not size:
+            return [(0, None)]
+        if not ranges_supported or size <= self.range_size:
+            return [(0, size - 1)]
+        return [(start, min(start + self.range_size, size) - 1) for start in range(0, size, self.range_size)]
+
+    def fetch_range(self, url: str, filename: str, start: int, end, ranges_supported: bool, progress: Progress):
+        have = os.path.getsize(filename) if os.path.exists(filename) else 0
+        if end is not None and have >= end - start + 1:
+            progress.add(have)
+            return
+        if not ranges_supported:
+            have = 0
+        headers = {'Range': f"bytes={start + have}-{'' if end is None else end}"} if ranges_supported else {}
+        with self.request(url, headers) as response:
+            if response.status != 206:
+                have = 0
+            progress.add(have)
+            with open(filename, 'ab' if have else 'wb') as file:
+                while chunk := response.read(CHUNK_SIZE):
+                    file.write(chunk)
+                    progress.add(len(chunk))
+
+    @staticmethod
+    def verify(blob: str, info: dict):
+        if info['size'] is not None and os.path.getsize(blob) != info['size']:
+            os.remove(blob)
+            raise DownloadError(f"Size mismatch for {blob}")
+        if info['sha256']:
+            ok = sha256(blob) == info['sha256']
+        elif info['oid']:
+            ok = git_blob_sha1(blob) == info['oid']
+        else:
+            ok = True
+        if not ok:
+            os.remove(blob)
+            raise DownloadError(f"Hash mismatch for {blob}")
+
+    def prefetch(self, repos: list, variant: str = None, revision: str = "main"):
+        # Every repository keeps the variant and revision it was queued with, the worker may already be running
+        with self.queue_lock:
+            tasks = [(repo, variant, revision) for repo in repos]
+            self.prefetch_queue += [task for task in tasks if task not in self.prefetch_queue]
+            for repo in repos:
+                self.progress.setdefault(repo, Progress())
+            if self.prefetch_thread is None or not self.prefetch_thread.is_alive():
+                self.prefetch_thread = threading.Thread(target=self.prefetch_worker, name="prefetch", daemon=True)
+                self.prefetch_thread.start()
+
+    def prefetch_worker(self):
+        while True:
+            with self.queue_lock:
+                if not self.prefetch_queue:
+                    return
+                repo, variant, revision = self.prefetch_queue.pop(0)
+            progress = self.progress[repo]
+            try:
+                self.download(repo, variant, revision, progress=progress)
+            except Exception as error:
+                progress.status = f"Failed: {type(error).__name__}: {error}"
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def blob_name(info: dict, commit: str, path: str) -> str:
+    return info['sha256'] or info['oid'] or hashlib.sha256(f"{commit}/{path}".encode()).hexdigest()
+
+
+def assemble(blob: str, parts: list):
+    incomplete = blob + ".incomplete"
+    if parts != [incomplete]:
+        with open(incomplete, 'wb') as output:
+            for part in parts:
+                with open(part, 'rb') as file:
+                    shutil.copyfileobj(file, output, CHUNK_SIZE)
+        for part in parts:
+            os.remove(part)
+    os.replace(incomplete, blob)
+
+
+def link_blob(blob: str, target: str):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.symlink(os.path.relpath(blob, os.path.dirname(target)), target)
+    except OSError:
+        try:
+            os.link(blob, target)
+        except OSError:
+            shutil.copyfile(blob, target)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download diffusers models into HuggingFace cache directory")
+    parser.add_argument('repos', nargs='+')
+    parser.add_argument('--cache-dir', default="cache")
+    parser.add_argument('--variant', default=None, help="Weights variant, e.g. 'fp16'")
+    parser.add_argument('--revision', default="main")
+    parser.add_argument('--endpoint', default=None, help="Hub URL, default HF_ENDPOINT or https://huggingface.co")
+    parser.add_argument('--token', default=None)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    manager = DownloadManager(args.cache_dir, args.endpoint, args.token, args.workers)
+    manager.prefetch(args.repos, args.variant, args.revision)
+    while manager.prefetch_thread.is_alive():
+        manager.prefetch_thread.join(1.0)
+        print("\r" + "; ".join(f"{repo}: {manager.progress[repo]}" for repo in args.repos), end="", file=sys.stderr)
+    print(file=sys.stderr)
+    manager.close()
+    if any(not manager.progress[repo].status == "Done" for repo in args.repos):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
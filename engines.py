@@ -0,0 +1,21 @@
+import importlib
+
+
+# Engine name -> (module, handler class, needs torch); modules are imported on first use, so missing backends cost
+# nothing
+ENGINES = {
+    'diffusers': ("diffusershandler", "DiffusersHandler", True),
+    'onnx': ("onnxhandler", "OnnxHandler", True),
+    'fake': ("fakehandler", "FakeHandler", False),
+}
+
+
+def uses_torch(engine: str) -> bool:
+    return ENGINES.get(engine, (None, None, True))[2]
+
+
+def handler_class(engine: str):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', expected one of: {', '.join(ENGINES)}")
+    module, name, _ = ENGINES[engine]
+    return getattr(importlib.import_module(module), name)
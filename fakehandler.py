@@ -0,0 +1,227 @@
+import os
+import time
+import random
+from typing import Union
+from PIL import Image
+
+from utils import repo_key, contact_sheet
+from progress import TimingHistory, RunProgress
+from priority import PriorityLock, Preempted
+
+
+class FakeHandler:
+    # Drop-in engine without torch: seed-deterministic synthetic images with simulated step latency, memory use and
+    # failures, for end-to-end tests and load tests of the queue, saving and GUI paths
+    def __init__(self, cache_dir="cache", max_models=1, step_time: float = 0.01, load_time: float = 0.0,
+                 memory_mb: int = 0, failure_rate: float = 0.0, max_batch: int = 4, **kwargs):
+        self.err_info = None
+        self.lock = PriorityLock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_models = max_models
+        self.step_time = step_time
+        self.load_time = load_time
+        self.memory_mb = memory_mb
+        self.failure_rate = failure_rate
+        self.max_batch = max_batch
+        self.device = "cpu"
+        self.device_opts = {'type': "cpu", 'engine': "fake"}
+        self.pipelines = {}
+        self.timing_history = TimingHistory(cache_dir)
+        self.curr = None
+        self.rng = random.Random()
+
+    def load_pipeline(self, repo_name: str, connect: bool = True, progress=None):
+        self.err_info = None
+        key = repo_key(repo_name)
+        if key in self.pipelines:
+            self.curr = self.pipelines.pop(key)
+            self.pipelines[key] = self.curr
+            return
+        if progress is not None:
+            progress({'stage': "Loading model", 'stage_index': 0, 'stages': 1, 'step': 0, 'steps': 1,
+                      'eta': self.load_time})
+        time.sleep(self.load_time)
+        if len(self.pipelines) == self.max_models:
+            del self.pipelines[list(self.pipelines)[0]]
+        model = {
+            'repo': repo_name,
+            'variant': "default",
+            'dtype': "float32",
+            'scheduler': "FakeScheduler",
+            'default_image_size': 512,
+            'engine': "fake"
+        }
+        self.curr = {'model': model, 'load_time': self.load_time, 'shared': []}
+        self.pipelines[key] = self.curr
+
+    def memory_usage(self) -> dict:
+        total = len(self.pipelines) * (self.memory_mb << 20)
+        return {'total': total, 'resident': total, 'shared': 0}
+
+    def auto_batch(self, width: int, height: int):
+        return self.max_batch
+
+    @staticmethod
+    def image(seed: int, prompt: str, width: int, height: int) -> Image.Image:
+        # A smooth color field from an 8x8 grid of random colors, different for every seed and prompt
+        grid = random.Random(f"{seed}|{prompt}").randbytes(8 * 8 * 3)
+        return Image.frombytes('RGB', (8, 8), grid).resize((width, height), Image.BICUBIC)
+
+    def fails(self, seed, prompt: str) -> bool:
+        return self.failure_rate > 0 and random.Random(f"fail|{seed}|{prompt}").random() < self.failure_rate
+
+    def run(self,
+            prompt: str, negative_prompt: str = "", guidance_scale: float = 7.5,
+            image_file: str = None, strength: float = 0.8, width: int = None, height: int = None,
+            num_inference_steps: int = 50, number: int = 1, seed: Union[int, list] = None,
+            block_nsfw: bool = True, loras: list = None, fuse_loras: bool = False,
+            hires: bool = False, hires_strength: float = 0.55, hires_steps: int = None,
+            step_cache: int = 0, step_cache_depth: int = 1, token_merge: float = 0.0,
+            guidance_truncation: float = 0.0,
+            progress=None, checkpoint: dict = None, should_yield=None) -> list[tuple]:
+        self.err_info = None
+        if self.curr is None:
+            raise AssertionError("Model not loaded")
+        params = {
+            'model': self.curr['model'],
+            'device': self.device_opts,
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'guidance_scale': guidance_scale,
+            'num_inference_steps': num_inference_steps,
+            'num_images_per_prompt': number,
+            'image_index': 0
+        }
+        seeds = list(seed) if isinstance(seed, (list, tuple)) else None
+        if seeds:
+            number = params['num_images_per_prompt'] = len(seeds)
+        elif seed is not None:
+            params['seed'] = seed
+        width = max(round((width or self.curr['model']['default_image_size']) / 32) * 32, 32)
+        height = max(round((height or self.curr['model']['default_image_size']) / 32) * 32, 32)
+        params['width'], params['height'] = width, height
+        if image_file:
+            params['init_image'] = image_file
+            params['strength'] = strength
+            num_inference_steps = int(num_inference_steps * strength)
+        if loras:
+            params['loras'] = [{'file': filename, 'weight': float(weight)} for filename, weight in loras]
+
+        start = time.perf_counter() - (checkpoint or {}).get('elapsed', 0)
+        # Seeds of every image are known up front, so images and failures do not depend on preemption
+        image_seeds = seeds or [
+            seed + index if seed is not None else self.rng.randrange(1 << 32) for index in range(number)
+        ]
+        state = (checkpoint or {}).pop('state', None) or {'done': [], 'step': 0}
+        run_progress = RunProgress(self.timing_history, [
+            ("Generating", TimingHistory.key(self.curr['model'], width, height, 1), num_inference_steps)
+        ] * number, progress)
+        buffer = bytearray(self.memory_mb << 20) if self.memory_mb else None
+        try:
+            for index, image_seed in enumerate(image_seeds):
+                if index < len(state['done']):
+                    run_progress.start()
+                    continue
+                if self.fails(image_seed, prompt):
+                    raise RuntimeError(f"Injected failure for seed {image_seed}")
+                run_progress.start(done=state['step'])
+                for step in range(state['step'], num_inference_steps):
+                    time.sleep(self.step_time)
+                    run_progress.on_step(step)
+                    if should_yield is not None and checkpoint is not None and step + 1 < num_inference_steps \
+                            and should_yield():
+                        checkpoint['state'] = {'done': state['done'], 'step': step + 1}
+                        raise Preempted(f"Preempted at step {step + 1}")
+                run_progress.end()
+                state = {'done': state['done'] + [image_seed], 'step': 0}
+        except Preempted:
+            checkpoint['elapsed'] = time.perf_counter() - start
+            checkpoint['preempted'] = checkpoint.get('preempted', 0) + 1
+            raise
+        except Exception as error:
+            self.err_info = params
+            raise error
+        del buffer
+        self.timing_history.save()
+        params['timings'] = {'inference': round(time.perf_counter() - start, 3), 'batch_size': 1}
+        if self.memory_mb:
+            params['timings']['peak_rss_mb'] = self.memory_mb
+        if checkpoint and checkpoint.get('preempted'):
+            params['timings']['preempted'] = checkpoint['preempted']
+
+        output = []
+        for image_seed in image_seeds:
+            if seeds:
+                params.update(seed=image_seed, num_images_per_prompt=1, image_index=0)
+            output.append((self.image(image_seed, prompt, width, height), params.copy()))
+            params['image_index'] += 1
+        return output
+
+    def run_images(self,
+                   images: list, names: list, seeds: list,
+                   prompt: str, negative_prompt: str = "", guidance_scale: float = 7.5, strength: float = 0.8,
+                   num_inference_steps: int = 50, block_nsfw: bool = True, loras: list = None,
+                   fuse_loras: bool = False, progress=None) -> list[tuple]:
+        self.err_info = None
+        if self.curr is None:
+            raise AssertionError("Model not loaded")
+        width, height = images[0].size
+        params = {
+            'model': self.curr['model'],
+            'device': self.device_opts,
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'guidance_scale': guidance_scale,
+            'num_inference_steps': num_inference_steps,
+            'num_images_per_prompt': 1,
+            'image_index': 0,
+            'strength': strength,
+            'width': width,
+            'height': height
+        }
+        start = time.perf_counter()
+        steps = int(num_inference_steps * strength)
+        run_progress = RunProgress(self.timing_history, [
+            ("Generating", TimingHistory.key(self.curr['model'], width, height, len(images), "img2img"), steps)
+        ], progress)
+        try:
+            for seed, name in zip(seeds, names):
+                if self.fails(seed, f"{prompt}|{name}"):
+                    raise RuntimeError(f"Injected failure for {name}")
+            # One batch: the steps take as long as for a single image
+            run_progress.start()
+            for step in range(steps):
+                time.sleep(self.step_time)
+                run_progress.on_step(step)
+            run_progress.end()
+        except Exception as error:
+            self.err_info = params
+            raise error
+        self.timing_history.save()
+        params['timings'] = {'inference': round(time.perf_counter() - start, 3), 'batch_size': len(images)}
+        return [
+            (Image.blend(image, self.image(seed, prompt, width, height), strength), dict(params, init_image=name, seed=seed))
+            for image, name, seed in zip(images, names, seeds)
+        ]
+
+    def sweep(self,
+              prompt: str, negative_prompt: str = "", guidance_scales: list = (7.5,), steps: list = (50,),
+              seeds: list = (0,), width: int = None, height: int = None, block_nsfw: bool = True,
+              max_batch: int = None, loras: list = None, fuse_loras: bool = False, progress=None) -> tuple:
+        guidance_scales, steps, seeds = list(guidance_scales), list(steps), list(seeds)
+        output = []
+        for num_steps in steps:
+            for guidance in guidance_scales:
+                for image, image_params in self.run(
+                        prompt, negative_prompt, guidance, width=width, height=height, num_inference_steps=num_steps,
+                        seed=seeds, loras=loras, progress=progress):
+                    image_params['image_index'] = len(output)
+                    output.append((image, image_params))
+        params = dict(output[0][1], sweep={'guidance_scales': guidance_scales, 'steps': steps, 'seeds': seeds})
+        sheet = contact_sheet(
+            [image for image, _ in output], rows=len(steps) * len(guidance_scales), cols=len(seeds),
+            row_labels=[f"steps {num_steps}, guidance {guidance}" for num_steps in steps for guidance in guidance_scales],
+            col_labels=[f"seed {seed}" for seed in seeds]
+        )
+        return (sheet, params), output
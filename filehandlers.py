@@ -1,9 +1,26 @@
 import os
+import yaml
 from PIL import Image
+from PIL.PngImagePlugin import PngInfo
 
 from utils import QueueMap
 
 
+PNG_PARAMS_KEY = "parameters"
+
+
+def png_params_info(params: dict) -> PngInfo:
+    info = PngInfo()
+    info.add_itxt(PNG_PARAMS_KEY, yaml.safe_dump(params, allow_unicode=True))
+    return info
+
+
+def read_png_params(filename: str):
+    with Image.open(filename) as image:
+        text = getattr(image, 'text', {}).get(PNG_PARAMS_KEY)
+    return yaml.safe_load(text) if text else None
+
+
 class FileCache(QueueMap):
     def __init__(self, max_size: int = 20, cache_saved: bool = False):
         super(FileCache, self).__init__(max_size)
@@ -22,14 +39,14 @@ class FileCache(QueueMap):
 
     def save(self, filename: str, content, cache_saved: bool = None, info=None):
         filename = os.path.realpath(filename)
-        self.save_to_disk(filename, content)
+        self.save_to_disk(filename, content, info)
         if cache_saved or cache_saved is None and self.cache_saved:
             self.push(filename, (content, os.stat(filename), info))
 
     def load_from_disk(self, filename: str):
         raise NotImplementedError("Virtual metod overload required")
 
-    def save_to_disk(self, filename: str, content):
+    def save_to_disk(self, filename: str, content, info=None):
         raise NotImplementedError("Virtual metod overload required")
 
 
@@ -39,7 +56,7 @@ class TextFileCahe(FileCache):
             content = file.read()
         return content
 
-    def save_to_disk(self, filename: str, content):
+    def save_to_disk(self, filename: str, content, info=None):
         with open(filename, 'wt') as file:
             file.write(content)
 
@@ -48,8 +65,11 @@ class ImageFileCahe(FileCache):
     def load_from_disk(self, filename: str):
         return Image.open(filename)
 
-    def save_to_disk(self, filename: str, content):
-        content.save(filename)
+    def save_to_disk(self, filename: str, content, info=None):
+        if isinstance(info, dict) and filename.lower().endswith(".png"):
+            content.save(filename, pnginfo=png_params_info(info))
+        else:
+            content.save(filename)
 
 
 text_files = TextFileCahe(100)
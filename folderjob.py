@@ -0,0 +1,167 @@
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from utils import image_fit
+from jobqueue import output_matches, save_output
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp', '.tif', '.tiff')
+# Arguments of handler.run_images in a folder request, which also has repo, connect, init_folder, seed, width, height
+# and adPrompts
+RUN_ARGS = ('prompt', 'negative_prompt', 'guidance_scale', 'strength', 'num_inference_steps', 'block_nsfw', 'loras',
+            'fuse_loras')
+REQUEST_KEYS = RUN_ARGS + ('repo', 'connect', 'width', 'height', 'adprompt', 'negative_adprompt')
+
+
+def folder_images(folder: str) -> list:
+    return sorted(
+        entry.path for entry in os.scandir(folder)
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+
+def image_seed(seed: int, index: int) -> int:
+    return (seed + index + (1 << 63)) % (1 << 64) - (1 << 63)
+
+
+def output_name(outdir: str, template: str, filename: str) -> str:
+    # The '?' mask of the template takes the name of the init image
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(outdir, re.sub(r'\?+', lambda match: stem, template, count=1))
+
+
+def prefetch(function, items: list, workers: int, depth: int):
+    # Yields (item, future) in order, with at most `depth` items submitted ahead of the consumer
+    pool = ThreadPoolExecutor(workers, thread_name_prefix="folder load")
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, pool.submit(function, item)))
+            if len(pending) >= depth:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class BoundedWriter:
+    # Saves on a thread pool; submit blocks while `depth` images are waiting, so finished batches cannot pile up
+    def __init__(self, save, workers: int, depth: int):
+        self.save = save
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="folder save")
+        self.slots = threading.BoundedSemaphore(depth)
+        self.errors = {}
+
+    def submit(self, index: int, *args):
+        self.slots.acquire()
+        future = self.pool.submit(self.save, *args)
+        future.add_done_callback(lambda done: self.done(index, done))
+
+    def done(self, index: int, future):
+        if future.exception() is not None:
+            self.errors[index] = future.exception()
+        self.slots.release()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class FolderJob:
+    # img2img over every image of a folder as a staged pipeline: init images are decoded and fitted on a thread pool
+    # ahead of the handler, which runs VAE encode, denoise and decode over whole batches; finished images are encoded
+    # and saved on another pool while the next batch runs. Queues between the stages are bounded, so memory stays
+    # flat however large the folder is
+    def __init__(self, handler, request: dict, outdir: str, template: str, batch_size: int = None,
+                 load_workers: int = 2, save_workers: int = 2):
+        self.handler = handler
+        self.request = request
+        self.outdir = outdir
+        self.template = template
+        self.batch_size = batch_size
+        self.load_workers = load_workers
+        self.save_workers = save_workers
+
+    def image_request(self, index: int) -> dict:
+        return dict(self.request, seed=image_seed(self.request['seed'], index))
+
+    def load(self, task: tuple):
+        # Images with a matching output from an earlier, interrupted run are not loaded again
+        index, filename = task
+        target = output_name(self.outdir, self.template, filename)
+        if output_matches(target, self.image_request(index)):
+            return None
+        with Image.open(filename) as image:
+            return image_fit(image, self.request['width'], self.request['height'], 32).convert('RGB')
+
+    def run(self, progress=None, stop=None) -> tuple:
+        files = folder_images(self.request['init_folder'])
+        outputs, errors = [None] * len(files), {}
+        if not files:
+            return outputs, errors
+        with self.handler.lock.batch():
+            self.handler.load_pipeline(self.request['repo'], connect=self.request.get('connect', True))
+            batch_size = self.batch_size or self.handler.auto_batch(self.request['width'], self.request['height']) or 4
+        kwargs = {key: self.request[key] for key in RUN_ARGS if key in self.request}
+        writer = BoundedWriter(save_output, self.save_workers, 2 * batch_size)
+        done = 0
+
+        def run_batch(batch: list):
+            nonlocal done
+            indices = [index for index, _, _ in batch]
+
+            def batch_progress(info):
+                if progress is not None:
+                    progress(dict(info, stage=f"Image {done + 1}-{done + len(batch)} of {len(files)}, {info['stage']}"))
+
+            # The lock is taken per batch, interactive runs get in between batches
+            with self.handler.lock.batch():
+                self.handler.load_pipeline(self.request['repo'], connect=self.request.get('connect', True))
+                result = self.handler.run_images(
+                    [image for _, _, image in batch], [filename for _, filename, _ in batch],
+                    [image_seed(self.request['seed'], index) for index in indices], **kwargs, progress=batch_progress
+                )
+            for (index, filename, _), (image, params) in zip(batch, result):
+                for key in ('adprompt', 'negative_adprompt'):
+                    if key in self.request:
+                        params[key] = self.request[key]
+                if image is not None:
+                    outputs[index] = output_name(self.outdir, self.template, filename)
+                    writer.submit(index, outputs[index], image, params)
+            done += len(batch)
+
+        os.makedirs(self.outdir, exist_ok=True)
+        batch = []
+        try:
+            for (index, filename), future in prefetch(
+                    self.load, list(enumerate(files)), self.load_workers, 2 * batch_size):
+                if stop is not None and stop():
+                    break
+                try:
+                    image = future.result()
+                except Exception as error:
+                    errors[index] = error
+                    done += 1
+                    continue
+                if image is None:
+                    outputs[index] = output_name(self.outdir, self.template, filename)
+                    done += 1
+                    continue
+                # Batches hold images of one size; fitted images of other aspect ratios start a new one
+                if batch and (len(batch) == batch_size or image.size != batch[0][2].size):
+                    run_batch(batch)
+                    batch = []
+                batch.append((index, filename, image))
+            else:
+                if batch:
+                    run_batch(batch)
+        finally:
+            writer.close()
+        for index, error in writer.errors.items():
+            outputs[index] = None
+            errors[index] = error
+        return outputs, errors
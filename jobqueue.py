@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from PIL import Image
+
+from catalog import catalog_at
+from priority import Preempted
+from filehandlers import png_params_info, read_png_params
+from utils import file_naming, load_yaml, save_yaml
+
+
+STATES = ('submitted', 'running', 'done', 'failed', 'cancelled')
+MATCH_KEYS = ('prompt', 'negative_prompt', 'seed', 'guidance_scale', 'num_inference_steps')
+
+
+def request_group(request: dict) -> str:
+    return json.dumps({key: value for key, value in request.items() if key != 'seed'}, sort_keys=True, default=str)
+
+
+def saved_params(filename: str):
+    try:
+        if filename.lower().endswith(".png"):
+            params = read_png_params(filename)
+            if params is not None:
+                return params
+        return load_yaml(filename + ".prm")
+    except Exception:
+        return None
+
+
+def output_matches(filename: str, request: dict) -> bool:
+    params = saved_params(filename) if filename and os.path.isfile(filename) else None
+    if not isinstance(params, dict) or params.get('model', {}).get('repo') != request['repo']:
+        return False
+    return all(params.get(key) == request.get(key) for key in MATCH_KEYS if key in request)
+
+
+def save_output(filename: str, image, params: dict):
+    ext = os.path.splitext(filename)[1].lower()
+    tmp_name = filename + ".tmp"
+    options = {'pnginfo': png_params_info(params)} if ext == ".png" else {}
+    image.save(tmp_name, format=Image.registered_extensions().get(ext, "PNG"), **options)
+    os.replace(tmp_name, filename)
+    save_yaml(filename + ".prm", params)
+    catalog_at(filename).add(filename, params)
+
+
+class JobQueue:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, priority INTEGER NOT NULL DEFAULT 0, "
+                "state TEXT NOT NULL, request TEXT NOT NULL, grp TEXT NOT NULL, outdir TEXT NOT NULL, "
+                "template TEXT NOT NULL, outputs TEXT, error TEXT, submitted REAL, started REAL, finished REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, priority, id)")
+        self.changed = threading.Event()
+
+    @staticmethod
+    def job(row) -> dict:
+        job = dict(row)
+        job['request'] = json.loads(job['request'])
+        job['outputs'] = json.loads(job['outputs']) if job['outputs'] else None
+        return job
+
+    def submit(self, request: dict, outdir: str, template: str, kind: str = "run", priority: int = 0) -> int:
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO jobs(kind, priority, state, request, grp, outdir, template, submitted) "
+                "VALUES (?, ?, 'submitted', ?, ?, ?, ?, ?)",
+                (kind, priority, json.dumps(request, default=str), request_group(request), outdir, template,
+                 time.time())
+            )
+        self.changed.set()
+        return cursor.lastrowid
+
+    def recover(self) -> int:
+        # Jobs left running by a crash go back to the queue, their planned outputs are kept for detection
+        with self.lock, self.db:
+            return self.db.execute("UPDATE jobs SET state = 'submitted' WHERE state = 'running'").rowcount
+
+    def claim(self, limit: int = 1, like: dict = None) -> list[dict]:
+        with self.lock, self.db:
+            if like is None:
+                rows = self.db.execute(
+                    "SELECT * FROM jobs WHERE state = 'submitted' ORDER BY priority DESC, id LIMIT ?", (limit,)
+                ).fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT * FROM jobs WHERE state = 'submitted' AND kind = ? AND grp = ? AND outdir = ? "
+                    "AND template = ? AND priority = ? ORDER BY id LIMIT ?",
+                    (like['kind'], like['grp'], like['outdir'], like['template'], like['priority'], limit)
+                ).fetchall()
+            self.db.executemany(
+                "UPDATE jobs SET state = 'running', started = ? WHERE id = ?", [(time.time(), row['id']) for row in rows]
+            )
+        return [self.job(row) for row in rows]
+
+    def reserved(self) -> set:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT outputs FROM jobs WHERE state IN ('submitted', 'running') AND outputs IS NOT NULL"
+            ).fetchall()
+        return set(path for row in rows for path in json.loads(row['outputs']) if path)
+
+    def plan(self, job_id: int, outputs: list):
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET outputs = ? WHERE id = ?", (json.dumps(outputs), job_id))
+
+    def finish(self, job_id: int, outputs: list):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET state = 'done', outputs = ?, error = NULL, finished = ? WHERE id = ?",
+                (json.dumps(outputs), time.time(), job_id)
+            )
+        self.changed.set()
+
+    def fail(self, job_id: int, error: str):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ? AND state = 'running'",
+                (error, time.time(), job_id)
+            )
+        self.changed.set()
+
+    def release(self, job_id: int):
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET state = 'submitted' WHERE id = ? AND state = 'running'", (job_id,))
+        self.changed.set()
+
+    def cancel(self, job_id: int):
+        with self.lock, self.db:
+            self.db.execute("UPDATE jobs SET state = 'cancelled' WHERE id = ? AND state = 'submitted'", (job_id,))
+        self.changed.set()
+
+    def retry(self, job_id: int):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE jobs SET state = 'submitted', error = NULL WHERE id = ? AND state IN ('failed', 'cancelled')",
+                (job_id,)
+            )
+        self.changed.set()
+
+    def clear(self, states=('done', 'cancelled')):
+        with self.lock, self.db:
+            self.db.execute(f"DELETE FROM jobs WHERE state IN ({', '.join('?' * len(states))})", tuple(states))
+        self.changed.set()
+
+    def jobs(self, limit: int = 500) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT * FROM jobs ORDER BY CASE state WHEN 'running' THEN 0 WHEN 'submitted' THEN 1 ELSE 2 END, "
+                "priority DESC, id LIMIT ?", (limit,)
+            ).fetchall()
+        return [self.job(row) for row in rows]
+
+    def counts(self) -> dict:
+        with self.lock:
+            rows = self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+
+class JobWorker:
+    def __init__(self, queue: JobQueue, get_handler, on_event=None, max_group: int = 16, max_preemptions: int = 8):
+        self.queue = queue
+        self.get_handler = get_handler
+        self.on_event = on_event or (lambda event: None)
+        self.max_group = max_group
+        # Fairness: after this many pauses a group runs to the end, interactive runs wait for it
+        self.max_preemptions = max_preemptions
+        self.stop = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.queue.recover()
+        self.thread = threading.Thread(target=self.loop, name="job worker", daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        try:
+            handler = self.get_handler()
+        except Exception as error:
+            self.on_event({'type': 'stopped', 'error': str(error)})
+            return
+        while not self.stop.is_set():
+            jobs = self.queue.claim()
+            if not jobs:
+                self.queue.changed.wait(1.0)
+                self.queue.changed.clear()
+                continue
+            try:
+                self.run_group(handler, jobs)
+            except Exception as error:
+                for job in jobs:
+                    self.queue.fail(job['id'], f"{type(error).__name__}: {error}")
+                    self.on_event({'type': 'failed', 'job': job['id'], 'error': str(error)})
+
+    def run_group(self, handler, jobs: list):
+        if jobs[0]['kind'] == "folder":
+            self.run_folder(handler, jobs[0])
+            return
+        request = jobs[0]['request']
+        with handler.lock.batch():
+            handler.load_pipeline(request['repo'], connect=request.get('connect', True))
+            limit = handler.auto_batch(request.get('width'), request.get('height')) \
+                if request.get('width') and request.get('height') else None
+            jobs += self.queue.claim(min(limit or 1, self.max_group) - 1, like=jobs[0])
+
+            pending = []
+            for job in jobs:
+                outputs = job['outputs']
+                if outputs and all(path is None or output_matches(path, job['request']) for path in outputs):
+                    self.queue.finish(job['id'], outputs)
+                    self.on_event({'type': 'done', 'job': job['id'], 'outputs': outputs, 'detected': True})
+                else:
+                    pending.append(job)
+            if not pending:
+                return
+
+            os.makedirs(jobs[0]['outdir'], exist_ok=True)
+            reserved = self.queue.reserved()
+            names = file_naming(jobs[0]['outdir'], jobs[0]['template'])
+            for job in pending:
+                if not job['outputs']:
+                    path = next(name for name in names if name not in reserved)
+                    job['outputs'] = [path]
+                    self.queue.plan(job['id'], job['outputs'])
+
+        kwargs = {key: value for key, value in request.items()
+                  if key not in ('repo', 'connect', 'seed', 'adprompt', 'negative_adprompt')}
+        job_ids = [job['id'] for job in pending]
+        checkpoint = {}
+        while True:
+            # Interactive runs get the lock first; the batch pauses at a step boundary and resumes from the checkpoint
+            with handler.lock.batch():
+                handler.load_pipeline(request['repo'], connect=request.get('connect', True))
+                try:
+                    result = handler.run(
+                        seed=[job['request']['seed'] for job in pending], **kwargs,
+                        progress=lambda info: self.on_event(dict(info, type='progress', jobs=job_ids)),
+                        checkpoint=checkpoint,
+                        should_yield=lambda: checkpoint.get('preempted', 0) < self.max_preemptions
+                        and handler.lock.should_yield()
+                    )
+                    break
+                except Preempted as preempted:
+                    self.on_event({'type': 'preempted', 'jobs': job_ids, 'info': str(preempted)})
+
+        for job, (image, params) in zip(pending, result):
+            for key in ('adprompt', 'negative_adprompt'):
+                if key in request:
+                    params[key] = request[key]
+            if image is None:
+                outputs = [None]
+            else:
+                save_output(job['outputs'][0], image, params)
+                outputs = job['outputs']
+            self.queue.finish(job['id'], outputs)
+            self.on_event({'type': 'done', 'job': job['id'], 'outputs': outputs, 'detected': False})
+
+    def run_folder(self, handler, job: dict):
+        # Imported here, folderjob builds on this module
+        from folderjob import FolderJob
+        outputs, errors = FolderJob(handler, job['request'], job['outdir'], job['template']).run(
+            progress=lambda info: self.on_event(dict(info, type='progress', jobs=[job['id']])),
+            stop=self.stop.is_set
+        )
+        if self.stop.is_set():
+            self.queue.release(job['id'])
+            return
+        if errors and not any(outputs):
+            raise next(iter(errors.values()))
+        self.queue.finish(job['id'], outputs)
+        self.on_event({'type': 'done', 'job': job['id'], 'outputs': outputs, 'detected': False})
@@ -0,0 +1,40 @@
+import os
+import threading
+import torch
+from safetensors.torch import load_file
+
+from utils import file_hash
+
+
+class LoraCache:
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, filename: str) -> dict:
+        filename = os.path.realpath(filename)
+        stats = os.stat(filename)
+        key = (filename, stats.st_size, stats.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry
+
+        if filename.endswith(".safetensors"):
+            state_dict = load_file(filename, device="cpu")
+        else:
+            state_dict = torch.load(filename, map_location="cpu", weights_only=True)
+        digest = file_hash(filename)
+        entry = {
+            'name': "lora_" + digest[:16],
+            'file': filename,
+            'hash': digest,
+            'state_dict': state_dict
+        }
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        return entry
@@ -1,3 +1,5 @@
+import startup
+import sys
 import tkinter as tk
 from tkinter import Tk, ttk
 from tkinter.messagebox import askokcancel
@@ -5,6 +7,17 @@ from PIL import ImageTk
 
 import cfg
 from widgets.inference_tab import InferenceTab
+from widgets.gallery import GalleryTab
+from widgets.queue_tab import QueueTab
+from jobqueue import JobQueue
+startup.mark("import GUI modules")
+
+
+def print_report(root, inference_tab):
+    if inference_tab.warmup.thread.is_alive():
+        root.after(200, lambda: print_report(root, inference_tab))
+    else:
+        print(startup.report())
 
 
 if __name__ == '__main__':
@@ -34,7 +47,19 @@ if __name__ == '__main__':
     notebook = ttk.Notebook(mainframe)
     notebook.grid(row=1, column=1, sticky=tk.N+tk.S+tk.W+tk.E, padx=5, pady=5)
 
-    inference_tab = InferenceTab(notebook)
+    job_queue = JobQueue(cfg.JOBS_FILE)
+    inference_tab = InferenceTab(notebook, job_queue=job_queue)
     notebook.add(inference_tab, text="Inference")
 
+    queue_tab = QueueTab(notebook, job_queue, inference_tab.warmup.get)
+    notebook.add(queue_tab, text="Queue")
+
+    gallery_tab = GalleryTab(notebook)
+    notebook.add(gallery_tab, text="Gallery")
+
+    root.update_idletasks()
+    startup.mark("window shown")
+    if '--startup-report' in sys.argv:
+        print_report(root, inference_tab)
+
     root.mainloop()
@@ -0,0 +1,101 @@
+import gc
+import os
+import ctypes
+import platform
+import threading
+import torch
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+MB = 1 << 20
+
+
+def rss() -> int:
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", 'rt') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def is_oom(error: BaseException) -> bool:
+    if isinstance(error, (MemoryError, torch.cuda.OutOfMemoryError)):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and (
+        "out of memory" in message or "can't allocate memory" in message or "not enough memory" in message
+    )
+
+
+def free_memory(device: str):
+    gc.collect()
+    if device == "cuda":
+        torch.cuda.empty_cache()
+    elif device == "mps":
+        torch.mps.empty_cache()
+    elif platform.system() == "Linux":
+        # glibc keeps freed blocks of released weights in the heap otherwise
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
+
+class MemoryMonitor:
+    def __init__(self, device: str, interval: float = 0.05):
+        self.device = device
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_device = None
+        self.stop = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, rss())
+            if self.stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self.peak_rss = max(self.peak_rss, rss())
+        self.stop.clear()
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        self.thread = threading.Thread(target=self.sample, name="memory monitor", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, rss())
+        if self.device == "cuda":
+            self.peak_device = max(self.peak_device or 0, torch.cuda.max_memory_allocated())
+
+    def report(self) -> dict:
+        report = {'peak_rss_mb': round(self.peak_rss / MB)}
+        if self.peak_device is not None:
+            report['peak_vram_mb'] = round(self.peak_device / MB)
+        return report
+
+
+def available_memory(device: str):
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo", 'rt') as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
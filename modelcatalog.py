@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import struct
+import hashlib
+import argparse
+import threading
+from typing import Optional
+
+from utils import file_hash
+
+
+WEIGHT_EXTS = (".safetensors", ".bin")
+NO_WEIGHTS = {'scheduler', 'tokenizer', 'tokenizer_2', 'feature_extractor', 'image_processor'}
+DEFAULT_VARIANT = "default"
+SAFETENSORS_DTYPES = {
+    'F16': "float16", 'BF16': "bfloat16", 'F32': "float32", 'F64': "float64",
+    'I8': "int8", 'U8': "uint8", 'F8_E4M3': "float8_e4m3fn", 'F8_E5M2': "float8_e5m2"
+}
+
+
+def repo_folder(repo_name: str) -> str:
+    return "models--" + repo_name.replace('/', '--')
+
+
+def safetensors_header_bytes(filename: str) -> bytes:
+    with open(filename, 'rb') as file:
+        size = struct.unpack('<Q', file.read(8))[0]
+        return file.read(size)
+
+
+def safetensors_header(filename: str) -> dict:
+    return json.loads(safetensors_header_bytes(filename))
+
+
+def weight_variant(filename: str) -> Optional[str]:
+    # 'diffusion_pytorch_model.fp16.safetensors' -> 'fp16', 'model-00001-of-00002.safetensors' -> 'default'
+    name = filename.removesuffix(".index.json")
+    for ext in WEIGHT_EXTS:
+        if name.endswith(ext):
+            parts = name.removesuffix(ext).split('.')
+            return parts[1] if len(parts) > 1 else DEFAULT_VARIANT
+    return None
+
+
+def component_weights(folder: str) -> dict:
+    variants = {}
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return variants
+    for name in names:
+        if not name.endswith(".index.json"):
+            continue
+        variant = weight_variant(name)
+        try:
+            with open(os.path.join(folder, name), 'rt') as file:
+                shards = set(json.load(file)['weight_map'].values())
+        except (OSError, ValueError, KeyError):
+            continue
+        files = [os.path.join(folder, shard) for shard in sorted(shards)]
+        if variant is not None and all(os.path.isfile(fname) for fname in files):
+            variants.setdefault(variant, files)
+    for name in names:
+        if not name.endswith(WEIGHT_EXTS) or '-of-' in name:
+            continue
+        variant = weight_variant(name)
+        filename = os.path.join(folder, name)
+        if variant is not None and os.path.isfile(filename):
+            variants.setdefault(variant, [filename])
+    return variants
+
+
+def weights_dtype(files: list) -> Optional[str]:
+    for filename in files:
+        if not filename.endswith(".safetensors"):
+            return None
+        try:
+            header = safetensors_header(filename)
+        except (OSError, ValueError, struct.error):
+            return None
+        for name, info in header.items():
+            if name != '__metadata__':
+                return SAFETENSORS_DTYPES.get(info['dtype'], info['dtype'])
+    return None
+
+
+def component_files(folder: str, variant: str = None) -> Optional[list]:
+    variants = component_weights(folder)
+    if variants and (variant or DEFAULT_VARIANT) not in variants:
+        return None
+    files = [
+        os.path.join(folder, name) for name in sorted(os.listdir(folder))
+        if weight_variant(name) is None and os.path.isfile(os.path.join(folder, name))
+    ]
+    return files + sorted(variants.get(variant or DEFAULT_VARIANT, []))
+
+
+CONFIG_IGNORE = {'_name_or_path', '_diffusers_version', 'transformers_version', '_commit_hash'}
+CONFIG_MAX_SIZE = 1 << 20  # Larger JSON files (tokenizers) are hashed as bytes instead of normalized
+_fingerprints = {}
+_file_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def content_id(filename: str) -> str:
+    # Cached blobs are named after their sha256 (LFS) or git sha1
+    target = os.path.realpath(filename)
+    if target != os.path.abspath(filename) and os.path.basename(os.path.dirname(target)) == "blobs":
+        return os.path.basename(target)
+    stats = os.stat(target)
+    key = (target, stats.st_size, stats.st_mtime_ns)
+    with _fingerprints_lock:
+        digest = _fingerprints.get(key)
+    if digest is None:
+        digest = file_hash(target)
+        with _fingerprints_lock:
+            _fingerprints[key] = digest
+    return digest
+
+
+def file_fingerprint(filename: str, full: bool = False) -> bytes:
+    # Memoized by path, size and mtime, so pool lookups on every model load do not read the files again
+    target = os.path.realpath(filename)
+    stats = os.stat(target)
+    key = (target, stats.st_size, stats.st_mtime_ns, full)
+    with _fingerprints_lock:
+        digest = _file_fingerprints.get(key)
+    if digest is not None:
+        return digest
+    name = os.path.basename(filename)
+    if weight_variant(name) is None:
+        digest = None
+        if name.endswith(".json") and stats.st_size <= CONFIG_MAX_SIZE:
+            try:
+                with open(target, 'rt', encoding='utf-8') as file:
+                    config = json.load(file)
+                if isinstance(config, dict):
+                    config = {k: v for k, v in config.items() if k not in CONFIG_IGNORE}
+                digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).digest()
+            except ValueError:
+                pass
+        digest = digest or file_hash(target).encode()
+    else:
+        digest = str(stats.st_size).encode()
+        if full:
+            digest += content_id(filename).encode()
+        elif name.endswith(".safetensors"):
+            digest += hashlib.sha256(safetensors_header_bytes(target)).digest()
+    with _fingerprints_lock:
+        _file_fingerprints[key] = digest
+    return digest
+
+
+def component_fingerprint(folder: str, variant: str = None, full: bool = False) -> Optional[str]:
+    # Quick fingerprint: small files, weight sizes and safetensors headers; full one adds content of weights
+    files = component_files(folder, variant)
+    if not files:
+        return None
+    digest = hashlib.sha256()
+    for filename in files:
+        digest.update(os.path.basename(filename).split('.')[0].encode() + b"\0")
+        digest.update(file_fingerprint(filename, full))
+    return digest.hexdigest()
+
+
+def scan_snapshot(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, "model_index.json"), 'rt') as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    components = [
+        name for name, value in index.items()
+        if not name.startswith('_') and isinstance(value, list) and value[0] is not None
+    ]
+    for name in components:
+        if not os.path.isdir(os.path.join(path, name)):
+            return None
+
+    weights = {}
+    for name in components:
+        if name in NO_WEIGHTS:
+            continue
+        folder = os.path.join(path, name)
+        if not os.path.isfile(os.path.join(folder, "config.json")):
+            continue
+        weights[name] = component_weights(folder)
+        if not weights[name]:
+            return None
+
+    config_size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if weight_variant(name) is None or name.endswith(".index.json"):
+                try:
+                    config_size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    return None
+
+    variants = {}
+    for variant in set(v for component in weights.values() for v in component):
+        if not all(variant in component for component in weights.values()):
+            continue
+        files = [fname for component in weights.values() for fname in component[variant]]
+        variants[variant] = {
+            'size': config_size + sum(os.path.getsize(fname) for fname in files),
+            'dtypes': sorted(set(filter(None, (weights_dtype(component[variant]) for component in weights.values()))))
+        }
+    if not variants:
+        return None
+    return {
+        'path': path,
+        'pipeline': index.get('_class_name'),
+        'components': components,
+        'variants': variants
+    }
+
+
+class ModelCatalog:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.stamps = {}
+
+    def snapshot_path(self, folder: str) -> Optional[str]:
+        try:
+            with open(os.path.join(folder, "refs", "main"), 'rt') as file:
+                revision = file.read().strip()
+            path = os.path.join(folder, "snapshots", revision)
+            if os.path.isdir(path):
+                return path
+        except OSError:
+            pass
+        try:
+            snapshots = [entry for entry in os.scandir(os.path.join(folder, "snapshots")) if entry.is_dir()]
+        except FileNotFoundError:
+            return None
+        return max(snapshots, key=lambda entry: entry.stat().st_mtime).path if snapshots else None
+
+    def stamp(self, folder: str) -> tuple:
+        stamp = []
+        for sub in ("", "refs", "snapshots", "blobs"):
+            try:
+                stamp.append(os.stat(os.path.join(folder, sub)).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def refresh(self):
+        with self.lock:
+            try:
+                folders = [entry for entry in os.scandir(self.cache_dir)
+                           if entry.is_dir() and entry.name.startswith("models--")]
+            except FileNotFoundError:
+                folders = []
+            seen = set()
+            for entry in folders:
+                repo = entry.name.removeprefix("models--").replace('--', '/')
+                seen.add(repo)
+                stamp = self.stamp(entry.path)
+                if self.stamps.get(repo) == stamp:
+                    continue
+                self.stamps[repo] = stamp
+                path = self.snapshot_path(entry.path)
+                info = scan_snapshot(path) if path else None
+                if info:
+                    self.repos[repo] = info
+                else:
+                    self.repos.pop(repo, None)
+            for repo in set(self.stamps) - seen:
+                del self.stamps[repo]
+                self.repos.pop(repo, None)
+
+    def find(self, repo_name: str) -> Optional[dict]:
+        self.refresh()
+        if os.path.isdir(repo_name):
+            return scan_snapshot(repo_name)
+        with self.lock:
+            for repo, info in self.repos.items():
+                if repo.lower() == repo_name.strip().lower():
+                    return info
+        return None
+
+    def resolve(self, repo_name: str, variant: str = None) -> Optional[str]:
+        info = self.find(repo_name)
+        if info is None or (variant or DEFAULT_VARIANT) not in info['variants']:
+            return None
+        return info['path']
+
+    def invalidate(self, repo_name: str = None):
+        with self.lock:
+            if repo_name is None:
+                self.stamps.clear()
+            else:
+                self.stamps.pop(repo_name, None)
+
+    def available(self) -> dict:
+        self.refresh()
+        with self.lock:
+            return dict(self.repos)
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def catalog_for(cache_dir: str) -> ModelCatalog:
+    cache_dir = os.path.realpath(cache_dir)
+    with _catalogs_lock:
+        if cache_dir not in _catalogs:
+            _catalogs[cache_dir] = ModelCatalog(cache_dir)
+        return _catalogs[cache_dir]
+
+
+def describe(info: Optional[dict]) -> str:
+    if info is None:
+        return "not in cache"
+    return ", ".join(
+        f"{variant} ({'/'.join(value['dtypes']) or '?'}, {value['size'] / (1 << 30):.2f} GB)"
+        for variant, value in sorted(info['variants'].items())
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List complete models in HuggingFace cache directory")
+    parser.add_argument('cache_dir', nargs='?', default="cache")
+    args = parser.parse_args(argv)
+    repos = catalog_for(args.cache_dir).available()
+    for repo, info in sorted(repos.items()):
+        print(f"{repo}\t{info['pipeline']}\t{describe(info)}")
+    if not repos:
+        print("No complete models found", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import os
+import re
+import json
+import time
+import shutil
+import inspect
+import warnings
+import torch
+import onnxruntime as ort
+import torch.nn.functional as F
+from diffusers.models.attention_processor import Attention, AttnProcessor2_0
+from diffusers.models.autoencoders.vae import DecoderOutput
+from diffusers.models.unets.unet_2d_condition import UNet2DConditionOutput
+from transformers.modeling_outputs import BaseModelOutputWithPooling
+
+from diffusershandler import DiffusersHandler
+from utils import repo_key, atomic_write
+
+
+OPSET = 17
+EXPORT_FILE = "export.json"
+
+
+def cpu_threads() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def to_numpy(value: torch.Tensor, dtype=torch.float32):
+    return value.detach().to("cpu", dtype).contiguous().numpy()
+
+
+def used(args: tuple, kwargs: dict) -> bool:
+    # Arguments the exported graphs do not take: a call with any of them runs the torch module
+    return bool(args) or any(
+        value is not None and not (isinstance(value, dict) and not value) for value in kwargs.values()
+    )
+
+
+class MultiHeadAttention(torch.autograd.Function):
+    # Exported as one fused attention node of ONNX Runtime instead of matmul/softmax over the whole score matrix
+    @staticmethod
+    def forward(ctx, query, key, value, heads: int, scale: float):
+        batch, length, _ = query.shape
+        query, key, value = (
+            item.view(batch, -1, heads, item.shape[-1] // heads).transpose(1, 2) for item in (query, key, value)
+        )
+        output = F.scaled_dot_product_attention(query, key, value, scale=scale)
+        return output.transpose(1, 2).reshape(batch, length, -1)
+
+    @staticmethod
+    def symbolic(g, query, key, value, heads: int, scale: float):
+        output = g.op("com.microsoft::MultiHeadAttention", query, key, value, num_heads_i=heads, scale_f=scale)
+        output.setType(query.type())
+        return output
+
+
+class ExportAttnProcessor:
+    # AttnProcessor2_0 with the fused attention core, used only while tracing the export
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None,
+                 *args, **kwargs):
+        if attention_mask is not None or attn.spatial_norm is not None or getattr(attn, 'norm_q', None) is not None:
+            return AttnProcessor2_0()(attn, hidden_states, encoder_hidden_states, attention_mask, temb)
+        residual = hidden_states
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch, channels, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch, channels, height * width).transpose(1, 2)
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+        hidden_states = MultiHeadAttention.apply(
+            attn.to_q(hidden_states), attn.to_k(encoder_hidden_states), attn.to_v(encoder_hidden_states),
+            attn.heads, attn.scale
+        )
+        hidden_states = attn.to_out[1](attn.to_out[0](hidden_states))
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch, channels, height, width)
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+        return hidden_states / attn.rescale_output_factor
+
+
+class UNetExport(torch.nn.Module):
+    def __init__(self, unet):
+        super(UNetExport, self).__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states, text_embeds=None, time_ids=None):
+        added_cond_kwargs = {'text_embeds': text_embeds, 'time_ids': time_ids} if text_embeds is not None else None
+        return self.unet(
+            sample, timestep, encoder_hidden_states, added_cond_kwargs=added_cond_kwargs, return_dict=False
+        )[0]
+
+
+class TextEncoderExport(torch.nn.Module):
+    def __init__(self, text_encoder):
+        super(TextEncoderExport, self).__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, input_ids):
+        outputs = self.text_encoder(input_ids, return_dict=False)
+        return outputs[0], outputs[1]
+
+
+class DecoderExport(torch.nn.Module):
+    def __init__(self, vae):
+        super(DecoderExport, self).__init__()
+        self.vae = vae
+
+    def forward(self, latent):
+        return self.vae.decode(latent, return_dict=False)[0]
+
+
+def export_specs(pipe) -> dict:
+    # Example inputs and dynamic axes of every exported component; components that do not fit stay in torch
+    specs = {}
+    unet = pipe.unet
+    if unet.config.addition_embed_type in (None, "text_time") and isinstance(unet.config.cross_attention_dim, int):
+        # Latent size not divisible by the upsampling factor, so the traced graph takes skip connection sizes
+        factor = 2 ** unet.num_upsamplers
+        size = factor + factor // 2 if factor > 1 else 8
+        inputs = {
+            'sample': torch.randn(2, unet.config.in_channels, size, size),
+            'timestep': torch.tensor([500.0, 500.0]),
+            'encoder_hidden_states': torch.randn(2, 77, unet.config.cross_attention_dim)
+        }
+        axes = {
+            'sample': {0: "batch", 2: "height", 3: "width"}, 'timestep': {0: "batch"},
+            'encoder_hidden_states': {0: "batch", 1: "sequence"}, 'noise': {0: "batch", 2: "height", 3: "width"}
+        }
+        if unet.config.addition_embed_type == "text_time":
+            time_ids = 6
+            inputs['text_embeds'] = torch.randn(
+                2, unet.config.projection_class_embeddings_input_dim - time_ids * unet.config.addition_time_embed_dim
+            )
+            inputs['time_ids'] = torch.randn(2, time_ids)
+            axes.update(text_embeds={0: "batch"}, time_ids={0: "batch"})
+        specs['unet'] = (UNetExport(unet), inputs, ['noise'], axes)
+    text_encoder = getattr(pipe, 'text_encoder', None)
+    if text_encoder is not None and type(text_encoder).__name__ == "CLIPTextModel":
+        length = pipe.tokenizer.model_max_length
+        specs['text_encoder'] = (
+            TextEncoderExport(text_encoder), {'input_ids': torch.zeros(2, length, dtype=torch.int64)},
+            ['last_hidden_state', 'pooler_output'],
+            {'input_ids': {0: "batch", 1: "sequence"}, 'last_hidden_state': {0: "batch", 1: "sequence"},
+             'pooler_output': {0: "batch"}}
+        )
+    vae = pipe.vae
+    specs['vae_decoder'] = (
+        DecoderExport(vae), {'latent': torch.randn(1, vae.config.latent_channels, 8, 8)}, ['image'],
+        {'latent': {0: "batch", 2: "height", 3: "width"}, 'image': {0: "batch", 2: "height", 3: "width"}}
+    )
+    return specs
+
+
+def exported(folder: str) -> list:
+    with open(os.path.join(folder, EXPORT_FILE), 'rt', encoding='utf-8') as file:
+        return json.load(file)['components']
+
+
+def export_pipeline(pipe, folder: str) -> list:
+    try:
+        return exported(folder)
+    except (OSError, ValueError, KeyError):
+        pass
+    # Components are written to a temporary folder first, so an interrupted export is never picked up
+    tmp_folder = folder + ".tmp"
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    os.makedirs(tmp_folder)
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    specs = export_specs(pipe)
+    processors = [
+        (module, module.processor) for component in (pipe.unet, pipe.vae)
+        for module in component.modules() if isinstance(module, Attention)
+    ]
+    try:
+        for module, _ in processors:
+            module.set_processor(ExportAttnProcessor())
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for name, (module, inputs, outputs, axes) in specs.items():
+                torch.onnx.export(
+                    module, tuple(inputs.values()), os.path.join(tmp_folder, f"{name}.onnx"),
+                    input_names=list(inputs), output_names=outputs, dynamic_axes=axes, opset_version=OPSET,
+                    custom_opsets={'com.microsoft': 1}, **options
+                )
+    finally:
+        for module, processor in processors:
+            module.set_processor(processor)
+    atomic_write(os.path.join(tmp_folder, EXPORT_FILE), json.dumps({
+        'components': list(specs), 'opset': OPSET, 'torch': torch.__version__, 'exported': time.time()
+    }, indent=2))
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+    return list(specs)
+
+
+def unet_forward(session, torch_forward):
+    added_inputs = {item.name for item in session.get_inputs()} & {'text_embeds', 'time_ids'}
+
+    def forward(sample, timestep, encoder_hidden_states, *args, added_cond_kwargs=None, return_dict=True, **kwargs):
+        if used(args, kwargs) or set(added_cond_kwargs or {}) != added_inputs:
+            return torch_forward(
+                sample, timestep, encoder_hidden_states, *args, added_cond_kwargs=added_cond_kwargs,
+                return_dict=return_dict, **kwargs
+            )
+        batch = sample.shape[0]
+        feed = {
+            'sample': to_numpy(sample),
+            'timestep': to_numpy(torch.as_tensor(timestep).reshape(-1).expand(batch)),
+            'encoder_hidden_states': to_numpy(encoder_hidden_states)
+        }
+        if added_cond_kwargs:
+            feed['text_embeds'] = to_numpy(added_cond_kwargs['text_embeds'])
+            feed['time_ids'] = to_numpy(added_cond_kwargs['time_ids'])
+        noise = torch.from_numpy(session.run(None, feed)[0]).to(sample.device, sample.dtype)
+        return UNet2DConditionOutput(sample=noise) if return_dict else (noise,)
+    return forward
+
+
+def text_encoder_forward(session, torch_forward):
+    def forward(input_ids, *args, **kwargs):
+        if used(args, kwargs):
+            return torch_forward(input_ids, *args, **kwargs)
+        hidden, pooled = session.run(None, {'input_ids': to_numpy(input_ids, torch.int64)})
+        return BaseModelOutputWithPooling(
+            last_hidden_state=torch.from_numpy(hidden).to(input_ids.device),
+            pooler_output=torch.from_numpy(pooled).to(input_ids.device)
+        )
+    return forward
+
+
+def decoder_forward(session):
+    def decode(z, return_dict=True, generator=None):
+        image = torch.from_numpy(session.run(None, {'latent': to_numpy(z)})[0]).to(z.device, z.dtype)
+        return DecoderOutput(sample=image) if return_dict else (image,)
+    return decode
+
+
+class OnnxHandler(DiffusersHandler):
+    # CPU engine: text encoder, UNet and VAE decoder run in ONNX Runtime sessions; they are exported once per model
+    # into cache_dir, everything around them (tokenizers, schedulers, img2img, hires, queue) is the diffusers code
+    def __init__(self, cache_dir="cache", threads: int = 0, **kwargs):
+        kwargs.update(use_cuda=False, use_float16=False, residency="resident", thread_tuning=False)
+        super(OnnxHandler, self).__init__(cache_dir=cache_dir, **kwargs)
+        self.threads = threads or cpu_threads()
+        torch.set_num_threads(self.threads)
+        self.device_opts = dict(self.device_opts, engine=f"onnxruntime {ort.__version__}", threads=self.threads)
+
+    def export_folder(self, model: dict) -> str:
+        name = re.sub(r'[^\w.-]+', "_", repo_key(model['repo'])).strip("_")
+        return os.path.join(self.cache_dir, "onnx", f"{name}-{model['variant']}")
+
+    def session(self, path: str):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def load_pipeline(self, repo_name: str, connect: bool = True, progress=None):
+        super(OnnxHandler, self).load_pipeline(repo_name, connect=connect, progress=progress)
+        if 'sessions' in self.curr:
+            return
+        pipe = self.curr['txt2img']
+        folder = self.export_folder(self.curr['model'])
+        start = time.perf_counter()
+        if progress is not None and not os.path.isfile(os.path.join(folder, EXPORT_FILE)):
+            progress({'stage': "Exporting to ONNX", 'stage_index': 0, 'stages': 1, 'step': 0, 'steps': 1, 'eta': None})
+        components = export_pipeline(pipe, folder)
+        sessions = {name: self.session(os.path.join(folder, f"{name}.onnx")) for name in components}
+        # Forward methods are replaced on the module instances, so img2img made from this pipeline runs them as well
+        if 'unet' in sessions:
+            pipe.unet.forward = unet_forward(sessions['unet'], pipe.unet.forward)
+        if 'text_encoder' in sessions:
+            pipe.text_encoder.forward = text_encoder_forward(sessions['text_encoder'], pipe.text_encoder.forward)
+        if 'vae_decoder' in sessions:
+            pipe.vae.decode = decoder_forward(sessions['vae_decoder'])
+        self.curr['sessions'] = sessions
+        self.curr['model'] = dict(self.curr['model'], engine="onnx")
+        self.curr['load_time'] = round(self.curr['load_time'] + time.perf_counter() - start, 3)
+
+    def set_loras(self, loras: list = None, fuse: bool = False) -> list:
+        if loras:
+            raise ValueError("LoRA adapters are not supported by the ONNX engine")
+        return []
+
+    def run(self, *args, **kwargs):
+        # Feature caching and token merging patch torch blocks, which the exported UNet does not run
+        kwargs.update(step_cache=0, token_merge=0.0)
+        return super(OnnxHandler, self).run(*args, **kwargs)
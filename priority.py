@@ -0,0 +1,71 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Preempted(Exception):
+    pass
+
+
+class PriorityLock:
+    # Reentrant lock that lets interactive callers in ahead of batch work; batch holders poll should_yield()
+    # at step boundaries and release the lock after saving a checkpoint
+    def __init__(self, min_slice: float = 1.0):
+        self.condition = threading.Condition(threading.Lock())
+        self.min_slice = min_slice
+        self.owner = None
+        self.depth = 0
+        self.batch_owner = False
+        self.granted = 0.0
+        self.waiting = 0
+
+    def acquire(self, batch: bool = False):
+        me = threading.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.depth += 1
+                return True
+            if not batch:
+                self.waiting += 1
+            try:
+                while self.owner is not None or (batch and self.waiting):
+                    self.condition.wait()
+            finally:
+                if not batch:
+                    self.waiting -= 1
+            self.owner, self.depth, self.batch_owner = me, 1, batch
+            self.granted = time.monotonic()
+            return True
+
+    def release(self):
+        with self.condition:
+            if self.owner != threading.get_ident():
+                raise RuntimeError("Cannot release un-acquired lock")
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @contextmanager
+    def batch(self):
+        self.acquire(batch=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def locked(self) -> bool:
+        with self.condition:
+            return self.owner is not None
+
+    def should_yield(self) -> bool:
+        # A batch holder keeps the lock for at least min_slice seconds, so it progresses between preemptions
+        with self.condition:
+            return self.batch_owner and self.waiting > 0 and time.monotonic() - self.granted >= self.min_slice
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import threading
+
+from utils import atomic_write
+
+
+HISTORY_FILE = "timings.json"
+
+
+class TimingHistory:
+    def __init__(self, cache_dir: str, alpha: float = 0.3):
+        self.filename = os.path.join(cache_dir, HISTORY_FILE)
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename, 'rt', encoding='utf-8') as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(model: dict, width: int, height: int, batch: int, kind: str = "txt2img") -> str:
+        return "|".join([
+            model['repo'], f"{width}x{height}", model['dtype'], model['scheduler'], str(batch), kind
+        ] + ([model['engine']] if 'engine' in model else []))
+
+    @staticmethod
+    def load_key(repo_name: str, dtype: str, local: bool) -> str:
+        return "|".join(["load", repo_name, dtype, "local" if local else "hub"])
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry else None
+
+    def update(self, key: str, **values):
+        with self.lock:
+            entry = self.entries.setdefault(key, {'count': 0})
+            for name, value in values.items():
+                old = entry.get(name)
+                entry[name] = round(value if old is None else old + self.alpha * (value - old), 4)
+            entry['count'] += 1
+
+    def save(self):
+        with self.lock:
+            text = json.dumps(self.entries, indent=1, sort_keys=True)
+        atomic_write(self.filename, text)
+
+    def predict(self, key: str, steps: int):
+        entry = self.get(key)
+        if entry is None or 'step' not in entry:
+            return None
+        return steps * entry['step'] + entry.get('decode', 0)
+
+
+class RunProgress:
+    def __init__(self, history: TimingHistory, stages: list, callback=None):
+        # stages: list of (name, history key, steps)
+        self.history = history
+        self.stages = [list(stage) for stage in stages]
+        self.callback = callback
+        self.index = -1
+        self.stage_start = self.last_step = time.perf_counter()
+        self.step = self.first = 0
+
+    def predicted(self, index: int):
+        name, key, steps = self.stages[index]
+        return self.history.predict(key, steps)
+
+    def expected(self):
+        predictions = [self.predicted(index) for index in range(len(self.stages))]
+        return None if None in predictions else round(sum(predictions), 3)
+
+    def start(self, steps: int = None, done: int = 0):
+        # done: steps finished before a resume, they are not timed again
+        self.index += 1
+        if steps is not None:
+            self.stages[self.index][2] = steps
+        self.stage_start = self.last_step = time.perf_counter()
+        self.step = self.first = done
+        self.report()
+
+    def on_step(self, step: int, steps: int = None):
+        if steps:
+            self.stages[self.index][2] = steps
+        self.step = step + 1
+        self.last_step = time.perf_counter()
+        self.report()
+
+    def end(self):
+        name, key, steps = self.stages[self.index]
+        now = time.perf_counter()
+        if self.step > self.first:
+            self.history.update(
+                key, step=(self.last_step - self.stage_start) / (self.step - self.first), decode=now - self.last_step
+            )
+
+    def eta(self):
+        name, key, steps = self.stages[self.index]
+        entry = self.history.get(key) or {}
+        if self.step > self.first:
+            step_time = (self.last_step - self.stage_start) / (self.step - self.first)
+        elif 'step' in entry:
+            step_time = entry['step']
+        else:
+            return None
+        remaining = (steps - self.step) * step_time + entry.get('decode', step_time)
+        for index in range(self.index + 1, len(self.stages)):
+            predicted = self.predicted(index)
+            if predicted is None:
+                return None
+            remaining += predicted
+        return max(remaining - (time.perf_counter() - self.last_step), 0)
+
+    def report(self):
+        if self.callback is None:
+            return
+        name, key, steps = self.stages[self.index]
+        self.callback({
+            'stage': name,
+            'stage_index': self.index,
+            'stages': len(self.stages),
+            'step': self.step,
+            'steps': steps,
+            'eta': self.eta()
+        })
+
+    def step_callback(self):
+        def callback(pipe, step, timestep, callback_kwargs):
+            self.on_step(step, getattr(pipe, 'num_timesteps', None))
+            return callback_kwargs
+        return callback
@@ -0,0 +1,281 @@
+import os
+import json
+import mmap
+import inspect
+import weakref
+import importlib
+from collections import OrderedDict
+import torch
+from accelerate import init_empty_weights
+
+from modelcatalog import component_weights, SAFETENSORS_DTYPES, DEFAULT_VARIANT
+from memory import available_memory, free_memory
+
+
+POLICIES = ('resident', 'lazy', 'minimal')
+# Components whose weights are dropped between uses; the UNet runs on every step and stays mapped
+RELEASED = {'text_encoder': ['forward'], 'text_encoder_2': ['forward'], 'vae': ['encode', 'decode']}
+ENCODERS = ('text_encoder', 'text_encoder_2')
+
+
+def tensor_infos(file) -> tuple:
+    length = int.from_bytes(file.read(8), 'little')
+    header = json.loads(file.read(length))
+    header.pop('__metadata__', None)
+    return 8 + length, {
+        name: (getattr(torch, SAFETENSORS_DTYPES.get(info['dtype'], info['dtype'].lower())), info)
+        for name, info in header.items()
+    }
+
+
+def mmap_safetensors(filename: str) -> dict:
+    # Tensors share the pages of a private (copy-on-write) file mapping, nothing is read before it is used
+    with open(filename, 'rb') as file:
+        start, infos = tensor_infos(file)
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    tensors = {}
+    for name, (dtype, info) in infos.items():
+        begin, end = info['data_offsets']
+        count = (end - begin) // dtype.itemsize
+        tensor = torch.frombuffer(mapped, dtype=dtype, count=count, offset=start + begin) if count \
+            else torch.empty(0, dtype=dtype)
+        tensors[name] = tensor.reshape(info['shape'])
+    return tensors
+
+
+def read_safetensors(filename: str, convert) -> dict:
+    # Tensor by tensor, each one converted right away: the peak is the converted size plus one tensor
+    tensors = {}
+    with open(filename, 'rb') as file:
+        start, infos = tensor_infos(file)
+        for name, (dtype, info) in infos.items():
+            begin, end = info['data_offsets']
+            file.seek(start + begin)
+            data = bytearray(file.read(end - begin))
+            tensor = torch.frombuffer(data, dtype=dtype) if data else torch.empty(0, dtype=dtype)
+            tensors[name] = convert(tensor.reshape(info['shape']))
+    return tensors
+
+
+def placeholder(tensor: torch.Tensor) -> torch.Tensor:
+    # Same shape, dtype and device without memory, so pipelines can still ask a released module for its device
+    return torch.zeros(1, dtype=tensor.dtype, device=tensor.device).expand(tensor.shape)
+
+
+class MappedModule:
+    def __init__(self, module, files: list, dtype):
+        self.module = weakref.ref(module)
+        self.files = files
+        self.dtype = dtype
+        self.keys = list(module.state_dict().keys())
+        self.resident = True
+        self.pinned = False
+        self.released = False
+
+    def weights(self, dtype) -> dict:
+        state = {}
+        for filename in self.files:
+            state.update(mmap_safetensors(filename))
+        if not any(self.converts(tensor, dtype) for tensor in state.values()):
+            return {key: state[key] for key in self.keys}
+        # Converted tensors are copies anyway, reading them keeps the source pages out of the process
+        del state
+        converted = {}
+        for filename in self.files:
+            converted.update(read_safetensors(
+                filename, lambda tensor: tensor.to(dtype) if self.converts(tensor, dtype) else tensor
+            ))
+        return {key: converted[key] for key in self.keys}
+
+    @staticmethod
+    def converts(tensor: torch.Tensor, dtype) -> bool:
+        return isinstance(dtype, torch.dtype) and tensor.is_floating_point() and tensor.dtype != dtype
+
+    @staticmethod
+    def current_dtype(module):
+        return next((tensor.dtype for tensor in module.state_dict().values() if tensor.is_floating_point()), None)
+
+    def materialize(self):
+        module = self.module()
+        if module is not None and not self.resident:
+            # A released module keeps the dtype of its placeholders, which a cast (VAE upcast) may have changed since
+            dtype = (self.current_dtype(module) or self.dtype) if self.released else self.dtype
+            module.load_state_dict(self.weights(dtype), strict=True, assign=True)
+            module.requires_grad_(False)
+            self.resident = True
+
+    def release(self):
+        module = self.module()
+        if module is None or not self.resident or self.pinned:
+            return
+        for key in self.keys:
+            owner_name, _, name = key.rpartition('.')
+            owner = module.get_submodule(owner_name)
+            if name in owner._parameters:
+                owner._parameters[name] = torch.nn.Parameter(placeholder(owner._parameters[name]), requires_grad=False)
+            elif name in owner._buffers:
+                owner._buffers[name] = placeholder(owner._buffers[name])
+        self.resident = False
+        self.released = True
+
+
+def load_mapped(folder: str, library: str, class_name: str, variant: str = None, dtype="auto"):
+    files = component_weights(folder).get(variant or DEFAULT_VARIANT)
+    if not files or not all(filename.endswith(".safetensors") for filename in files):
+        return None
+    try:
+        cls = getattr(importlib.import_module(library), class_name)
+        with init_empty_weights():
+            if library == "diffusers":
+                module = cls.from_config(cls.load_config(folder))
+            else:
+                module = cls(cls.config_class.from_pretrained(folder))
+        state = {}
+        for filename in files:
+            state.update(mmap_safetensors(filename))
+        expected = module.state_dict()
+        if any(key not in state or state[key].shape != value.shape for key, value in expected.items()):
+            return None
+        entry = MappedModule(module, files, dtype)
+        entry.resident = False
+        entry.materialize()
+    except (OSError, ValueError, AttributeError, KeyError, RuntimeError, TypeError):
+        return None
+    module.eval()
+    return module, entry
+
+
+class PromptCache:
+    # Prompt embeddings by encode_prompt arguments; a hit needs no text encoder at all
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def encoder_ids(pipe) -> tuple:
+        return tuple(id(getattr(pipe, name, None)) for name in ENCODERS)
+
+    @staticmethod
+    def key(pipe, call, args: tuple, kwargs: dict):
+        encoders = [getattr(pipe, name, None) for name in ENCODERS]
+        if any(getattr(encoder, 'peft_config', None) for encoder in encoders):
+            return None
+        try:
+            bound = inspect.signature(call).bind(*args, **kwargs)
+        except TypeError:
+            return None
+        bound.apply_defaults()
+        if any(torch.is_tensor(value) for value in bound.arguments.values()):
+            return None
+        # Pipelines of different models share classes and arguments, only their encoders tell them apart
+        return PromptCache.encoder_ids(pipe), repr(
+            (type(pipe).__name__, sorted((name, str(value)) for name, value in bound.arguments.items()))
+        )
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def forget(self, pipe):
+        # Called on eviction: ids of freed encoders can be reused by the next model
+        ids = self.encoder_ids(pipe)
+        for key in [key for key in self.entries if key[0] == ids]:
+            del self.entries[key]
+
+
+class Residency:
+    # Text encoders and VAE of memory-mapped pipelines are materialized only for their calls and dropped afterwards: always with 'minimal', when available memory is below `reserve` with 'lazy'
+    def __init__(self, policy: str = "lazy", device: str = "cpu", reserve: int = 4 << 30):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown residency policy '{policy}', expected one of: {', '.join(POLICIES)}")
+        self.policy = policy
+        self.device = device
+        self.reserve = reserve
+        self.entries = weakref.WeakKeyDictionary()
+        self.prompt_cache = PromptCache()
+
+    def map_components(self, path: str, variant: str = None, dtype="auto", exclude=()) -> dict:
+        try:
+            with open(os.path.join(path, "model_index.json"), 'rt') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        modules = {}
+        for name, value in index.items():
+            if name.startswith('_') or name in exclude or not isinstance(value, list) or value[0] is None:
+                continue
+            library, class_name = value
+            if library not in ("diffusers", "transformers"):
+                continue
+            loaded = load_mapped(os.path.join(path, name), library, class_name, variant, dtype)
+            if loaded is not None:
+                modules[name], self.entries[loaded[0]] = loaded
+                if name in RELEASED:
+                    # Dropped right away, converted copies of one component are gone before the next one loads
+                    loaded[1].release()
+                    free_memory(self.device)
+        return modules
+
+    def use(self, entries: list, call):
+        def wrapped(*args, **kwargs):
+            for entry in entries:
+                entry.materialize()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                self.after_use(entries)
+        return wrapped
+
+    def after_use(self, entries: list):
+        if self.policy == "lazy":
+            available = available_memory(self.device)
+            if available is None or available >= self.reserve:
+                return
+        for entry in entries:
+            entry.release()
+        free_memory(self.device)
+
+    def attach(self, pipe):
+        encoders = []
+        for name, methods in RELEASED.items():
+            module = getattr(pipe, name, None)
+            entry = self.entries.get(module) if module is not None else None
+            if entry is None:
+                continue
+            if name.startswith('text_encoder'):
+                # Encoders are needed for the whole encode_prompt, it also runs their layers after forward (clip skip)
+                encoders.append(entry)
+            elif not getattr(module, 'residency_wrapped', False):
+                for method in methods:
+                    setattr(module, method, self.use([entry], getattr(module, method)))
+                module.residency_wrapped = True
+        if encoders and hasattr(pipe, 'encode_prompt') and 'encode_prompt' not in pipe.__dict__:
+            pipe.encode_prompt = self.cached_encode(pipe, self.use(encoders, pipe.encode_prompt))
+
+    def cached_encode(self, pipe, encode):
+        signature_call = pipe.encode_prompt
+
+        def encode_prompt(*args, **kwargs):
+            key = self.prompt_cache.key(pipe, signature_call, args, kwargs)
+            cached = self.prompt_cache.get(key) if key is not None else None
+            if cached is not None:
+                return cached
+            result = encode(*args, **kwargs)
+            if key is not None:
+                self.prompt_cache.put(key, result)
+            return result
+        return encode_prompt
+
+    def pin(self, module):
+        # Adapters and fused weights live in the module, so it has to stay as it is from now on
+        entry = self.entries.get(module) if module is not None else None
+        if entry is not None:
+            entry.materialize()
+            entry.pinned = True
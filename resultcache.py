@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from utils import params_hash
+
+
+INDEX_FILE = "index.sqlite"
+
+
+class ResultCache:
+    def __init__(self, root: str, max_bytes: int = 1 << 30):
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, INDEX_FILE), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, size INTEGER, last_access REAL, nsfw TEXT, params TEXT)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS results_access ON results(last_access)")
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="result cache")
+
+    @staticmethod
+    def key(params: dict) -> str:
+        # Only the device type changes the pixels; host details, thread counts and the allocator do not
+        device = (params.get('device') or {}).get('type')
+        return params_hash(dict(params, device=device), exclude=('timings', 'image_index'))
+
+    def image_path(self, key: str, index: int) -> str:
+        return os.path.join(self.root, key[:2], f"{key}_{index}.png")
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.db.execute("SELECT nsfw, params FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        flags, params = json.loads(row[0]), json.loads(row[1])
+        output = []
+        try:
+            for index, nsfw in enumerate(flags):
+                if nsfw:
+                    output.append((None, params[index]))
+                else:
+                    with Image.open(self.image_path(key, index)) as image:
+                        image.load()
+                    output.append((image, params[index]))
+        except (FileNotFoundError, OSError):
+            self.remove(key)
+            return None
+        with self.lock, self.db:
+            self.db.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        return output
+
+    def put(self, key: str, output: list):
+        # PNG encoding runs on the writer thread, off the generation path; the entry is indexed once its files exist
+        nsfw = json.dumps([image is None for image, _ in output])
+        params = json.dumps([params for _, params in output], default=str)
+        self.writer.submit(self.store, key, [image for image, _ in output], nsfw, params)
+
+    def store(self, key: str, images: list, nsfw: str, params: str):
+        size = 0
+        os.makedirs(os.path.dirname(self.image_path(key, 0)), exist_ok=True)
+        for index, image in enumerate(images):
+            if image is not None:
+                filename = self.image_path(key, index)
+                image.save(filename + ".tmp", format='PNG')
+                os.replace(filename + ".tmp", filename)
+                size += os.path.getsize(filename)
+        row = (key, size, time.time(), nsfw, params)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results(key, size, last_access, nsfw, params) VALUES (?, ?, ?, ?, ?)", row
+            )
+        self.evict()
+
+    def remove(self, key: str):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT nsfw FROM results WHERE key = ?", (key,)).fetchone()
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+        if row is not None:
+            for index in range(len(json.loads(row[0]))):
+                try:
+                    os.remove(self.image_path(key, index))
+                except FileNotFoundError:
+                    pass
+
+    def total_size(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def evict(self):
+        total = self.total_size()
+        while total > self.max_bytes:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT key, size FROM results ORDER BY last_access LIMIT 32"
+                ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.remove(key)
+                total -= size
+                if total <= self.max_bytes:
+                    break
@@ -0,0 +1,163 @@
+import inspect
+import numpy as np
+import torch
+
+from utils import array_image
+
+
+def is_sdxl(pipe) -> bool:
+    return getattr(pipe, 'text_encoder_2', None) is not None or getattr(pipe, 'tokenizer_2', None) is not None
+
+
+def encode(pipe, prompt: str, negative_prompt: str, device, cfg: bool = True) -> dict:
+    # Without classifier-free guidance the negative prompt is not needed
+    if is_sdxl(pipe):
+        cond, uncond, pooled, uncond_pooled = pipe.encode_prompt(
+            prompt=prompt, device=device, num_images_per_prompt=1,
+            do_classifier_free_guidance=cfg, negative_prompt=negative_prompt
+        )
+        embeds = {'cond': cond, 'pooled': pooled}
+        if cfg:
+            embeds.update(uncond=uncond, uncond_pooled=uncond_pooled)
+        return embeds
+    cond, uncond = pipe.encode_prompt(
+        prompt, device, 1, cfg, negative_prompt=negative_prompt
+    )
+    return {'cond': cond, 'uncond': uncond} if cfg else {'cond': cond}
+
+
+def latent_shape(pipe, width: int, height: int) -> tuple:
+    return 1, pipe.unet.config.in_channels, height // pipe.vae_scale_factor, width // pipe.vae_scale_factor
+
+
+def make_generators(seeds: list, device) -> list:
+    return [torch.Generator(device).manual_seed(seed) for seed in seeds]
+
+
+def initial_latents(pipe, seeds: list, width: int, height: int, device, dtype, generators: list = None) -> torch.Tensor:
+    # One generator per seed, same draw as a single-image run with that seed
+    shape = latent_shape(pipe, width, height)
+    generators = generators or make_generators(seeds, device)
+    latents = [torch.randn(shape, generator=generator, device=device, dtype=dtype) for generator in generators]
+    return torch.cat(latents)
+
+
+def make_scheduler(pipe, num_inference_steps: int, device):
+    scheduler = pipe.scheduler.__class__.from_config(pipe.scheduler.config)
+    scheduler.set_timesteps(num_inference_steps, device=device)
+    return scheduler
+
+
+def unet_kwargs(pipe, embeds: dict, batch: int, cfg: bool, width: int, height: int) -> dict:
+    cond = embeds['cond'].expand(batch, -1, -1)
+    if cfg:
+        cond = torch.cat([embeds['uncond'].expand(batch, -1, -1), cond])
+    kwargs = {'encoder_hidden_states': cond}
+    if 'pooled' in embeds:
+        pooled = embeds['pooled'].expand(batch, -1)
+        if cfg:
+            pooled = torch.cat([embeds['uncond_pooled'].expand(batch, -1), pooled])
+        time_ids = torch.tensor([[height, width, 0, 0, height, width]], dtype=cond.dtype, device=cond.device)
+        kwargs['added_cond_kwargs'] = {'text_embeds': pooled, 'time_ids': time_ids.expand(pooled.shape[0], -1)}
+    return kwargs
+
+
+def guidance_steps(steps: int, truncation: float) -> int:
+    # Guidance is kept for the first steps only, the last `truncation` share of steps uses the conditional branch
+    return max(steps - int(steps * truncation), 1)
+
+
+def callback_inputs(pipe) -> list:
+    return [
+        name for name in ('latents', 'prompt_embeds', 'add_text_embeds', 'add_time_ids')
+        if name in pipe._callback_tensor_inputs
+    ]
+
+
+def truncate_guidance(truncation: float, callback=None):
+    # Step end callback for the diffusers pipelines: drops the unconditional half of the batch once guidance ends
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        if pipe.do_classifier_free_guidance and step + 1 == guidance_steps(pipe.num_timesteps, truncation):
+            pipe._guidance_scale = 0.0
+            for name in ('prompt_embeds', 'add_text_embeds', 'add_time_ids'):
+                if name in callback_kwargs:
+                    callback_kwargs[name] = callback_kwargs[name].chunk(2)[-1]
+        return callback(pipe, step, timestep, callback_kwargs) if callback is not None else callback_kwargs
+    return on_step_end
+
+
+def denoise(pipe, latents: torch.Tensor, embeds: dict, scheduler, guidance,
+            width: int, height: int, start: int = 0, callback=None, generator=None,
+            guidance_end: int = None) -> torch.Tensor:
+    batch = latents.shape[0]
+    guidance = torch.as_tensor(guidance, dtype=latents.dtype, device=latents.device).reshape(-1)
+    guidance = guidance.expand(batch) if guidance.numel() == 1 else guidance
+    cfg = bool((guidance > 1).any())
+    kwargs = unet_kwargs(pipe, embeds, batch, cfg, width, height)
+    cond_kwargs = unet_kwargs(pipe, embeds, batch, False, width, height) if cfg and guidance_end is not None else kwargs
+    scale = guidance.view(-1, 1, 1, 1)
+    # Stochastic schedulers draw their noise from the generators of the images, as in the pipelines
+    step_kwargs = {'generator': generator} \
+        if generator is not None and 'generator' in inspect.signature(scheduler.step).parameters else {}
+
+    timesteps = scheduler.timesteps
+    with torch.no_grad():
+        for i in range(start, len(timesteps)):
+            t = timesteps[i]
+            use_cfg = cfg and (guidance_end is None or i < guidance_end)
+            model_input = torch.cat([latents] * 2) if use_cfg else latents
+            model_input = scheduler.scale_model_input(model_input, t)
+            noise = pipe.unet(model_input, t, return_dict=False, **(kwargs if use_cfg else cond_kwargs))[0]
+            if use_cfg:
+                noise_uncond, noise_cond = noise.chunk(2)
+                noise = noise_uncond + scale * (noise_cond - noise_uncond)
+            latents = scheduler.step(noise, t, latents, return_dict=False, **step_kwargs)[0]
+            if callback is not None:
+                callback(i, t, latents)
+    return latents
+
+
+def decode(pipe, latents: torch.Tensor) -> torch.Tensor:
+    vae = pipe.vae
+    # Only pipelines that upcast on their own (SDXL) do it here; SD 1.5 decodes in float16 despite force_upcast
+    upcast = hasattr(pipe, 'upcast_vae') and vae.dtype == torch.float16 and getattr(vae.config, 'force_upcast', False)
+    with torch.no_grad():
+        if upcast:
+            vae.to(torch.float32)
+        latents = latents.to(vae.dtype)
+        mean, std = getattr(vae.config, 'latents_mean', None), getattr(vae.config, 'latents_std', None)
+        if mean is not None and std is not None:
+            shape = (1, latents.shape[1], 1, 1)
+            latents = latents * torch.tensor(std, dtype=latents.dtype, device=latents.device).view(shape) \
+                / vae.config.scaling_factor + torch.tensor(mean, dtype=latents.dtype, device=latents.device).view(shape)
+        else:
+            latents = latents / vae.config.scaling_factor
+        image = vae.decode(latents, return_dict=False)[0]
+        if upcast:
+            vae.to(torch.float16)
+    return image
+
+
+def safety_flags(pipe, batch: np.ndarray, device, dtype) -> list:
+    checker = getattr(pipe, 'safety_checker', None)
+    if checker is None or getattr(pipe, 'feature_extractor', None) is None:
+        return [False] * len(batch)
+    clip_input = pipe.feature_extractor(list(batch), return_tensors="pt").pixel_values.to(device, dtype)
+    _, flags = checker(images=batch, clip_input=clip_input)
+    return [bool(flag) for flag in flags]
+
+
+def to_uint8(pipe, image: torch.Tensor, device, dtype, block_nsfw: bool = True) -> tuple:
+    # Decoded images go to the host once, as a contiguous NxHxWx3 uint8 batch; blocked images are zeroed in place
+    if getattr(pipe, 'watermark', None) is not None:
+        image = pipe.watermark.apply_watermark(image)
+    image = (image / 2).add_(0.5).clamp_(0, 1).float().mul_(255).round_().to(torch.uint8)
+    batch = image.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+    flags = safety_flags(pipe, batch, device, dtype) if block_nsfw else [False] * len(batch)
+    batch[np.array(flags, dtype=bool)] = 0
+    return batch, flags
+
+
+def to_pil(pipe, image: torch.Tensor, device, dtype, block_nsfw: bool = True):
+    batch, flags = to_uint8(pipe, image, device, dtype, block_nsfw)
+    return [array_image(array) for array in batch], flags
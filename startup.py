@@ -0,0 +1,84 @@
+import time
+import threading
+
+START_TIME = time.perf_counter()
+marks = []
+
+
+def mark(stage: str, start: float = None):
+    now = time.perf_counter()
+    marks.append((stage, now - (start if start is not None else START_TIME), now - START_TIME))
+    return now
+
+
+def report() -> str:
+    lines = [f"{'Stage':<40}{'Duration, s':>12}{'At, s':>10}"]
+    for stage, duration, at in marks:
+        lines.append(f"{stage:<40}{duration:>12.3f}{at:>10.3f}")
+    return "\n".join(lines)
+
+
+class Warmup:
+    def __init__(self, handler_opts: dict, preload_repo: str = None, engine: str = "diffusers"):
+        self.handler_opts = handler_opts
+        self.engine = engine
+        self.preload_repo = preload_repo
+        self.status = "Starting"
+        self.handler = None
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.work, name="warmup", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def work(self):
+        try:
+            import engines
+            start = time.perf_counter()
+            if engines.uses_torch(self.engine):
+                self.status = "Importing torch"
+                import torch
+                start = mark("import torch", start)
+
+                self.status = "Importing diffusers"
+                import diffusers
+                from diffusers import AutoPipelineForText2Image, AutoPipelineForImage2Image
+                start = mark("import diffusers", start)
+
+            handler_class = engines.handler_class(self.engine)
+            start = mark(f"import {handler_class.__module__}", start)
+
+            self.status = "Probing device"
+            handler = handler_class(**self.handler_opts)
+            start = mark(f"device probe ({handler.device})", start)
+            self.handler = handler
+        except Exception as error:
+            self.error = error
+            self.status = "Startup failed"
+            self.done.set()
+            return
+
+        self.status = "Ready"
+        self.done.set()
+
+        if self.preload_repo:
+            self.status = f"Preloading {self.preload_repo}"
+            try:
+                with handler.lock:
+                    handler.load_pipeline(self.preload_repo, connect=False)
+                mark(f"preload {self.preload_repo}", start)
+                self.status = "Ready"
+            except Exception as error:
+                mark(f"preload failed: {type(error).__name__}", start)
+                self.status = "Ready (preload failed)"
+
+    def ready(self) -> bool:
+        return self.done.is_set()
+
+    def get(self, timeout: float = None):
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.handler
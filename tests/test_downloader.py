@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from downloader import DownloadManager, select_files, sha256
+
+
+REPO = "test/tiny-model"
+COMMIT = "0123456789abcdef"
+WEIGHTS = bytes(range(256)) * 1000 + b"tail"
+MODEL_INDEX = json.dumps({
+    '_class_name': "StableDiffusionPipeline",
+    'unet': ["diffusers", "UNet2DConditionModel"],
+    'tokenizer': ["transformers", "CLIPTokenizer"],
+    'safety_checker': [None, None]
+}).encode()
+FILES = {
+    "model_index.json": MODEL_INDEX,
+    "README.md": b"# tiny",
+    "unet/config.json": b'{"sample_size": 8}',
+    "unet/diffusion_pytorch_model.safetensors": WEIGHTS,
+    "unet/diffusion_pytorch_model.bin": b"pickled weights",
+    "unet/diffusion_pytorch_model.msgpack": b"flax weights",
+    "unet/model.onnx": b"onnx graph",
+    "tokenizer/vocab.json": b'{"a": 0}',
+    "tokenizer/merges.txt": b"#version: 0.2",
+    "tokenizer/tf_model.h5": b"keras weights",
+}
+LFS = {"unet/diffusion_pytorch_model.safetensors"}
+
+
+def git_oid(data: bytes) -> str:
+    return hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+
+
+def tree_entry(path: str) -> dict:
+    data = FILES[path]
+    entry = {'type': "file", 'path': path, 'size': len(data), 'oid': git_oid(data)}
+    if path in LFS:
+        entry['lfs'] = {'oid': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+    return entry
+
+
+class Hub(BaseHTTPRequestHandler):
+    # Minimal hub: the recursive tree listing and file downloads with single-range requests
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith(f"/api/models/{REPO}/tree/"):
+            body = json.dumps([tree_entry(path) for path in FILES]).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        prefix = f"/{REPO}/resolve/"
+        path = self.path[len(prefix):].split('/', 1)[1] if self.path.startswith(prefix) else None
+        if path not in FILES:
+            self.send_error(404)
+            return
+        data = FILES[path]
+        header = self.headers.get('Range')
+        if header is None:
+            self.send_response(200)
+            body = data
+        else:
+            start, end = header.removeprefix("bytes=").split('-')
+            start, end = int(start), int(end) if end else len(data) - 1
+            Hub.ranges.append((path, start, end))
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(data)}")
+            body = data[start:end + 1]
+        self.send_header('X-Repo-Commit', COMMIT)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def hub():
+    Hub.ranges = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Hub)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_select_files_takes_configs_and_one_weight_format():
+    tree = {path: {} for path in FILES}
+    assert sorted(select_files(tree, json.loads(MODEL_INDEX))) == [
+        "model_index.json", "tokenizer/merges.txt", "tokenizer/vocab.json",
+        "unet/config.json", "unet/diffusion_pytorch_model.safetensors"
+    ]
+
+
+def test_download_splits_ranges(hub, tmp_path):
+    manager = DownloadManager(str(tmp_path), endpoint=hub, workers=4, range_size=64 << 10)
+    snapshot = manager.download(REPO)
+    manager.close()
+
+    weights = os.path.join(snapshot, "unet", "diffusion_pytorch_model.safetensors")
+    with open(weights, 'rb') as file:
+        assert file.read() == WEIGHTS
+    assert not os.path.exists(os.path.join(snapshot, "unet", "model.onnx"))
+    assert not os.path.exists(os.path.join(snapshot, "tokenizer", "tf_model.h5"))
+    ranges = sorted((start, end) for path, start, end in Hub.ranges if path.endswith(".safetensors"))
+    assert ranges == [(start, min(start + (64 << 10), len(WEIGHTS)) - 1) for start in range(0, len(WEIGHTS), 64 << 10)]
+    assert manager.progress[REPO].status == "Done"
+    assert manager.progress[REPO].done == manager.progress[REPO].total
+
+
+def test_download_resumes_partial_ranges(hub, tmp_path):
+    range_size = 64 << 10
+    blob = os.path.join(
+        str(tmp_path), "models--test--tiny-model", "blobs", hashlib.sha256(WEIGHTS).hexdigest()
+    )
+    os.makedirs(os.path.dirname(blob))
+    # The first range was completed and the second one cut off by an earlier, interrupted run
+    with open(blob + ".incomplete.0", 'wb') as file:
+        file.write(WEIGHTS[:range_size])
+    with open(blob + ".incomplete.1", 'wb') as file:
+        file.write(WEIGHTS[range_size:range_size + 1000])
+
+    manager = DownloadManager(str(tmp_path), endpoint=hub, workers=4, range_size=range_size)
+    manager.download(REPO)
+    manager.close()
+
+    assert sha256(blob) == hashlib.sha256(WEIGHTS).hexdigest()
+    starts = sorted(start for path, start, _ in Hub.ranges if path.endswith(".safetensors"))
+    assert 0 not in starts
+    assert range_size + 1000 in starts
+    assert not [name for name in os.listdir(os.path.dirname(blob)) if ".incomplete" in name]
+
+
+def test_prefetch_keeps_variant_of_every_request(tmp_path):
+    manager = DownloadManager(str(tmp_path))
+    started, release, calls = threading.Event(), threading.Event(), []
+
+    def download(repo, variant=None, revision="main", progress=None):
+        calls.append((repo, variant, revision))
+        started.set()
+        release.wait(5)
+
+    manager.download = download
+    manager.prefetch(["first/model"])
+    started.wait(5)
+    # Queued while the worker is busy with the first repository
+    manager.prefetch(["second/model"], "fp16", "refs/pr/1")
+    release.set()
+    manager.prefetch_thread.join(5)
+    manager.close()
+    assert calls == [("first/model", None, "main"), ("second/model", "fp16", "refs/pr/1")]
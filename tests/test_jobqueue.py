@@ -0,0 +1,153 @@
+import os
+import time
+
+import pytest
+from PIL import Image, ImageChops
+
+from fakehandler import FakeHandler
+from folderjob import image_seed
+from jobqueue import JobQueue, JobWorker, saved_params
+from utils import image_fit
+
+
+REQUEST = {
+    'repo': "fake/model", 'connect': False, 'prompt': "a castle", 'negative_prompt': "", 'guidance_scale': 7.5,
+    'num_inference_steps': 20, 'width': 64, 'height': 64
+}
+
+
+def same_pixels(image: Image.Image, expected: Image.Image) -> bool:
+    return image.size == expected.size and ImageChops.difference(image.convert('RGB'), expected).getbbox() is None
+
+
+def same_image(filename: str, expected: Image.Image) -> bool:
+    with Image.open(filename) as image:
+        return same_pixels(image, expected)
+
+
+def wait_idle(queue: JobQueue, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        counts = queue.counts()
+        if not counts.get('submitted') and not counts.get('running'):
+            return counts
+        time.sleep(0.02)
+    raise TimeoutError(queue.counts())
+
+
+@pytest.fixture
+def setup(tmp_path):
+    def make(**options):
+        handler = FakeHandler(cache_dir=str(tmp_path / "cache"), **options)
+        queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+        events = []
+        worker = JobWorker(queue, lambda: handler, on_event=events.append)
+        workers.append(worker)
+        return handler, queue, worker, events
+
+    workers = []
+    yield make
+    for worker in workers:
+        worker.stop.set()
+        if worker.thread is not None:
+            worker.thread.join(5)
+
+
+def test_outputs_are_deterministic(setup, tmp_path):
+    handler, queue, worker, events = setup(step_time=0.0)
+    outdir = str(tmp_path / "out")
+    ids = [queue.submit(dict(REQUEST, seed=seed), outdir, "img_???.png") for seed in (1, 2, 3)]
+    worker.start()
+    assert wait_idle(queue) == {'done': 3}
+
+    jobs = {job['id']: job for job in queue.jobs()}
+    for job_id, seed in zip(ids, (1, 2, 3)):
+        filename = jobs[job_id]['outputs'][0]
+        assert same_image(filename, FakeHandler.image(seed, REQUEST['prompt'], 64, 64))
+        assert saved_params(filename)['seed'] == seed
+    # Jobs that differ only in seed run as one batch
+    assert len([event for event in events if event['type'] == 'progress' and event['jobs'] == ids]) > 0
+
+
+def test_injected_failures_repeat_on_retry(setup, tmp_path):
+    handler, queue, worker, events = setup(step_time=0.0, failure_rate=0.5)
+    seeds = range(100)
+    failing = next(seed for seed in seeds if handler.fails(seed, REQUEST['prompt']))
+    passing = next(seed for seed in seeds if not handler.fails(seed, REQUEST['prompt']))
+    # Different guidance keeps the jobs in separate batches, so one failure does not fail the other
+    failed_id = queue.submit(dict(REQUEST, seed=failing), str(tmp_path / "out"), "img_???.png")
+    done_id = queue.submit(dict(REQUEST, seed=passing, guidance_scale=5.0), str(tmp_path / "out"), "img_???.png")
+    worker.start()
+    wait_idle(queue)
+
+    jobs = {job['id']: job for job in queue.jobs()}
+    assert jobs[done_id]['state'] == "done"
+    assert jobs[failed_id]['state'] == "failed"
+    assert f"Injected failure for seed {failing}" in jobs[failed_id]['error']
+
+    queue.retry(failed_id)
+    wait_idle(queue)
+    assert {job['id']: job for job in queue.jobs()}[failed_id]['state'] == "failed"
+
+
+def test_interactive_run_preempts_and_batch_resumes(setup, tmp_path):
+    handler, queue, worker, events = setup(step_time=0.02)
+    handler.lock.min_slice = 0.05
+    seeds = (11, 12)
+    for seed in seeds:
+        queue.submit(dict(REQUEST, seed=seed), str(tmp_path / "out"), "img_???.png")
+    worker.start()
+    deadline = time.monotonic() + 10
+    while not any(event['type'] == 'progress' for event in events) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    with handler.lock:
+        interactive = handler.run("a cat", num_inference_steps=2, seed=5, width=64, height=64)
+    assert any(event['type'] == 'preempted' for event in events)
+    assert same_pixels(interactive[0][0], FakeHandler.image(5, "a cat", 64, 64))
+    assert wait_idle(queue) == {'done': 2}
+
+    for job, seed in zip(sorted(queue.jobs(), key=lambda job: job['id']), seeds):
+        filename = job['outputs'][0]
+        # The resumed batch gives the same images as an uninterrupted one
+        assert same_image(filename, FakeHandler.image(seed, REQUEST['prompt'], 64, 64))
+        assert saved_params(filename)['timings']['preempted'] >= 1
+
+
+def test_folder_job_runs_every_image_once(setup, tmp_path):
+    handler, queue, worker, events = setup(step_time=0.0, max_batch=2)
+    folder = tmp_path / "init"
+    folder.mkdir()
+    sizes = [(80, 64), (64, 64), None, (64, 96), (120, 64)]
+    for index, size in enumerate(sizes):
+        filename = folder / f"{chr(ord('a') + index)}.png"
+        if size is None:
+            filename.write_bytes(b"not an image")
+        else:
+            Image.new('RGB', size, (index * 40, 100, 200 - index * 30)).save(filename)
+    request = dict(REQUEST, seed=7, strength=0.5, init_folder=str(folder))
+    outdir = str(tmp_path / "out")
+    queue.submit(request, outdir, "var_?.png", kind="folder")
+    worker.start()
+    assert wait_idle(queue) == {'done': 1}
+
+    outputs = queue.jobs()[0]['outputs']
+    assert outputs[2] is None
+    for index, size in enumerate(sizes):
+        if size is None:
+            continue
+        name = chr(ord('a') + index)
+        assert outputs[index] == os.path.join(outdir, f"var_{name}.png")
+        with Image.open(folder / f"{name}.png") as image:
+            fitted = image_fit(image, 64, 64, 32).convert('RGB')
+        expected = Image.blend(fitted, FakeHandler.image(image_seed(7, index), REQUEST['prompt'], *fitted.size), 0.5)
+        assert same_image(outputs[index], expected)
+
+    # A repeated job finds the outputs of the first one and runs nothing
+    mtimes = [os.path.getmtime(path) for path in outputs if path]
+    runs = []
+    handler.run_images = lambda *args, **kwargs: runs.append(args)
+    queue.submit(request, outdir, "var_?.png", kind="folder")
+    assert wait_idle(queue) == {'done': 2}
+    assert runs == []
+    assert [os.path.getmtime(path) for path in outputs if path] == mtimes
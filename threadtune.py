@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import ctypes
+import platform
+import threading
+import torch
+
+import sampling
+from memory import free_memory
+from utils import atomic_write
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+PROFILES_FILE = "thread_profiles.json"
+# mallopt parameters
+M_TRIM_THRESHOLD = -1
+M_MMAP_THRESHOLD = -3
+# 'glibc' leaves the library alone: any mallopt call switches off its dynamic mmap threshold. 'retain' keeps freed
+# blocks of up to 32 MB (the largest threshold glibc accepts) in the heap, so per-step activations do not go through
+# mmap and page faults; glibc has no way back to the dynamic threshold, so once tried it stays until restart
+ALLOCATORS = {
+    'glibc': {},
+    'retain': {M_MMAP_THRESHOLD: 32 << 20, M_TRIM_THRESHOLD: 1 << 30}
+}
+
+
+def host_id() -> str:
+    return f"{platform.node()}|{platform.machine()}|{os.cpu_count()}"
+
+
+def libc():
+    if platform.system() != "Linux":
+        return None
+    try:
+        return ctypes.CDLL("libc.so.6")
+    except OSError:
+        return None
+
+
+def set_allocator(name: str) -> bool:
+    lib = libc()
+    if lib is None or name not in ALLOCATORS:
+        return False
+    return all(lib.mallopt(param, value) == 1 for param, value in ALLOCATORS[name].items())
+
+
+def set_threads(threads: int, interop_threads: int = 1):
+    torch.set_num_threads(threads)
+    # The inter-op pool can be sized only once per process, before its first use
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        pass
+
+
+def thread_candidates() -> list:
+    cores = os.cpu_count() or 1
+    physical = psutil.cpu_count(logical=False) if psutil is not None else None
+    # One core less leaves room for the GUI thread and image encoding
+    candidates = {cores, max(cores - 1, 1), max(cores // 2, 1), physical or cores}
+    return sorted(candidates, reverse=True)
+
+
+def step_time(pipe, embeds: dict, device: str, width: int, height: int, steps: int = 2) -> float:
+    scheduler = sampling.make_scheduler(pipe, steps, device)
+    latents = sampling.initial_latents(
+        pipe, [0], width, height, device, embeds['cond'].dtype
+    ) * scheduler.init_noise_sigma
+    start = time.perf_counter()
+    sampling.denoise(pipe, latents, embeds, scheduler, 7.5, width, height)
+    return (time.perf_counter() - start) / steps
+
+
+def calibrate(pipe, device: str, size: int, repeats: int = 2) -> dict:
+    # Thread counts are compared with the default allocator, then 'retain' with the fastest count
+    def best_of(threads: int) -> float:
+        set_threads(threads)
+        return min(step_time(pipe, embeds, device, size, size) for _ in range(repeats))
+
+    free_memory(device)
+    with torch.inference_mode():
+        embeds = sampling.encode(pipe, "", "", device)
+        step_time(pipe, embeds, device, size, size, steps=1)
+        timings = {threads: best_of(threads) for threads in thread_candidates()}
+        threads = min(timings, key=timings.get)
+        allocators = {'glibc': timings[threads]}
+        if set_allocator('retain'):
+            allocators['retain'] = best_of(threads)
+    allocator = min(allocators, key=allocators.get)
+    return {
+        'threads': threads, 'interop_threads': 1, 'allocator': allocator,
+        'step_time': round(allocators[allocator], 4), 'size': size, 'measured': time.time()
+    }
+
+
+def default_profile(threads: int, error: Exception) -> dict:
+    # Stored in place of a measured profile, so a model that cannot be timed is not calibrated on every load
+    return {
+        'threads': threads, 'interop_threads': 1, 'allocator': 'glibc',
+        'error': f"{type(error).__name__}: {error}", 'measured': time.time()
+    }
+
+
+def apply(profile: dict):
+    set_threads(profile['threads'], profile['interop_threads'])
+    set_allocator(profile['allocator'])
+
+
+class ThreadProfiles:
+    def __init__(self, cache_dir: str):
+        self.filename = os.path.join(cache_dir, PROFILES_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.filename, 'rt', encoding='utf-8') as file:
+                self.profiles = json.load(file)
+        except (OSError, ValueError):
+            self.profiles = {}
+
+    @staticmethod
+    def key(model: dict) -> str:
+        return "|".join([host_id(), model['repo'], model['variant'], model['dtype']])
+
+    def get(self, key: str):
+        with self.lock:
+            return self.profiles.get(key)
+
+    def put(self, key: str, profile: dict):
+        with self.lock:
+            self.profiles[key] = profile
+            atomic_write(self.filename, json.dumps(self.profiles, indent=1, sort_keys=True))
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from utils import file_hash
+
+
+IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".jfif", ".jpe", ".bmp", ".webp", ".tif", ".tiff", ".gif"}
+INDEX_FILE = "index.sqlite"
+
+
+def list_images(folder: str) -> list[str]:
+    try:
+        entries = [
+            entry.path for entry in os.scandir(folder)
+            if os.path.splitext(entry.name)[1].lower() in IMAGE_EXTS and entry.is_file()
+        ]
+    except FileNotFoundError:
+        return []
+    entries.sort()
+    return entries
+
+
+class ThumbnailStore:
+    def __init__(self, root: str, size: int = 160, workers: int = None):
+        self.root = os.path.realpath(root)
+        self.size = size
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.root, INDEX_FILE), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)"
+            )
+        self.pool = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1),
+                                       thread_name_prefix="thumbnail")
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def thumb_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}_{self.size}.jpg")
+
+    def lookup_hash(self, filename: str, stats: os.stat_result):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime, hash FROM files WHERE path = ?", (filename,)).fetchone()
+        if row and row[0] == stats.st_size and row[1] == stats.st_mtime_ns:
+            return row[2]
+        return None
+
+    def store_hash(self, filename: str, stats: os.stat_result, digest: str):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files(path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                (filename, stats.st_size, stats.st_mtime_ns, digest)
+            )
+
+    def load(self, filename: str) -> Image.Image:
+        filename = os.path.realpath(filename)
+        stats = os.stat(filename)
+        digest = self.lookup_hash(filename, stats)
+        if digest is None:
+            digest = file_hash(filename)
+            self.store_hash(filename, stats, digest)
+        thumb_file = self.thumb_path(digest)
+        try:
+            with Image.open(thumb_file) as thumb:
+                thumb.load()
+                return thumb
+        except (FileNotFoundError, OSError):
+            pass
+        with Image.open(filename) as image:
+            image.draft('RGB', (self.size, self.size))
+            image.thumbnail((self.size, self.size))
+            thumb = image.convert('RGB')
+        os.makedirs(os.path.dirname(thumb_file), exist_ok=True)
+        tmp_file = thumb_file + f".{threading.get_ident()}.tmp"
+        thumb.save(tmp_file, format='JPEG', quality=85)
+        os.replace(tmp_file, thumb_file)
+        return thumb
+
+    def request(self, filename: str, callback):
+        with self.pending_lock:
+            if filename in self.pending:
+                return
+            self.pending[filename] = self.pool.submit(self._job, filename, callback)
+
+    def cancel(self, keep=()):
+        keep = set(keep)
+        with self.pending_lock:
+            for filename, future in list(self.pending.items()):
+                if filename not in keep and future.cancel():
+                    del self.pending[filename]
+
+    def _job(self, filename: str, callback):
+        try:
+            thumb = self.load(filename)
+        except Exception:
+            thumb = None
+        with self.pending_lock:
+            self.pending.pop(filename, None)
+        callback(filename, thumb)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.db.close()
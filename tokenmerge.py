@@ -0,0 +1,141 @@
+import math
+import torch
+from diffusers.models.attention import BasicTransformerBlock
+
+
+def bipartite_merge(x: torch.Tensor, height: int, width: int, r: int, generator: torch.Generator):
+    # Bipartite soft matching of ToMe for SD: one destination token per 2x2 window, the r source tokens most similar
+    # to a destination are averaged into it; unmerge copies the merged values back to the source positions
+    batch, tokens, _ = x.shape
+    hsy, wsx = height // 2, width // 2
+    choice = torch.randint(4, size=(hsy, wsx, 1), generator=generator).to(x.device)
+    buffer = torch.zeros(hsy, wsx, 4, device=x.device, dtype=torch.int64)
+    buffer.scatter_(2, choice, -torch.ones_like(choice))
+    buffer = buffer.view(hsy, wsx, 2, 2).transpose(1, 2).reshape(hsy * 2, wsx * 2)
+    if hsy * 2 < height or wsx * 2 < width:
+        padded = torch.zeros(height, width, device=x.device, dtype=torch.int64)
+        padded[:hsy * 2, :wsx * 2] = buffer
+        buffer = padded
+    order = buffer.reshape(1, -1, 1).argsort(dim=1)
+    num_dst = hsy * wsx
+    a_idx, b_idx = order[:, num_dst:, :], order[:, :num_dst, :]
+    r = min(r, tokens - num_dst)
+
+    def split(value):
+        channels = value.shape[-1]
+        return (
+            value.gather(1, a_idx.expand(batch, tokens - num_dst, channels)),
+            value.gather(1, b_idx.expand(batch, num_dst, channels))
+        )
+
+    with torch.no_grad():
+        metric = x / x.norm(dim=-1, keepdim=True)
+        a, b = split(metric)
+        node_max, node_idx = (a @ b.transpose(-1, -2)).max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)[..., None]
+        unm_idx, src_idx = edge_idx[:, r:, :], edge_idx[:, :r, :]
+        dst_idx = node_idx[..., None].gather(1, src_idx)
+
+    def merge(value):
+        src, dst = split(value)
+        channels = value.shape[-1]
+        unm = src.gather(1, unm_idx.expand(batch, tokens - num_dst - r, channels))
+        src = src.gather(1, src_idx.expand(batch, r, channels))
+        dst = dst.scatter_reduce(1, dst_idx.expand(batch, r, channels), src, reduce='mean')
+        return torch.cat([unm, dst], dim=1)
+
+    def unmerge(value):
+        unm_len = unm_idx.shape[1]
+        unm, dst = value[:, :unm_len, :], value[:, unm_len:, :]
+        channels = value.shape[-1]
+        src = dst.gather(1, dst_idx.expand(batch, r, channels))
+        source = a_idx.expand(batch, a_idx.shape[1], 1)
+        out = torch.zeros(batch, tokens, channels, device=value.device, dtype=value.dtype)
+        out.scatter_(1, b_idx.expand(batch, num_dst, channels), dst)
+        out.scatter_(1, source.gather(1, unm_idx).expand(batch, unm_len, channels), unm)
+        out.scatter_(1, source.gather(1, src_idx).expand(batch, r, channels), src)
+        return out
+
+    return merge, unmerge
+
+
+class MergingProcessor:
+    def __init__(self, processor, token_merge):
+        self.processor = processor
+        self.token_merge = token_merge
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, **kwargs):
+        plan = self.token_merge.plan(hidden_states)
+        if plan is None:
+            return self.processor(attn, hidden_states, encoder_hidden_states, attention_mask, **kwargs)
+        merge, unmerge = plan
+        output = self.processor(attn, merge(hidden_states), encoder_hidden_states, attention_mask, **kwargs)
+        return unmerge(output)
+
+
+class TokenMerge:
+    # Merges redundant spatial tokens before the self-attention of the UNet transformer blocks and unmerges after;
+    # installed for one run by wrapping the current attn1 processors, so slicing and other processors keep working
+    def __init__(self, unet, ratio: float = 0.5, max_downsample: int = 1):
+        self.unet = unet
+        self.ratio = min(max(float(ratio), 0.0), 0.75)
+        self.max_downsample = max_downsample
+        self.latent_size = None
+        self.timestep = 0
+        self.wrapped = []
+        self.hook = None
+
+    def policy(self) -> dict:
+        return {'type': "tome", 'ratio': self.ratio, 'max_downsample': self.max_downsample}
+
+    def tag(self) -> str:
+        return f"tome{self.ratio}x{self.max_downsample}"
+
+    def record(self, module, args):
+        if len(args) < 2:
+            return
+        sample, timestep = args[0], args[1]
+        self.latent_size = tuple(sample.shape[-2:])
+        self.timestep = float(timestep.flatten()[0]) if torch.is_tensor(timestep) else float(timestep)
+
+    def plan(self, hidden_states: torch.Tensor):
+        if self.latent_size is None or hidden_states.ndim != 3:
+            return None
+        latent_height, latent_width = self.latent_size
+        tokens = hidden_states.shape[1]
+        downsample = round(math.sqrt(latent_height * latent_width / tokens))
+        if downsample > self.max_downsample:
+            return None
+        height, width = math.ceil(latent_height / downsample), math.ceil(latent_width / downsample)
+        r = int(tokens * self.ratio)
+        if height * width != tokens or height < 2 or width < 2 or r == 0:
+            return None
+        # Destinations are drawn from the timestep, so a run and its resumed continuation merge the same tokens
+        generator = torch.Generator().manual_seed(int(self.timestep * 1000) + tokens)
+        return bipartite_merge(hidden_states, height, width, r, generator)
+
+    def installed(self, attn) -> bool:
+        return isinstance(attn.processor, MergingProcessor) and attn.processor.token_merge is self
+
+    def install(self):
+        # Also wraps processors that memory modes switched on during the run put in place of the wrappers
+        for module in self.unet.modules():
+            if isinstance(module, BasicTransformerBlock) and not module.only_cross_attention \
+                    and not self.installed(module.attn1):
+                if module.attn1 not in self.wrapped:
+                    self.wrapped.append(module.attn1)
+                module.attn1.set_processor(MergingProcessor(module.attn1.processor, self))
+
+    def __enter__(self):
+        self.hook = self.unet.register_forward_pre_hook(self.record)
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        # Only the wrappers are removed, processors set during the run (attention slicing) stay
+        for attn in reversed(self.wrapped):
+            if self.installed(attn):
+                attn.set_processor(attn.processor.processor)
+        self.wrapped.clear()
+        self.hook.remove()
+        self.hook = None
@@ -1,7 +1,11 @@
 import os.path
-from PIL import Image
+import numpy as np
+from PIL import Image, ImageDraw
 import yaml
 import re
+import json
+import hashlib
+import threading
 from heapq import heapify, heappop, heappushpop
 from typing import Dict, Any, Union
 
@@ -117,9 +121,35 @@ def load_yaml(fname: str) -> dict:
 
 
 def save_yaml(fname: str, mapping: dict):
-    with open(fname, 'wt') as file:
-        for key, value in mapping.items():
-            yaml.safe_dump({key: value}, file)
+    atomic_write(fname, yaml.safe_dump(mapping, sort_keys=False))
+
+
+def atomic_write(fname: str, text: str):
+    tmp_name = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_name, 'wt', encoding='utf-8') as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_name, fname)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+
+def params_hash(params: dict, exclude=('timings', 'device')) -> str:
+    canonical = {key: value for key, value in params.items() if key not in exclude}
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def file_hash(fname: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as file:
+        while chunk := file.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 TRUE_STR = {'yes', 'y', 'true', 't', 'on'}
@@ -160,6 +190,21 @@ def append_non_zero(list_: list, value):
         list_.append(value)
 
 
+def parse_loras(text: str) -> list[tuple[str, float]]:
+    # 'style.safetensors:0.8; C:\\loras\\detail.safetensors' -> [('style.safetensors', 0.8), ('C:\\...', 1.0)]
+    loras = []
+    for item in text.split(';'):
+        item = strip_quotes(item)
+        if not item:
+            continue
+        filename, _, weight = item.rpartition(':')
+        try:
+            loras.append((strip_quotes(filename), float(weight)))
+        except ValueError:
+            loras.append((item, 1.0))
+    return loras
+
+
 def repo_key(repo_name: str) -> str:
     return repo_name.lower().replace(' ', '').replace('\t', '')
 
@@ -254,5 +299,39 @@ class SubstituteImage:
         return image.crop((x, y, x + width, y + height))
 
 
+def array_image(array: np.ndarray) -> Image.Image:
+    # Unpacked straight from a contiguous HxWx3 uint8 buffer; PIL stores RGB padded to 4 bytes, so it cannot share it
+    return Image.frombuffer('RGB', (array.shape[1], array.shape[0]), array, 'raw', 'RGB', 0, 1)
+
+
+def contact_sheet(images: list, rows: int, cols: int, row_labels: list = None, col_labels: list = None,
+                  margin: int = 4, label_height: int = 24, background=(255, 255, 255)) -> Image.Image:
+    # Images are PIL images or HxWx3 uint8 arrays; tiles are copied into one array, labels drawn afterwards
+    tiles = [
+        image if image is None or isinstance(image, np.ndarray) else np.asarray(image.convert('RGB'))
+        for image in images
+    ]
+    h, w = (max(sizes) for sizes in zip(*(tile.shape[:2] for tile in tiles if tile is not None)))
+    left = max((ImageDraw.Draw(Image.new('RGB', (1, 1))).textlength(label) for label in row_labels), default=0) \
+        if row_labels else 0
+    left = int(left) + 2 * margin if left else 0
+    top = label_height if col_labels else 0
+    sheet = np.empty((top + rows * (h + margin) + margin, left + cols * (w + margin) + margin, 3), dtype=np.uint8)
+    sheet[:] = background
+    for index, tile in enumerate(tiles):
+        if tile is None:
+            continue
+        row, col = divmod(index, cols)
+        y, x = top + margin + row * (h + margin), left + margin + col * (w + margin)
+        sheet[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+    sheet = Image.fromarray(sheet)
+    draw = ImageDraw.Draw(sheet)
+    for col, label in enumerate(col_labels or []):
+        draw.text((left + margin + col * (w + margin), margin), label, fill=(0, 0, 0))
+    for row, label in enumerate(row_labels or []):
+        draw.text((margin, top + margin + row * (h + margin) + h // 2), label, fill=(0, 0, 0))
+    return sheet
+
+
 def clip(x: Union[int, float], lower: Union[int, float], upper: Union[int, float]) -> Union[int, float]:
     return max(min(x, upper), lower)
@@ -6,7 +6,7 @@ from numpy import random
 from PIL import ImageTk, Image
 
 import cfg
-from utils import image_fit
+from utils import image_fit, parse_loras
 from filehandlers import image_files
 
 
@@ -148,8 +148,7 @@ class HistoryCombo(ttk.Frame):
                     break
             else:
                 self.history.insert(0, value)
-                if len(self.history) > self.max_history:
-                    self.history = self.history[:self.max_history]
+                del self.history[self.max_history:]
 
         if idx != -1:
             self.history.insert(0, self.history[idx])
@@ -194,6 +193,31 @@ class ChooseDir(HistoryCombo):
         return folder
 
 
+class LoraChooser(HistoryCombo):
+    def __init__(self, parent, label, width, history, max_history=20):
+        super().__init__(parent, label, width, history, max_history=max_history)
+        self.icon = ImageTk.PhotoImage(cfg.ICONS['folder'])
+
+        self.button = ttk.Button(self, image=self.icon, command=lambda *args: self.ask_files())
+        self.button.grid(column=2, row=0, sticky=W, padx=5, pady=5)
+
+    def ask_files(self):
+        opts = {
+            "title": self.title,
+            "filetypes": [("LoRA weights", "*.safetensors *.bin"), ("All files", "*.*")]
+        }
+        loras = self.get()
+        if loras:
+            opts['initialdir'] = os.path.dirname(loras[-1][0])
+        files = filedialog.askopenfilenames(**opts)
+        if files:
+            self.value.set("; ".join([item for item in [self.value.get().strip(' ;')] if item] +
+                                     [f"{filename}:1.0" for filename in files]))
+
+    def get(self):
+        return parse_loras(self.value.get())
+
+
 class SeedEntry(ttk.LabelFrame):
     def __init__(self, parent, label, init=None):
         super().__init__(parent, text=label)
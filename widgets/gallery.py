@@ -0,0 +1,171 @@
+import os
+import queue
+import tkinter as tk
+from tkinter import ttk
+from PIL import ImageTk
+
+import cfg
+from widgets.common import ChooseDir
+from widgets.imagebox import OpenImage
+from thumbnails import ThumbnailStore, list_images
+
+
+class ThumbnailGrid(ttk.Frame):
+    def __init__(self, parent, store: ThumbnailStore, padding=8, on_open=None):
+        super(ThumbnailGrid, self).__init__(parent)
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+
+        self.store = store
+        self.cell = store.size + 2 * padding
+        self.padding = padding
+        self.on_open = on_open
+
+        self.files = []
+        self.columns = 1
+        self.visible = {}
+        self.thumbs = {}
+        self.max_thumbs = 400
+        self.ready = queue.SimpleQueue()
+
+        self.canvas = tk.Canvas(self, highlightthickness=0, yscrollincrement=self.cell // 4)
+        self.canvas.grid(row=0, column=0, sticky=tk.N+tk.S+tk.W+tk.E)
+        self.y_scroll = ttk.Scrollbar(self, orient=tk.VERTICAL, command=lambda *args: self.yview(*args))
+        self.y_scroll.grid(row=0, column=1, sticky=tk.N+tk.S)
+        self.canvas.config(yscrollcommand=self.y_scroll.set)
+
+        self.canvas.bind('<Configure>', lambda *args: self.layout())
+        self.canvas.bind('<MouseWheel>', lambda status: self.yview('scroll', -status.delta // 120, 'units'))
+        self.canvas.bind('<Button-4>', lambda *args: self.yview('scroll', -1, 'units'))
+        self.canvas.bind('<Button-5>', lambda *args: self.yview('scroll', 1, 'units'))
+        self.canvas.bind('<Double-Button-1>', lambda status: self.open_at(status.x, status.y))
+        self.after(50, self.poll)
+
+    def set_files(self, files: list[str]):
+        self.files = files
+        self.store.cancel()
+        self.clear_cells()
+        self.canvas.yview_moveto(0)
+        self.layout()
+
+    def clear_cells(self):
+        for items in self.visible.values():
+            for item in items:
+                self.canvas.delete(item)
+        self.visible.clear()
+
+    def layout(self):
+        width = max(self.canvas.winfo_width(), self.cell)
+        columns = max(width // self.cell, 1)
+        if columns != self.columns:
+            self.columns = columns
+            self.clear_cells()
+        rows = (len(self.files) + self.columns - 1) // self.columns
+        self.canvas.config(scrollregion=(0, 0, self.columns * self.cell, rows * self.cell))
+        self.refresh()
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def visible_range(self):
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first = max(int(top // self.cell), 0) * self.columns
+        last = min((int(bottom // self.cell) + 1) * self.columns, len(self.files))
+        return first, last
+
+    def refresh(self):
+        first, last = self.visible_range()
+        for index in [index for index in self.visible if not first <= index < last]:
+            for item in self.visible.pop(index):
+                self.canvas.delete(item)
+        for index in range(first, last):
+            if index in self.visible:
+                continue
+            filename = self.files[index]
+            x, y = self.cell_origin(index)
+            rect = self.canvas.create_rectangle(
+                x + self.padding, y + self.padding,
+                x + self.cell - self.padding, y + self.cell - self.padding,
+                outline="#C0C0C0"
+            )
+            self.visible[index] = [rect]
+            if filename in self.thumbs:
+                self.show(index, filename)
+        # Every visible cell still without a thumbnail, also those from earlier refreshes whose results were dropped
+        wanted = [self.files[index] for index in range(first, last) if self.files[index] not in self.thumbs]
+        self.store.cancel(keep=wanted)
+        for filename in wanted:
+            self.store.request(filename, lambda fname, thumb: self.ready.put((fname, thumb)))
+
+    def cell_origin(self, index):
+        return (index % self.columns) * self.cell, (index // self.columns) * self.cell
+
+    def show(self, index, filename):
+        photo = self.thumbs[filename]
+        if photo is None:
+            return
+        self.thumbs[filename] = self.thumbs.pop(filename)
+        x, y = self.cell_origin(index)
+        item = self.canvas.create_image(x + self.cell // 2, y + self.cell // 2, anchor=tk.CENTER, image=photo)
+        self.visible[index].append(item)
+
+    def poll(self):
+        first, last = self.visible_range()
+        index_of = {self.files[index]: index for index in range(first, last)}
+        try:
+            while True:
+                filename, thumb = self.ready.get_nowait()
+                if filename not in index_of:
+                    continue
+                self.thumbs[filename] = ImageTk.PhotoImage(thumb) if thumb is not None else None
+                while len(self.thumbs) > self.max_thumbs:
+                    del self.thumbs[next(iter(self.thumbs))]
+                index = index_of[filename]
+                if index in self.visible and len(self.visible[index]) == 1:
+                    self.show(index, filename)
+        except queue.Empty:
+            pass
+        self.after(50, self.poll)
+
+    def open_at(self, x, y):
+        x, y = self.canvas.canvasx(x), self.canvas.canvasy(y)
+        column = int(x // self.cell)
+        index = int(y // self.cell) * self.columns + column
+        if column < self.columns and 0 <= index < len(self.files) and self.on_open:
+            self.on_open(self.files[index])
+
+
+class GalleryTab(ttk.Frame):
+    def __init__(self, root):
+        super(GalleryTab, self).__init__(root, padding="3 3 12 12")
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(1, weight=1)
+
+        self.store = ThumbnailStore(os.path.join(cfg.config['cache_dir'], "thumbnails"))
+
+        self.top_frame = ttk.Frame(self)
+        self.top_frame.columnconfigure(0, weight=1)
+        self.folder = ChooseDir(self.top_frame, "Folder: ", width=80, history=cfg.config['outdir_history'])
+        self.folder.entry.bind('<<ComboboxSelected>>', lambda *args: self.open_folder())
+        self.folder.entry.bind('<Return>', lambda *args: self.open_folder())
+        self.folder.grid(column=0, row=0, sticky=tk.W+tk.E, padx=5, pady=5)
+        self.open_button = ttk.Button(self.top_frame, text="Open", command=lambda *args: self.open_folder())
+        self.open_button.grid(column=1, row=0, padx=5, pady=5)
+        self.count_var = tk.StringVar()
+        self.count_label = ttk.Label(self.top_frame, textvariable=self.count_var)
+        self.count_label.grid(column=2, row=0, padx=5, pady=5)
+        self.top_frame.grid(column=0, row=0, sticky=tk.W+tk.E)
+
+        self.grid_view = ThumbnailGrid(self, self.store, on_open=lambda fname: OpenImage(tk._default_root, fname))
+        self.grid_view.grid(column=0, row=1, sticky=tk.N+tk.S+tk.W+tk.E, padx=5, pady=5)
+
+    def destroy(self):
+        self.store.close()
+        super(GalleryTab, self).destroy()
+
+    def open_folder(self):
+        files = list_images(self.folder.get())
+        self.count_var.set(f"{len(files)} images")
+        self.grid_view.set_files(files)
@@ -8,7 +8,8 @@ from PIL.Image import Resampling
 import cfg
 from widgets.common import ChooseDir, HistoryCombo
 from utils import not_include, get_available_filename, load_yaml, save_yaml
-from filehandlers import image_files
+from filehandlers import image_files, read_png_params
+from catalog import catalog_at
 
 
 def clip(x, lower, upper):
@@ -222,7 +223,10 @@ class ImageBox(ttk.Frame):
         try:
             self.params = load_yaml(path + ".prm")
         except FileNotFoundError:
-            self.params = None
+            try:
+                self.params = read_png_params(path)
+            except Exception:
+                self.params = None
         try:
             self.mask = image_files.load(path + "_mask.png")
         except FileNotFoundError:
@@ -272,12 +276,25 @@ class ImageBox(ttk.Frame):
                     ):
                         return
 
-            if self.image is not None: image_files.save(filepath, self.image)
+            catalog = catalog_at(filepath)
+            if self.image is not None and self.params is not None:
+                same = [fname for fname in catalog.find_same(self.params)
+                        if os.path.exists(fname) and fname != os.path.realpath(filepath)]
+                if same:
+                    if not askokcancel(
+                        "Duplicate image",
+                        f"Image with the same parameters is already saved as {same[0]}. Save anyway?"
+                    ):
+                        return
+
+            if self.image is not None: image_files.save(filepath, self.image, info=self.params)
             else: filepath = None
             if self.params is not None: save_yaml(yml_path, self.params)
             else: yml_path = None
             if self.mask is not None: image_files.save(mask_path, self.mask)
             else: mask_path = None
+            if filepath is not None and yml_path is not None:
+                catalog.add(filepath, self.params)
 
             self.outdir.update_history()
             self.prefix.update_history()
@@ -304,3 +321,15 @@ class SaveImage(tk.Toplevel):
         self.image_box = ImageBox(self, on_save=lambda *args: self.destroy(), on_cancel=lambda *args: self.destroy())
         self.image_box.set(image, params)
         self.image_box.grid(row=0, column=0, sticky=tk.N+tk.S+tk.W+tk.E)
+
+
+class OpenImage(tk.Toplevel):
+    def __init__(self, root, path):
+        super(OpenImage, self).__init__(root)
+        self.title(os.path.basename(path))
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+
+        self.image_box = ImageBox(self, on_save=lambda *args: self.destroy(), on_cancel=lambda *args: self.destroy())
+        self.image_box.load(path)
+        self.image_box.grid(row=0, column=0, sticky=tk.N+tk.S+tk.W+tk.E)
@@ -1,30 +1,55 @@
 import os
+import queue
+import threading
 import tkinter as tk
 from tkinter import N, S, E, W, NW, SW, NE, SE, HORIZONTAL, VERTICAL, RIGHT
 from tkinter import ttk, messagebox
 from math import sqrt, floor
-from diffusers.utils import make_image_grid
 
 import cfg
-from widgets.common import HistoryCombo, DasScala, SeedEntry, ChooseDir, ImageBox, Size, CheckBox, InitImageBox
+from widgets.common import HistoryCombo, DasScala, SeedEntry, Size, CheckBox, InitImageBox, LoraChooser
 from widgets.promptbox import PromptBox, AdPromptList
-from widgets.imagebox import ScalableImage, SaveImage
-from diffusershandler import DiffusersHandler
-from utils import repo_key, file_naming, not_include, save_yaml
-from filehandlers import image_files
+from widgets.imagebox import SaveImage
+from widgets.sweep import SweepDialog
+from widgets.queue_tab import QueueDialog
+from startup import Warmup
+from modelcatalog import catalog_for, describe
+from downloader import DownloadManager
+from utils import repo_key
+from folderjob import REQUEST_KEYS
 
 
 class InferenceTab(ttk.Frame):
-    def __init__(self, root):
+    def __init__(self, root, job_queue=None):
         super(InferenceTab, self).__init__(root, padding="3 3 12 12")
 
-        self.diffusers_handler = DiffusersHandler(
-            cache_dir=cfg.config['cache_dir'],
-            max_models=cfg.config['max_models'],
-            use_cuda=cfg.config['use_cuda'],
-            use_float16=cfg.config['use_float16'],
-            hf_key=cfg.config['hf_key'] if 'hf_key' in cfg.config else None
+        self.diffusers_handler = None
+        self.job_queue = job_queue
+        self.events = queue.SimpleQueue()
+        self.task = None
+        self.downloader = DownloadManager(
+            cfg.config['cache_dir'], token=cfg.config['hf_key'] if 'hf_key' in cfg.config else None
         )
+        self.warmup = Warmup(
+            dict(
+                cache_dir=cfg.config['cache_dir'],
+                max_models=cfg.config['max_models'],
+                use_cuda=cfg.config['use_cuda'],
+                use_float16=cfg.config['use_float16'],
+                hf_key=cfg.config['hf_key'] if 'hf_key' in cfg.config else None,
+                result_cache_mb=cfg.config['result_cache_mb'],
+                auto_batch=cfg.config['auto_batch'],
+                residency=cfg.config['residency'],
+                thread_tuning=cfg.config['thread_tuning'],
+                downloader=self.downloader,
+                **{'onnx': {'threads': cfg.config['onnx_threads']}, 'fake': cfg.config['fake_engine']}.get(
+                    cfg.config['engine'], {}
+                )
+            ),
+            preload_repo=cfg.config['repo_history'][0]
+            if cfg.config['preload_last_repo'] and cfg.config['repo_history'] else None,
+            engine=cfg.config['engine']
+        ).start()
 
         self.grid(column=0, row=0, sticky=(N, W, E, S))
         self.columnconfigure(1, weight=1, minsize=400)
@@ -39,6 +64,15 @@ class InferenceTab(ttk.Frame):
             is_eq_func=lambda s1, s2: repo_key(s1) == repo_key(s2)
         )
         self.repo.grid(column=1, row=1, sticky=E+W, padx=5, pady=5)
+        self.model_catalog = catalog_for(cfg.config['cache_dir'])
+        self.repo_status = tk.StringVar()
+        self.repo_status_label = ttk.Label(self.repo, textvariable=self.repo_status)
+        self.repo_status_label.grid(column=2, row=0, sticky=W, padx=5, pady=5)
+        self.repo.entry.bind('<<ComboboxSelected>>', lambda *args: self.check_repo())
+        self.repo.entry.bind('<FocusOut>', lambda *args: self.check_repo())
+        self.download_button = ttk.Button(self.repo, text="Download", command=lambda *args: self.download())
+        self.download_button.grid(column=3, row=0, sticky=W, padx=5, pady=5)
+        self.check_repo()
 
         # Image size
         self.imsize = Size(self, "Image size", (32, 4096), step=32, defaul=(512, 512))
@@ -48,6 +82,8 @@ class InferenceTab(ttk.Frame):
         checkbuttons = {
             'nsfw': ("NSFW protection", True),
             'connect': ("Connect to HuggingFace", True),
+            'fuse_lora': ("Fuse LoRA weights", False),
+            'hires': ("Hires (upscale latents)", False),
         }
         self.checkbox = CheckBox(self, checkbuttons, orient=tk.VERTICAL)
         self.checkbox.grid(column=1, row=2, sticky=tk.NE, padx=5, pady=5)
@@ -83,6 +119,10 @@ class InferenceTab(ttk.Frame):
         )
         self.init_img.grid(column=3, row=2, rowspan=2, sticky=tk.NE+tk.NW, padx=5, pady=5)
 
+        # LoRA adapters
+        self.lora = LoraChooser(self, "LoRA (file:weight; ...)", width=40, history=cfg.config['lora_history'])
+        self.lora.grid(column=3, row=1, sticky=E+W, padx=5, pady=5)
+
         # Seed
         self.seed = SeedEntry(self, "Random generator seed")
         self.seed.grid(column=2, row=2, sticky=(W, E), padx=5, pady=5)
@@ -96,6 +136,19 @@ class InferenceTab(ttk.Frame):
         # Run button
         self.run_button = ttk.Button(self, text="Run", command=lambda *args: self.run())
         self.run_button.grid(column=2, row=7, padx=5, pady=5)
+        self.sweep_button = ttk.Button(self, text="Sweep...", command=lambda *args: self.ask_sweep())
+        self.sweep_button.grid(column=1, row=7, sticky=E, padx=5, pady=5)
+        if self.job_queue is not None:
+            self.queue_button = ttk.Button(self, text="Queue...", command=lambda *args: self.ask_queue())
+            self.queue_button.grid(column=1, row=7, sticky=W, padx=5, pady=5)
+
+        # Status
+        self.status_var = tk.StringVar(value=self.warmup.status)
+        self.status_label = ttk.Label(self, textvariable=self.status_var)
+        self.status_label.grid(column=3, row=7, sticky=W, padx=5, pady=5)
+        self.progress_bar = ttk.Progressbar(self, orient=HORIZONTAL, mode='determinate')
+        self.progress_bar.grid(column=3, row=6, sticky=E+W+S, padx=5, pady=5)
+        self.after(100, self.poll_warmup)
 
 
 
@@ -103,6 +156,137 @@ class InferenceTab(ttk.Frame):
             child.grid_configure(padx=5, pady=5)
         self.prompt.focus()
 
+    def check_repo(self):
+        self.repo_status.set("Local: " + describe(self.model_catalog.find(self.repo.get())))
+
+    def download(self):
+        repo = self.repo.get().strip()
+        if not repo or os.path.isdir(repo):
+            return
+        self.repo.update_history()
+        cfg.save()
+        self.downloader.prefetch([repo], "fp16" if cfg.config['use_float16'] else None)
+        self.after(200, self.poll_download, repo)
+
+    def poll_download(self, repo):
+        progress = self.downloader.progress[repo]
+        self.repo_status.set(str(progress))
+        if self.downloader.prefetch_thread.is_alive():
+            self.after(500, self.poll_download, repo)
+        elif progress.status == "Done":
+            self.check_repo()
+
+    def show_memory(self):
+        usage = self.diffusers_handler.memory_usage()
+        shared = self.diffusers_handler.curr['shared']
+        self.status_var.set(
+            f"Models: {usage['resident'] / (1 << 30):.2f} GB"
+            + (f", shared {usage['shared'] / (1 << 30):.2f} GB" if usage['shared'] else "")
+            + (f" (reused {', '.join(shared)})" if shared else "")
+        )
+
+    def show_progress(self, info):
+        steps = max(info['steps'], 1)
+        self.progress_bar.config(maximum=steps * info['stages'], value=steps * info['stage_index'] + info['step'])
+        text = f"{info['stage']}: {info['step']}/{info['steps']}" if info['steps'] > 1 else info['stage']
+        if info['eta'] is not None:
+            text += f", ~{info['eta']:.0f} s left"
+        self.status_var.set(text)
+        self.update_idletasks()
+
+    def show_run_info(self, params):
+        timings = params.get('timings', {})
+        info = [f"Done in {timings.get('inference', 0)} s"]
+        if 'peak_vram_mb' in timings:
+            info.append(f"peak VRAM {timings['peak_vram_mb']} MB")
+        if 'peak_rss_mb' in timings:
+            info.append(f"peak RAM {timings['peak_rss_mb']} MB")
+        if timings.get('expected') and timings.get('inference', 0) > 1.5 * timings['expected']:
+            info.append(f"{timings['inference'] / timings['expected']:.1f}x slower than usual")
+        if params.get('memory_mode'):
+            info.append("out of memory, used " + ", ".join(params['memory_mode']))
+        self.status_var.set("; ".join(info))
+        self.progress_bar.config(value=self.progress_bar['maximum'])
+
+    def poll_warmup(self):
+        self.status_var.set(self.warmup.status)
+        if self.warmup.thread.is_alive():
+            self.after(100, self.poll_warmup)
+
+    def start_task(self, work, done):
+        # Loading and generation run on a worker thread: the handler lock may be held by a queued batch until its
+        # next pause point, and waiting for it on the Tk thread would freeze the window. Results come back through
+        # self.events and are shown by poll_task
+        self.run_button.state(['disabled'])
+        self.sweep_button.state(['disabled'])
+        stage = {'name': "Startup"}
+
+        def target():
+            try:
+                result = work(stage)
+            except Exception as error:
+                info = self.diffusers_handler.err_info if self.diffusers_handler else None
+                self.events.put(('failed', stage['name'], error, info))
+            else:
+                self.events.put(('done', done, result))
+
+        self.task = threading.Thread(target=target, name="inference", daemon=True)
+        self.task.start()
+        self.after(50, self.poll_task)
+
+    def task_progress(self, info):
+        self.events.put(('progress', info))
+
+    def poll_task(self):
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event[0] == 'progress':
+                    self.show_progress(event[1])
+                elif event[0] == 'status':
+                    self.status_var.set(event[1])
+                elif event[0] == 'loaded':
+                    self.repo.update_history()
+                    self.check_repo()
+                    self.show_memory()
+                elif event[0] == 'failed':
+                    self.finish_task()
+                    self.show_error(*event[1:])
+                elif event[0] == 'done':
+                    self.finish_task()
+                    try:
+                        event[1](event[2])
+                    except Exception as error:
+                        self.show_error("Save results", error)
+        except queue.Empty:
+            pass
+        if self.task.is_alive() or not self.events.empty():
+            self.after(50, self.poll_task)
+
+    def finish_task(self):
+        self.run_button.state(['!disabled'])
+        self.sweep_button.state(['!disabled'])
+        cfg.save()
+
+    def show_error(self, stage, error, info=None):
+        messagebox.showerror(
+            title=stage + " ERROR",
+            message=f"{type(error).__name__} ERROR:\n\n{str(error)}" + (f"\n\n{str(info)}" if info else "")
+        )
+
+    def load_repo(self, stage: dict, repo_name: str, connect: bool):
+        # On the worker thread, with the handler lock held
+        stage['name'] = "Load repo"
+        self.diffusers_handler.load_pipeline(repo_name, connect=connect, progress=self.task_progress)
+        self.events.put(('loaded',))
+
+    def get_handler(self, stage: dict):
+        stage['name'] = "Startup"
+        self.diffusers_handler = self.warmup.get()
+        if self.diffusers_handler.lock.locked():
+            self.events.put(('status', "Pausing queued jobs"))
+        return self.diffusers_handler
+
     def run(self):
         stage = "Runtime"
         try:
@@ -120,50 +304,172 @@ class InferenceTab(ttk.Frame):
             num_steps = self.steps.get()
             width, height = self.imsize.get()
             block_nsfw = self.checkbox['nsfw'].get()
+            loras = self.lora.get()
+            if loras:
+                self.lora.update_history()
+            fuse_loras = self.checkbox['fuse_lora'].get()
+            hires = self.checkbox['hires'].get()
             connect = self.checkbox['connect'].get()
             init_image_file, strength = self.init_img.get()
             self.init_img.add_history()
+            repo_name = self.repo.get()
+        except Exception as error:
+            self.show_error(stage, error)
+            cfg.save()
+            return
+
+        def work(stage):
+            handler = self.get_handler(stage)
+            with handler.lock:
+                self.load_repo(stage, repo_name, connect)
+                stage['name'] = "Inference"
+                return handler.run(
+                    prompt=prompt_txt, negative_prompt=neg_prompt_txt, guidance_scale=guidance_val,
+                    image_file=init_image_file, strength=strength,
+                    width=width, height=height,
+                    num_inference_steps=num_steps, number=1, seed=seed_val,
+                    block_nsfw=block_nsfw, loras=loras, fuse_loras=fuse_loras,
+                    hires=hires, hires_strength=cfg.config['hires_strength'], step_cache=cfg.config['step_cache'],
+                    token_merge=cfg.config['token_merge'], guidance_truncation=cfg.config['guidance_truncation'],
+                    progress=self.task_progress)
+
+        self.start_task(work, self.save_results)
+
+    def save_results(self, result):
+        to_show = []
+        actual_size = None
+        for image, params in result:
+            if actual_size is None:
+                actual_size = (params['width'], params['height'])
+                self.imsize.set(actual_size)
+                self.show_run_info(params)
+
+            params['adprompt'] = self.prompt.adprompt.get()
+            params['negative_adprompt'] = self.neg_prompt.adprompt.get()
+            if image is not None:
+                SaveImage(tk._default_root, image, params)
+                #to_show.append(image)
+            else:
+                to_show.append(cfg.config['nsfw_image'])
+
+        #stage = "Show image"
+        #if to_show:
+        #    length = len(to_show)
+        #    rows = floor(sqrt(length))
+        #    cols = (length - 1) // rows + 1
+        #   im_grid = make_image_grid(to_show, rows, cols)
+        #    self.output.set_image(im_grid)
+
+    def ask_sweep(self):
+        seed = self.seed.get()
+        SweepDialog(
+            tk._default_root, guidance=[self.guidance.get()], steps=[self.steps.get()], seed=[seed, seed + 1],
+            on_run=lambda guidance, steps, seeds: self.run_sweep(guidance, steps, seeds)
+        )
+
+    def run_sweep(self, guidance_scales, steps, seeds):
+        stage = "Runtime"
+        try:
+            stage = "Get prompts"
+            prompt_txt = self.prompt.get().strip()
+            if prompt_txt:
+                self.prompt.update_history()
+            neg_prompt_txt = self.neg_prompt.get().strip()
+            if neg_prompt_txt:
+                self.neg_prompt.update_history()
+
+            stage = "Get parameters"
+            width, height = self.imsize.get()
+            block_nsfw = self.checkbox['nsfw'].get()
+            loras = self.lora.get()
+            if loras:
+                self.lora.update_history()
+            fuse_loras = self.checkbox['fuse_lora'].get()
+            connect = self.checkbox['connect'].get()
 
-            stage = "Load repo"
             repo_name = self.repo.get()
-            self.diffusers_handler.load_pipeline(repo_name, connect=connect)
+        except Exception as error:
+            self.show_error(stage, error)
+            cfg.save()
+            return
+
+        def work(stage):
+            handler = self.get_handler(stage)
+            with handler.lock:
+                self.load_repo(stage, repo_name, connect)
+                stage['name'] = "Inference"
+                return handler.sweep(
+                    prompt=prompt_txt, negative_prompt=neg_prompt_txt, guidance_scales=guidance_scales,
+                    steps=steps, seeds=seeds, width=width, height=height, block_nsfw=block_nsfw,
+                    loras=loras, fuse_loras=fuse_loras, progress=self.task_progress)
+
+        self.start_task(work, self.save_sweep)
+
+    def save_sweep(self, result):
+        (sheet, params), _ = result
+        params['adprompt'] = self.prompt.adprompt.get()
+        params['negative_adprompt'] = self.neg_prompt.adprompt.get()
+        self.show_run_info(params)
+        if sheet is not None:
+            SaveImage(tk._default_root, sheet, params)
+
+    def ask_queue(self):
+        QueueDialog(tk._default_root, on_submit=lambda outdir, template, count, init_folder: self.queue(
+            outdir, template, count, init_folder
+        ))
+
+    def queue(self, outdir, template, count, init_folder=None):
+        stage = "Runtime"
+        try:
+            stage = "Get prompts"
+            prompt_txt = self.prompt.get().strip()
+            if prompt_txt:
+                self.prompt.update_history()
+            neg_prompt_txt = self.neg_prompt.get().strip()
+            if neg_prompt_txt:
+                self.neg_prompt.update_history()
+
+            stage = "Get parameters"
+            width, height = self.imsize.get()
+            loras = self.lora.get()
+            if loras:
+                self.lora.update_history()
+            init_image_file, strength = self.init_img.get()
+            self.init_img.add_history()
+            repo_name = self.repo.get()
             self.repo.update_history()
+            request = dict(
+                repo=repo_name, connect=self.checkbox['connect'].get(),
+                prompt=prompt_txt, negative_prompt=neg_prompt_txt, guidance_scale=self.guidance.get(),
+                image_file=init_image_file, strength=strength, width=width, height=height,
+                num_inference_steps=self.steps.get(), block_nsfw=self.checkbox['nsfw'].get(),
+                loras=loras, fuse_loras=self.checkbox['fuse_lora'].get(),
+                hires=self.checkbox['hires'].get(), hires_strength=cfg.config['hires_strength'],
+                step_cache=cfg.config['step_cache'], token_merge=cfg.config['token_merge'],
+                guidance_truncation=cfg.config['guidance_truncation'],
+                adprompt=self.prompt.adprompt.get(), negative_adprompt=self.neg_prompt.adprompt.get()
+            )
 
-            stage = "Inference"
-            result = self.diffusers_handler.run(
-                prompt=prompt_txt, negative_prompt=neg_prompt_txt, guidance_scale=guidance_val,
-                image_file=init_image_file, strength=strength,
-                width=width, height=height,
-                num_inference_steps=num_steps, number=1, seed=seed_val,
-                block_nsfw=block_nsfw)
-
-            stage = "Save results"
-            to_show = []
-            actual_size = None
-            for image, params in result:
-                if actual_size is None:
-                    actual_size = (params['width'], params['height'])
-                    self.imsize.set(actual_size)
-
-                if image is not None:
-                    SaveImage(tk._default_root, image, params)
-                    #to_show.append(image)
-                else:
-                    to_show.append(cfg.config['nsfw_image'])
-
-            #stage = "Show image"
-            #if to_show:
-            #    length = len(to_show)
-            #    rows = floor(sqrt(length))
-            #    cols = (length - 1) // rows + 1
-            #   im_grid = make_image_grid(to_show, rows, cols)
-            #    self.output.set_image(im_grid)
+            stage = "Submit"
+            # Seeds are fixed at submit time, so a resumed job reproduces exactly the planned image
+            seed_val = self.seed.get()
+            if init_folder is not None:
+                # Image i of the folder gets seed + i
+                folder_request = {key: value for key, value in request.items() if key in REQUEST_KEYS}
+                self.job_queue.submit(
+                    dict(folder_request, init_folder=init_folder, seed=seed_val), outdir, template, kind="folder"
+                )
+                self.status_var.set(f"Queued img2img of {init_folder}")
+                cfg.save()
+                return
+            for index in range(count):
+                seed = (seed_val + index + (1 << 63)) % (1 << 64) - (1 << 63)
+                self.job_queue.submit(dict(request, seed=seed), outdir, template)
+            self.status_var.set(f"Queued {count} image(s)")
 
         except Exception as error:
-            info = self.diffusers_handler.err_info
             messagebox.showerror(
                 title=stage + " ERROR",
-                message=f"{type(error).__name__} ERROR:\n\n{str(error)}" +
-                        (f"\n\n{str(info)}" if info else "")
+                message=f"{type(error).__name__} ERROR:\n\n{str(error)}"
             )
         cfg.save()
@@ -0,0 +1,169 @@
+import os
+import queue
+import tkinter as tk
+from tkinter import ttk, messagebox
+
+import cfg
+from widgets.common import ChooseDir, HistoryCombo
+from jobqueue import JobQueue, JobWorker
+
+
+class QueueDialog(tk.Toplevel):
+    def __init__(self, root, on_submit):
+        super(QueueDialog, self).__init__(root)
+        self.title("Queue generation")
+        self.columnconfigure(1, weight=1)
+        self.on_submit = on_submit
+
+        self.outdir = ChooseDir(self, "Path: ", width=80, history=cfg.config['outdir_history'])
+        self.outdir.grid(column=0, row=0, columnspan=2, sticky=tk.W+tk.E, padx=5, pady=5)
+        self.template = HistoryCombo(self, "File name: ", width=40, history=cfg.config['queue_template_history'])
+        self.template.grid(column=0, row=1, columnspan=2, sticky=tk.W+tk.E, padx=5, pady=5)
+
+        self.count_var = tk.StringVar(value="1")
+        ttk.Label(self, text="Images: ").grid(column=0, row=2, sticky=tk.E, padx=5, pady=5)
+        ttk.Spinbox(self, from_=1, to=1000, width=8, textvariable=self.count_var).grid(
+            column=1, row=2, sticky=tk.W, padx=5, pady=5
+        )
+        # Instead of a number of images: img2img of every image in a folder, the '?' mask takes its name
+        self.folder_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self, text="Img2img of every image in folder", variable=self.folder_var).grid(
+            column=0, row=3, columnspan=2, sticky=tk.W, padx=5, pady=5
+        )
+        self.init_folder = ChooseDir(self, "Folder: ", width=80, history=cfg.config['init_folder_history'])
+        self.init_folder.grid(column=0, row=4, columnspan=2, sticky=tk.W+tk.E, padx=5, pady=5)
+
+        self.button_frame = ttk.Frame(self)
+        self.submit_button = ttk.Button(self.button_frame, text="Queue", command=lambda *args: self.submit())
+        self.submit_button.grid(row=0, column=0, padx=5, pady=5)
+        self.cancel_button = ttk.Button(self.button_frame, text="Cancel", command=lambda *args: self.destroy())
+        self.cancel_button.grid(row=0, column=1, padx=5, pady=5)
+        self.button_frame.grid(row=5, column=0, columnspan=2, sticky=tk.E)
+
+    def submit(self):
+        try:
+            count = int(self.count_var.get())
+            template = self.template.get().strip()
+            if count < 1:
+                raise ValueError("Number of images must be positive")
+            if '?' not in template or os.sep in template or '/' in template:
+                raise ValueError("File name needs a '?' counter mask and no folder")
+            init_folder = self.init_folder.get() if self.folder_var.get() else None
+            if init_folder is not None and not os.path.isdir(init_folder):
+                raise ValueError(f"No folder {init_folder}")
+        except ValueError as error:
+            messagebox.showerror(title="Queue ERROR", message=str(error), parent=self)
+            return
+        outdir = self.outdir.get()
+        self.outdir.update_history()
+        self.template.update_history()
+        if init_folder is not None:
+            self.init_folder.update_history()
+        cfg.save()
+        self.destroy()
+        self.on_submit(outdir, template, count, init_folder)
+
+
+class QueueTab(ttk.Frame):
+    COLUMNS = (('id', "#", 50), ('state', "State", 90), ('prompt', "Prompt", 420), ('seed', "Seed", 170),
+               ('output', "Output", 320))
+
+    def __init__(self, root, job_queue: JobQueue, get_handler):
+        super(QueueTab, self).__init__(root, padding="3 3 12 12")
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        self.job_queue = job_queue
+        self.events = queue.SimpleQueue()
+
+        self.tree = ttk.Treeview(self, columns=[name for name, *_ in self.COLUMNS], show='headings')
+        for name, text, width in self.COLUMNS:
+            self.tree.heading(name, text=text)
+            self.tree.column(name, width=width, stretch=name in ('prompt', 'output'))
+        self.tree.grid(column=0, row=0, sticky=tk.N+tk.S+tk.W+tk.E, padx=5, pady=5)
+        self.y_scroll = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.tree.yview)
+        self.y_scroll.grid(column=1, row=0, sticky=tk.N+tk.S)
+        self.tree.config(yscrollcommand=self.y_scroll.set)
+
+        self.button_frame = ttk.Frame(self)
+        self.cancel_button = ttk.Button(self.button_frame, text="Cancel", command=lambda *args: self.cancel())
+        self.cancel_button.grid(row=0, column=0, padx=5, pady=5)
+        self.retry_button = ttk.Button(self.button_frame, text="Retry", command=lambda *args: self.retry())
+        self.retry_button.grid(row=0, column=1, padx=5, pady=5)
+        self.clear_button = ttk.Button(self.button_frame, text="Clear finished", command=lambda *args: self.clear())
+        self.clear_button.grid(row=0, column=2, padx=5, pady=5)
+        self.status_var = tk.StringVar()
+        ttk.Label(self.button_frame, textvariable=self.status_var).grid(row=0, column=3, padx=5, pady=5)
+        self.button_frame.grid(column=0, row=1, columnspan=2, sticky=tk.W)
+
+        # Unfinished jobs of a previous session are resumed as soon as the handler is ready
+        self.worker = JobWorker(job_queue, get_handler, on_event=self.events.put).start()
+        self.refresh()
+        self.after(200, self.poll)
+
+    def selected(self) -> list[int]:
+        return [int(item) for item in self.tree.selection()]
+
+    def cancel(self):
+        for job_id in self.selected():
+            self.job_queue.cancel(job_id)
+        self.refresh()
+
+    def retry(self):
+        for job_id in self.selected():
+            self.job_queue.retry(job_id)
+        self.refresh()
+
+    def clear(self):
+        self.job_queue.clear()
+        self.refresh()
+
+    def refresh(self):
+        selection = self.tree.selection()
+        self.tree.delete(*self.tree.get_children())
+        for job in self.job_queue.jobs():
+            outputs = [path for path in job['outputs'] or [] if path]
+            if job['state'] == 'failed':
+                output = job['error']
+            elif job['kind'] == "folder":
+                output = f"{job['request']['init_folder']} -> {len(outputs)} image(s)" if job['outputs'] is not None \
+                    else job['request']['init_folder']
+            else:
+                output = ", ".join(outputs)
+            self.tree.insert('', tk.END, iid=str(job['id']), values=(
+                job['id'], job['state'], job['request'].get('prompt', ""), job['request'].get('seed', ""), output
+            ))
+        self.tree.selection_set([item for item in selection if self.tree.exists(item)])
+        self.show_counts()
+
+    def show_counts(self, extra: str = ""):
+        counts = self.job_queue.counts()
+        text = ", ".join(f"{state} {count}" for state, count in sorted(counts.items()))
+        self.status_var.set(text + (f"; {extra}" if extra else ""))
+
+    def poll(self):
+        changed = False
+        progress = ""
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event['type'] == 'progress':
+                    progress = f"{event['stage']}: {event['step']}/{event['steps']}"
+                    if event['eta'] is not None:
+                        progress += f", ~{event['eta']:.0f} s left"
+                elif event['type'] == 'stopped':
+                    progress = "Queue stopped: " + event['error']
+                elif event['type'] == 'preempted':
+                    progress = "Paused for interactive run"
+                else:
+                    changed = True
+        except queue.Empty:
+            pass
+        if changed:
+            self.refresh()
+        elif progress:
+            self.show_counts(progress)
+        self.after(200, self.poll)
+
+    def destroy(self):
+        self.worker.stop.set()
+        super(QueueTab, self).destroy()
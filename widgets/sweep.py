@@ -0,0 +1,46 @@
+import tkinter as tk
+from tkinter import ttk, messagebox
+
+
+def parse_list(text: str, dtype) -> list:
+    return [dtype(item) for item in text.replace(';', ',').split(',') if item.strip()]
+
+
+class SweepDialog(tk.Toplevel):
+    def __init__(self, root, guidance, steps, seed, on_run):
+        super(SweepDialog, self).__init__(root)
+        self.title("Parameter sweep")
+        self.columnconfigure(1, weight=1)
+        self.on_run = on_run
+
+        self.guidance_var = tk.StringVar(value=", ".join(str(g) for g in guidance))
+        self.steps_var = tk.StringVar(value=", ".join(str(s) for s in steps))
+        self.seeds_var = tk.StringVar(value=", ".join(str(s) for s in seed))
+
+        for row, (label, var) in enumerate([
+            ("Guidance scales: ", self.guidance_var),
+            ("Inference steps: ", self.steps_var),
+            ("Seeds: ", self.seeds_var)
+        ]):
+            ttk.Label(self, text=label).grid(column=0, row=row, sticky=tk.E, padx=5, pady=5)
+            ttk.Entry(self, width=60, textvariable=var).grid(column=1, row=row, sticky=tk.W+tk.E, padx=5, pady=5)
+
+        self.button_frame = ttk.Frame(self)
+        self.run_button = ttk.Button(self.button_frame, text="Run", command=lambda *args: self.run())
+        self.run_button.grid(row=0, column=0, padx=5, pady=5)
+        self.cancel_button = ttk.Button(self.button_frame, text="Cancel", command=lambda *args: self.destroy())
+        self.cancel_button.grid(row=0, column=1, padx=5, pady=5)
+        self.button_frame.grid(row=3, column=0, columnspan=2, sticky=tk.E)
+
+    def run(self):
+        try:
+            guidance = parse_list(self.guidance_var.get(), float)
+            steps = parse_list(self.steps_var.get(), int)
+            seeds = parse_list(self.seeds_var.get(), int)
+            if not guidance or not steps or not seeds:
+                raise ValueError("Every list needs at least one value")
+        except ValueError as error:
+            messagebox.showerror(title="Sweep ERROR", message=str(error), parent=self)
+            return
+        self.destroy()
+        self.on_run(guidance, steps, seeds)